@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Listen and target addresses.
+
+"host:port" is a tcp address, kept as a (host, port) tuple, ipv6 literals
+are written "[::1]:port" and kept without the brackets. "unix:/path" is
+a unix socket and "unix:@name" one in the abstract namespace (linux), both
+kept as the path string, "\\0name" for abstract ones.
+"""
+import socket
+import struct
+from collections import namedtuple
+
+UNIX_PREFIX = "unix:"
+
+PeerCred = namedtuple("PeerCred", ["pid", "uid", "gid"])
+
+
+def parse_addr(spec, default_port=None):
+    """"host:port" or "[v6]:port" -> (host, port), "unix:/path" -> "/path\""""
+    if spec.startswith(UNIX_PREFIX):
+        path = spec[len(UNIX_PREFIX):]
+        if not path:
+            raise ValueError("empty unix socket path")
+        return "\0" + path[1:] if path.startswith("@") else path
+    host, sep, port = spec.rpartition(":")
+    if not sep or (":" in host and not host.startswith("[")) or \
+            (spec.startswith("[") and not host.endswith("]")):
+        # no port: "host", a bare "::1" or "[::1]"
+        host, port = spec, default_port
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    if port is None:
+        raise ValueError("no port in {}".format(spec))
+    return host, int(port)
+
+
+def is_unix(addr):
+    return isinstance(addr, str)
+
+
+def format_addr(addr):
+    if is_unix(addr):
+        return UNIX_PREFIX + ("@" + addr[1:] if addr.startswith("\0") else addr)
+    host, port = addr[:2]
+    return "[{}]:{}".format(host, port) if ":" in str(host) else "{}:{}".format(host, port)
+
+
+def family_of(addr):
+    if is_unix(addr):
+        return socket.AF_UNIX
+    return socket.AF_INET6 if ":" in addr[0] else socket.AF_INET
+
+
+def parse_port_range(spec):
+    """"40000-40099" or "40000" -> (first, last)"""
+    first, _, last = str(spec).partition("-")
+    first, last = int(first), int(last or first)
+    if not 0 < first <= last < 65536:
+        raise ValueError("bad port range: {}".format(spec))
+    return first, last
+
+
+def peer_credentials(sock):
+    """PeerCred of the process on the other end of a unix socket, None if unknown"""
+    if hasattr(socket, "SO_PEERCRED"):
+        fmt = struct.Struct("3i")
+        try:
+            return PeerCred(*fmt.unpack(sock.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, fmt.size)))
+        except OSError:
+            return None
+    if hasattr(socket, "LOCAL_PEERCRED"):
+        # struct xucred: version, uid, ngroups, groups[16], no pid
+        fmt = struct.Struct("=IIh2x16I")
+        try:
+            cred = fmt.unpack(sock.getsockopt(0, socket.LOCAL_PEERCRED, fmt.size))
+        except OSError:
+            return None
+        return PeerCred(None, cred[1], cred[3] if cred[2] else None)
+    return None
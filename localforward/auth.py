@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Username/password authentication (RFC 1929 for socks5, Basic for http).
+
+Credentials come from a store: `CredentialFile`, lines of "user:hash" with
+salted pbkdf2/scrypt hashes made by `hash_password` (or `localforward passwd`),
+or `CallbackStore` around any check(username, password) -> bool.
+
+Running the slow hash for every connection would make the handshake cost
+more than the tunnel, so `Authenticator` keeps a bounded LRU of recently
+verified logins. Entries are an HMAC of the credentials under a key that
+only lives in this process, compared in constant time, and expire after
+`ttl` seconds, or all at once when the store reports a new generation
+(the credential file changed). Verification runs on the pool worker doing
+the handshake, never on the accept loop or the relay engine.
+"""
+import os
+import hmac
+import time
+import base64
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+PBKDF2_ITERATIONS = 200000
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode()
+
+
+def hash_password(password, method="pbkdf2", salt=None):
+    """encoded salted hash of password, as stored in credential files"""
+    salt = salt or os.urandom(16)
+    password = password.encode()
+    if method == "pbkdf2":
+        digest = hashlib.pbkdf2_hmac("sha256", password, salt, PBKDF2_ITERATIONS)
+        return "pbkdf2_sha256${}${}${}".format(PBKDF2_ITERATIONS, _b64(salt), _b64(digest))
+    if method == "scrypt":
+        digest = hashlib.scrypt(password, salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return "scrypt${}:{}:{}${}${}".format(SCRYPT_N, SCRYPT_R, SCRYPT_P, _b64(salt), _b64(digest))
+    raise ValueError("unknown hash method: {}".format(method))
+
+
+def verify_password(password, encoded) -> bool:
+    try:
+        method, params, salt, expected = encoded.split("$")
+        salt, expected = base64.b64decode(salt), base64.b64decode(expected)
+        if method == "pbkdf2_sha256":
+            digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, int(params))
+        elif method == "scrypt":
+            n, r, p = (int(v) for v in params.split(":"))
+            digest = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                                    dklen=len(expected))
+        else:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+class CredentialFile(object):
+    """"user:hash" lines, re-read when the file changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._users = {}
+        # bumped on every re-read, see Authenticator
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        st = os.stat(self.path)
+        mtime = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if mtime == self._mtime:
+            return
+        users = {}
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    user, _, encoded = line.partition(":")
+                    users[user] = encoded
+        self._users, self._mtime = users, mtime
+        self._generation += 1
+
+    def generation(self):
+        """changes whenever the users in the file may have changed"""
+        with self._lock:
+            self._load()
+            return self._generation
+
+    def check(self, username, password) -> bool:
+        with self._lock:
+            self._load()
+            encoded = self._users.get(username)
+        if encoded is None:
+            # as slow as a real check, not telling which users exist
+            hashlib.pbkdf2_hmac("sha256", password.encode(), b"\x00" * 16, PBKDF2_ITERATIONS)
+            return False
+        return verify_password(password, encoded)
+
+    def set(self, username, password, method="pbkdf2"):
+        """add or replace a user, the file is replaced as a whole and only readable by us"""
+        with self._lock:
+            lines = []
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    lines = [line for line in f if line.partition(":")[0] != username]
+            lines.append("{}:{}\n".format(username, hash_password(password, method)))
+            # mkstemp creates it 0600
+            fd, tmp = tempfile.mkstemp(prefix=".", dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.writelines(lines)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self._mtime = None
+
+
+class CallbackStore(object):
+    """"""
+
+    def __init__(self, check):
+        self.check = check
+
+
+class Authenticator(object):
+    """"""
+
+    def __init__(self, store, cache_size=1024, ttl=300, stats=None):
+        self.store = store
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.stats = stats
+        self._key = os.urandom(32)
+        # username -> (digest, verified at)
+        self._cache = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def _digest(self, username, password):
+        return hmac.new(self._key, "{}\0{}".format(username, password).encode(),
+                        hashlib.sha256).digest()
+
+    def _count(self, name):
+        if self.stats:
+            self.stats.incr(name)
+
+    def _store_generation(self):
+        generation = getattr(self.store, "generation", None)
+        if generation is None:
+            return None
+        try:
+            return generation()
+        except OSError as e:
+            logger.warn("credential store error: {}".format(e))
+            return None
+
+    def verify(self, username, password) -> bool:
+        digest = self._digest(username, password)
+        now = time.monotonic()
+        generation = self._store_generation()
+        with self._lock:
+            if generation != self._generation:
+                # users may be gone or have new passwords
+                self._cache.clear()
+                self._generation = generation
+            cached = self._cache.get(username)
+            if cached and now - cached[1] < self.ttl:
+                if hmac.compare_digest(cached[0], digest):
+                    self._cache.move_to_end(username)
+                    self._count("auth_cache_hits")
+                    self._count("auth_ok")
+                    return True
+
+        try:
+            ok = bool(self.store.check(username, password))
+        except Exception as e:
+            logger.warn("credential store error: {}".format(e))
+            ok = False
+
+        if not ok:
+            self._count("auth_failed")
+            return False
+        with self._lock:
+            if generation != self._generation:
+                # checked against users that changed meanwhile, don't cache
+                self._count("auth_ok")
+                return True
+            self._cache[username] = (digest, now)
+            self._cache.move_to_end(username)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        self._count("auth_ok")
+        return True
+
+    def forget(self, username=None):
+        """drop cached logins, e.g. after a password change"""
+        with self._lock:
+            if username is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(username, None)
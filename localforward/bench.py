@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Benchmarks.
+
+    localforward bench idle --sessions 10000
+    localforward bench handshake --count 20000 --max-read 1
+    localforward bench relay --megabytes 512 --sessions 4
+
+`idle` starts a socks5 server in a child process and a backend that accepts
+and holds connections, opens N tunnels through the server and leaves them
+idle, then reports how much the resident set of the server grew per tunnel.
+
+`handshake` runs socks5 handshakes in this process over memory transports,
+no kernel and no threads involved, and reports the CPU time per handshake.
+Faults of the transport (--max-read, --latency) check the handshake copes.
+
+`relay` pushes data through the relay engine over socketpairs and reports
+the CPU time per MB, less what pushing the same data through plain
+socketpairs costs.
+"""
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from . import outils
+from . import client
+from .relay import RelayEngine
+from .sessions import Sock5Session
+from .sessions.base import SessionBase
+from .transport import memory_pair, MemoryNetwork
+
+logger = outils.get_logger("localforward")
+
+
+def raise_nofile(want):
+    """raise the open files limit towards want, returns the soft limit in effect"""
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        want = min(want, hard)
+    if want > soft:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+            soft = want
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+def rss_of(pid):
+    """resident set size of a process in bytes"""
+    out = subprocess.check_output(["ps", "-o", "rss=", "-p", str(pid)])
+    return int(out.strip()) * 1024
+
+
+def free_port(host="127.0.0.1"):
+    sock = socket.socket()
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class HoldingBackend(object):
+    """accepts connections and keeps them open without reading"""
+
+    def __init__(self, host="127.0.0.1", backlog=1024):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(backlog)
+        self.addr = self.sock.getsockname()
+        self.conns = []
+        self._thread = threading.Thread(target=self._accept, name="bench-backend")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.conns.append(conn)
+
+    def close(self):
+        self.sock.close()
+        for conn in self.conns:
+            conn.close()
+
+
+def open_tunnel(proxy, dest):
+    """socks5 CONNECT through proxy, returns the connected socket"""
+    sock = socket.create_connection(proxy)
+    sock.sendall(b"\x05\x01\x00")
+    if sock.recv(2) != b"\x05\x00":
+        raise ConnectionError("bad socks5 greeting reply")
+    sock.sendall(b"\x05\x01\x00\x01" + socket.inet_aton(dest[0]) + struct.pack("!H", dest[1]))
+    rsp = sock.recv(10)
+    if len(rsp) < 2 or rsp[1] != 0:
+        raise ConnectionError("socks5 CONNECT failed: {}".format(rsp))
+    return sock
+
+
+def spawn_server(port, size=20, extra=()):
+    cmd = [sys.executable, "-c", "from localforward import cli; cli()",
+           "-p", str(port), "--size", str(size), "--idle-timeout", "0"] + list(extra)
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not come up on port {}".format(port))
+
+
+def idle_rss(sessions=1000, warmup=100, settle=1.0, extra=()):
+    """bytes of server RSS per idle tunnel"""
+    raise_nofile(sessions * 2 + warmup * 2 + 256)
+    backend = HoldingBackend()
+    port = free_port()
+    proc = spawn_server(port, extra=extra)
+    proxy = ("127.0.0.1", port)
+    clients = []
+    try:
+        # the first tunnels start the relay engine, timers and friends
+        for _ in range(warmup):
+            clients.append(open_tunnel(proxy, backend.addr))
+        time.sleep(settle)
+        before = rss_of(proc.pid)
+
+        for _ in range(sessions):
+            clients.append(open_tunnel(proxy, backend.addr))
+        time.sleep(settle)
+        after = rss_of(proc.pid)
+    finally:
+        for sock in clients:
+            sock.close()
+        proc.terminate()
+        proc.wait()
+        backend.close()
+
+    return {
+        "sessions": sessions,
+        "rss_before": before,
+        "rss_after": after,
+        "bytes_per_session": (after - before) / float(sessions),
+    }
+
+
+class _DiscardEngine(object):
+    """stands in for the relay engine, sessions end right after the handshake"""
+
+    def add(self, session):
+        session.close()
+
+    def __len__(self):
+        return 0
+
+
+def handshake_cpu(count=10000, max_read=None, latency=0):
+    """CPU seconds per socks5 handshake, CONNECT included, over memory transports"""
+    network = MemoryNetwork()
+    network.listen("*", lambda server_end: None)
+    options = {"engine": _DiscardEngine(), "connector": network}
+    request = client.handshake_bytes("10.0.0.1", 80)
+
+    start = time.process_time()
+    for sid in range(count):
+        client_end, server_end = memory_pair(max_read=max_read, latency=latency)
+        client_end.sendall(request)
+        session = Sock5Session(server_end, ("127.0.0.1", 40000 + sid % 20000), options, sid)
+        session.handle()
+        # method choice and the CONNECT reply with an IPv4 address
+        reply = b""
+        while len(reply) < 12:
+            reply += client_end.recv(12 - len(reply))
+        if reply[:2] != b"\x05\x00" or reply[3:4] != b"\x00":
+            raise RuntimeError("handshake failed: {!r}".format(reply))
+    cpu = time.process_time() - start
+    return {"handshakes": count, "cpu": cpu, "cpu_per_handshake": cpu / count}
+
+
+def _push(pairs, total, chunk=64 * 1024):
+    """send total bytes into each (sender, receiver) pair and read them out, CPU seconds"""
+    payload = b"x" * chunk
+
+    def send(sock):
+        left = total
+        while left > 0:
+            sock.sendall(payload[:min(left, chunk)])
+            left -= chunk
+
+    def receive(sock):
+        buf = bytearray(chunk)
+        got = 0
+        while got < total:
+            n = sock.recv_into(buf)
+            if not n:
+                raise RuntimeError("stream ended after {} of {} bytes".format(got, total))
+            got += n
+
+    threads = [threading.Thread(target=send, args=(s,)) for s, _ in pairs]
+    threads += [threading.Thread(target=receive, args=(r,)) for _, r in pairs]
+    start = time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.process_time() - start
+
+
+def relay_cpu(megabytes=256, sessions=4):
+    """CPU seconds per MB relayed by the engine, the cost of the sockets themselves excluded"""
+    total = megabytes * 1024 * 1024 // sessions
+    baseline_pairs = [socket.socketpair() for _ in range(sessions)]
+    baseline = _push(baseline_pairs, total)
+
+    engine = RelayEngine()
+    options = {"engine": engine}
+    pairs, socks = [], []
+    for sid in range(sessions):
+        client_end, conn = socket.socketpair()
+        upstream, backend = socket.socketpair()
+        session = SessionBase(conn, ("127.0.0.1", 40000 + sid), options, sid)
+        session.relay(upstream)
+        pairs.append((client_end, backend))
+        socks += [client_end, backend]
+    try:
+        cpu = _push(pairs, total)
+    finally:
+        engine.stop()
+        for sock in socks + [s for pair in baseline_pairs for s in pair]:
+            sock.close()
+
+    relay = max(cpu - baseline, 0.0)
+    return {"megabytes": megabytes, "sessions": sessions, "cpu": cpu, "baseline": baseline,
+            "cpu_per_mb": relay / megabytes}
+
+
+def main(argv):
+    """localforward bench idle|handshake|relay"""
+    parser = argparse.ArgumentParser(prog="localforward bench")
+    parser.add_argument("kind", choices=["idle", "handshake", "relay"], help="what to measure.")
+    parser.add_argument("-n", "--sessions", type=int, default=None,
+                        help="tunnels opened and held idle (idle, 1000) or relaying at "
+                             "once (relay, 4).")
+    parser.add_argument("--warmup", type=int, default=100,
+                        help="tunnels opened before the baseline is taken.")
+    parser.add_argument("--count", type=int, default=10000,
+                        help="handshakes to run.")
+    parser.add_argument("--max-read", type=int,
+                        help="bytes a recv returns at most during handshakes.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds of simulated latency during handshakes.")
+    parser.add_argument("--megabytes", type=int, default=256,
+                        help="data relayed in total.")
+    cmd_options = parser.parse_args(argv)
+
+    if cmd_options.kind == "handshake":
+        result = handshake_cpu(cmd_options.count, cmd_options.max_read, cmd_options.latency)
+        print("handshakes:    {handshakes}\n"
+              "cpu:           {cpu:.3f} s\n"
+              "per handshake: {0:.1f} us".format(result["cpu_per_handshake"] * 1e6, **result))
+    elif cmd_options.kind == "relay":
+        result = relay_cpu(cmd_options.megabytes, cmd_options.sessions or 4)
+        print("relayed:       {megabytes} MB over {sessions} sessions\n"
+              "cpu:           {cpu:.3f} s ({baseline:.3f} s without the engine)\n"
+              "per MB:        {0:.2f} ms".format(result["cpu_per_mb"] * 1e3, **result))
+    else:
+        result = idle_rss(cmd_options.sessions or 1000, cmd_options.warmup)
+        print("idle sessions: {sessions}\n"
+              "rss before:    {rss_before}\n"
+              "rss after:     {rss_after}\n"
+              "per session:   {bytes_per_session:.0f} bytes".format(**result))
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Traffic capture into a memory-mapped ring file.
+
+The ring is a file of fixed-size slots. A writer reserves a slot by taking
+the next sequence number from an `itertools.count`, copies the chunk into
+the mapping and stamps the slot header last. Chunks larger than a slot are
+spread over several slots. When the ring is full the oldest slots are
+overwritten, forwarding never waits for the capture. Writers hold a lock
+only for the copy, so `close` cannot unmap the ring under them; the copy
+holds the GIL anyway.
+
+`CaptureReader` reads a ring file offline and exports sessions or a time
+window as pcap (synthesized TCP/IPv4 packets) or as raw streams.
+"""
+import os
+import json
+import mmap
+import time
+import random
+import socket
+import struct
+import fnmatch
+import ipaddress
+import itertools
+import threading
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+MAGIC = b"LFCAP001"
+
+DIR_SEND = 0
+DIR_RECV = 1
+
+KIND_OPEN = 1
+KIND_DATA = 2
+KIND_CLOSE = 3
+
+# magic, slot size, number of slots
+_FILE_HDR = struct.Struct("<8sII")
+_FILE_HDR_SIZE = 4096
+# seq, sid, timestamp, stream offset, length, kind, direction
+_SLOT_HDR = struct.Struct("<QQdQIBB2x")
+
+DEFAULT_SLOT_SIZE = 2048
+
+
+class CaptureFilter(object):
+    """
+    decide at session open if the session is captured.
+
+    dest/client are lists of glob patterns ("*.example.com", "10.0.0.*") or
+    networks ("10.0.0.0/8"), sample is the fraction of matching sessions kept.
+    """
+
+    def __init__(self, dest=None, client=None, sample=1.0):
+        self.dest = [self._compile(i) for i in dest or []]
+        self.client = [self._compile(i) for i in client or []]
+        self.sample = sample
+
+    @staticmethod
+    def _compile(rule):
+        try:
+            return ipaddress.ip_network(rule, strict=False)
+        except ValueError:
+            return rule
+
+    @staticmethod
+    def _match(rules, host):
+        if not rules:
+            return True
+        try:
+            ip = ipaddress.ip_address(host)
+        except ValueError:
+            ip = None
+        for rule in rules:
+            if isinstance(rule, str):
+                if fnmatch.fnmatch(host, rule):
+                    return True
+            elif ip is not None and ip.version == rule.version and ip in rule:
+                return True
+        return False
+
+    def accept(self, client_host, *dest_hosts):
+        """dest_hosts are the names a destination is known by, any may match"""
+        if not self._match(self.client, client_host):
+            return False
+        if not any(self._match(self.dest, host) for host in dest_hosts):
+            return False
+        return self.sample >= 1 or random.random() < self.sample
+
+
+class Capture(object):
+    """"""
+
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=DEFAULT_SLOT_SIZE,
+                 capture_filter: CaptureFilter = None):
+        if slot_size <= _SLOT_HDR.size:
+            raise ValueError("slot_size is too small: {}".format(slot_size))
+
+        self.path = path
+        self.slot_size = slot_size
+        self.nslots = (size - _FILE_HDR_SIZE) // slot_size
+        if self.nslots <= 0:
+            raise ValueError("capture size is too small: {}".format(size))
+        self.filter = capture_filter or CaptureFilter()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        # drop the old content, the new file is sparse and zeroed
+        os.ftruncate(self._fd, 0)
+        os.ftruncate(self._fd, _FILE_HDR_SIZE + self.nslots * slot_size)
+        self._mm = mmap.mmap(self._fd, 0)
+        _FILE_HDR.pack_into(self._mm, 0, MAGIC, slot_size, self.nslots)
+
+        self._seq = itertools.count(1)
+        self._payload_size = slot_size - _SLOT_HDR.size
+        # taken by writers and close, the mapping is gone after close
+        self._lock = threading.Lock()
+
+    def open_session(self, sid, client: tuple, dest: tuple, host=None):
+        """
+        returns a SessionCapture, or None if the filter drops the session.
+        dest is the connected peer address, host the requested name if any.
+        """
+        host = host or str(dest[0])
+        if self._mm is None or not self.filter.accept(str(client[0]), str(dest[0]), host):
+            return None
+
+        meta = {
+            "client": [str(client[0]), client[1]],
+            "dest": [str(dest[0]), dest[1]],
+            "host": host,
+        }
+        self.write(sid, KIND_OPEN, DIR_SEND, 0, json.dumps(meta).encode())
+        return SessionCapture(self, sid)
+
+    def write(self, sid, kind, direction, offset, data):
+        """append one record, split over as many slots as needed"""
+        view = memoryview(data)
+        size = self._payload_size
+        ts = time.time()
+        pos = 0
+        with self._lock:
+            mm = self._mm
+            if mm is None:
+                return
+            while True:
+                part = view[pos:pos + size]
+                seq = next(self._seq)
+                base = _FILE_HDR_SIZE + ((seq - 1) % self.nslots) * self.slot_size
+                mm[base + _SLOT_HDR.size:base + _SLOT_HDR.size + len(part)] = part
+                _SLOT_HDR.pack_into(mm, base, seq, sid, ts, offset + pos,
+                                    len(part), kind, direction)
+                pos += len(part)
+                if pos >= len(view):
+                    break
+
+    def close(self):
+        with self._lock:
+            mm, self._mm = self._mm, None
+            if mm is not None:
+                mm.flush()
+                mm.close()
+                os.close(self._fd)
+
+
+class SessionCapture(object):
+    """"""
+
+    __slots__ = ("capture", "sid", "offsets")
+
+    def __init__(self, capture: Capture, sid):
+        self.capture = capture
+        self.sid = sid
+        self.offsets = [0, 0]
+
+    def record(self, direction, data):
+        self.capture.write(self.sid, KIND_DATA, direction, self.offsets[direction], data)
+        self.offsets[direction] += len(data)
+
+    def close(self):
+        self.capture.write(self.sid, KIND_CLOSE, DIR_SEND, 0, b"")
+
+
+class CaptureRecord(object):
+    """"""
+
+    __slots__ = ("seq", "sid", "ts", "offset", "kind", "direction", "data")
+
+    def __init__(self, seq, sid, ts, offset, kind, direction, data):
+        self.seq = seq
+        self.sid = sid
+        self.ts = ts
+        self.offset = offset
+        self.kind = kind
+        self.direction = direction
+        self.data = data
+
+
+class CaptureReader(object):
+    """"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            raw = f.read()
+
+        magic, self.slot_size, self.nslots = _FILE_HDR.unpack_from(raw, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a localforward capture file".format(path))
+        self._raw = raw
+
+    def records(self):
+        """valid records ordered by sequence"""
+        raw = self._raw
+        records = []
+        for i in range(self.nslots):
+            base = _FILE_HDR_SIZE + i * self.slot_size
+            seq, sid, ts, offset, length, kind, direction = _SLOT_HDR.unpack_from(raw, base)
+            if not seq or (seq - 1) % self.nslots != i:
+                continue
+            start = base + _SLOT_HDR.size
+            records.append(CaptureRecord(seq, sid, ts, offset, kind, direction,
+                                         raw[start:start + length]))
+        records.sort(key=lambda r: r.seq)
+        return records
+
+    def sessions(self, sid=None, start=None, end=None):
+        """group records by session: {sid: {"meta": {...}, "records": [...]}}"""
+        result = {}
+        for r in self.records():
+            if sid is not None and r.sid != sid:
+                continue
+            if (start is not None and r.ts < start) or (end is not None and r.ts > end):
+                continue
+            item = result.setdefault(r.sid, {"meta": None, "records": []})
+            if r.kind == KIND_OPEN:
+                item["meta"] = json.loads(r.data.decode())
+            else:
+                item["records"].append(r)
+        return result
+
+    def export_raw(self, directory, sid=None, start=None, end=None):
+        """write <sid>-send.bin and <sid>-recv.bin for each session"""
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for _sid, item in self.sessions(sid, start, end).items():
+            for direction, name in ((DIR_SEND, "send"), (DIR_RECV, "recv")):
+                path = os.path.join(directory, "{}-{}.bin".format(_sid, name))
+                with open(path, "wb") as f:
+                    for r in item["records"]:
+                        if r.kind == KIND_DATA and r.direction == direction:
+                            f.seek(r.offset)
+                            f.write(r.data)
+                paths.append(path)
+        return paths
+
+    def export_pcap(self, path, sid=None, start=None, end=None):
+        """write a pcap with one synthesized TCP flow per session"""
+        sessions = self.sessions(sid, start, end)
+        with open(path, "wb") as f:
+            writer = _PcapWriter(f)
+            for _sid, item in sorted(sessions.items()):
+                writer.session(_sid, item["meta"], item["records"])
+        return len(sessions)
+
+
+# pcap with LINKTYPE_RAW, payloads are IPv4 packets
+_PCAP_HDR = struct.Struct("<IHHiIII")
+_PCAP_REC = struct.Struct("<IIII")
+_IP_HDR = struct.Struct("!BBHHHBBH4s4s")
+_TCP_HDR = struct.Struct("!HHIIBBHHH")
+
+_TCP_FIN = 0x01
+_TCP_SYN = 0x02
+_TCP_PSH = 0x08
+_TCP_ACK = 0x10
+
+_MAX_SEGMENT = 65000
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b"\x00"
+    total = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def _port(value, default):
+    """unix clients are recorded with their pid as port, which may not fit"""
+    if isinstance(value, int) and 0 <= value <= 0xffff:
+        return value
+    return default
+
+
+def _ipv4(host, default):
+    try:
+        return ipaddress.IPv4Address(host).packed
+    except ValueError:
+        return default
+
+
+class _PcapWriter(object):
+    """"""
+
+    def __init__(self, f):
+        self.f = f
+        f.write(_PCAP_HDR.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 101))
+
+    def session(self, sid, meta, records):
+        if meta:
+            client = (_ipv4(meta["client"][0], b"\x7f\x00\x00\x01"),
+                      _port(meta["client"][1], 1024 + sid % 60000))
+            dest = (_ipv4(meta["dest"][0], b"\x7f\x00\x00\x02"), _port(meta["dest"][1], 1))
+        else:
+            # the open record was overwritten, keep the flow distinguishable
+            client = (socket.inet_aton("127.0.0.1"), 1024 + sid % 60000)
+            dest = (socket.inet_aton("127.0.0.2"), 1)
+
+        if not records:
+            return
+
+        ends = (client, dest)
+        isn = [1000, 2000]
+        ts = records[0].ts
+        self._packet(ts, ends, 0, isn[0] - 1, 0, _TCP_SYN, b"")
+        self._packet(ts, ends, 1, isn[1] - 1, isn[0], _TCP_SYN | _TCP_ACK, b"")
+        self._packet(ts, ends, 0, isn[0], isn[1], _TCP_ACK, b"")
+
+        acked = [0, 0]
+        for r in records:
+            ts = r.ts
+            if r.kind != KIND_DATA:
+                continue
+            d = r.direction
+            view = memoryview(r.data)
+            for pos in range(0, len(view), _MAX_SEGMENT):
+                seg = bytes(view[pos:pos + _MAX_SEGMENT])
+                self._packet(ts, ends, d, isn[d] + r.offset + pos,
+                             isn[1 - d] + acked[1 - d], _TCP_ACK | _TCP_PSH, seg)
+            acked[d] = max(acked[d], r.offset + len(view))
+
+        for d in (0, 1):
+            self._packet(ts, ends, d, isn[d] + acked[d], isn[1 - d] + acked[1 - d],
+                         _TCP_FIN | _TCP_ACK, b"")
+
+    def _packet(self, ts, ends, direction, seq, ack, flags, payload):
+        (src, sport), (dst, dport) = ends[direction], ends[1 - direction]
+        seq &= 0xffffffff
+        ack &= 0xffffffff
+        tcp = _TCP_HDR.pack(sport, dport, seq, ack, 5 << 4, flags, 65535, 0, 0)
+        pseudo = src + dst + struct.pack("!BBH", 0, socket.IPPROTO_TCP, len(tcp) + len(payload))
+        csum = _checksum(pseudo + tcp + payload)
+        tcp = tcp[:16] + struct.pack("!H", csum) + tcp[18:]
+
+        total = _IP_HDR.size + len(tcp) + len(payload)
+        ip = _IP_HDR.pack(0x45, 0, total, 0, 0, 64, socket.IPPROTO_TCP, 0, src, dst)
+        ip = ip[:10] + struct.pack("!H", _checksum(ip)) + ip[12:]
+
+        packet = ip + tcp + payload
+        sec = int(ts)
+        self.f.write(_PCAP_REC.pack(sec, int((ts - sec) * 1e6), len(packet), len(packet)))
+        self.f.write(packet)
@@ -1,9 +1,18 @@
 #!/usr/bin/env python3
 # coding:utf-8
+import sys
+import getpass
 import argparse
 
 import logging
 from .core import ForwordServer
+from .capture import Capture, CaptureFilter, CaptureReader
+from . import trace
+from . import top
+from .routes import RouteTable
+from .tunnel import TunnelClient
+from .address import parse_addr, parse_port_range
+from .auth import Authenticator, CredentialFile
 
 from .outils import get_logger
 
@@ -11,35 +20,247 @@ from .outils import get_logger
 logger = get_logger("localforward")
 
 
+def capture_export(argv):
+    """localforward capture-export RING [--pcap FILE | --raw DIR]"""
+    parser = argparse.ArgumentParser(prog="localforward capture-export")
+    parser.add_argument("ring", help="the capture ring file.")
+    parser.add_argument("--pcap", type=str, help="export as pcap to this file.")
+    parser.add_argument("--raw", type=str, help="export raw streams into this directory.")
+    parser.add_argument("--session", type=int, help="only export this session id.")
+    parser.add_argument("--since", type=float, help="start of the time window (unix time).")
+    parser.add_argument("--until", type=float, help="end of the time window (unix time).")
+    cmd_options = parser.parse_args(argv)
+
+    if not (cmd_options.pcap or cmd_options.raw):
+        parser.error("one of --pcap/--raw is required.")
+
+    reader = CaptureReader(cmd_options.ring)
+    window = (cmd_options.session, cmd_options.since, cmd_options.until)
+    if cmd_options.pcap:
+        count = reader.export_pcap(cmd_options.pcap, *window)
+        print("{} sessions exported to {}".format(count, cmd_options.pcap))
+    if cmd_options.raw:
+        paths = reader.export_raw(cmd_options.raw, *window)
+        print("{} streams exported to {}".format(len(paths), cmd_options.raw))
+
+
+def trace_summary(argv):
+    """localforward trace DUMP"""
+    parser = argparse.ArgumentParser(prog="localforward trace")
+    parser.add_argument("dump", help="a flight recorder dump (kill -USR1 <pid>).")
+    parser.add_argument("--top", type=int, default=5,
+                        help="how many of the slowest sessions are listed.")
+    cmd_options = parser.parse_args(argv)
+
+    with open(cmd_options.dump, "rb") as f:
+        records = trace.load(f.read())
+    print(trace.summarize(records, top=cmd_options.top))
+
+
+def top_view(argv):
+    """localforward top --control PATH"""
+    parser = argparse.ArgumentParser(prog="localforward top")
+    parser.add_argument("-c", "--control", type=str, required=True,
+                        help="control socket of the running server.")
+    parser.add_argument("-i", "--interval", type=float, default=1.0,
+                        help="seconds between refreshes.")
+    cmd_options = parser.parse_args(argv)
+
+    top.run(cmd_options.control, cmd_options.interval)
+
+
+def passwd(argv):
+    """localforward passwd FILE USER"""
+    parser = argparse.ArgumentParser(prog="localforward passwd")
+    parser.add_argument("file", help="the credential file (--auth-file).")
+    parser.add_argument("user", help="the user to add or change.")
+    parser.add_argument("--method", choices=["pbkdf2", "scrypt"], default="pbkdf2",
+                        help="how the password is hashed.")
+    cmd_options = parser.parse_args(argv)
+
+    password = getpass.getpass("password for {}: ".format(cmd_options.user))
+    if password != getpass.getpass("again: "):
+        parser.error("passwords do not match.")
+    CredentialFile(cmd_options.file).set(cmd_options.user, password, cmd_options.method)
+    print("{} is saved in {}".format(cmd_options.user, cmd_options.file))
+
+
+def bench_run(argv):
+    from . import bench
+    return bench.main(argv)
+
+
+def replay_run(argv):
+    from . import replay
+    return replay.main(argv)
+
+
+_SUBCOMMANDS = {
+    "capture-export": capture_export,
+    "trace": trace_summary,
+    "top": top_view,
+    "bench": bench_run,
+    "replay": replay_run,
+    "passwd": passwd,
+}
+
+
 def cli():
     """"""
+    if len(sys.argv) > 1 and sys.argv[1] in _SUBCOMMANDS:
+        return _SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
     logger.setLevel(logging.INFO)
     parser = argparse.ArgumentParser()
-    parser.add_argument("-p", "--port", type=int, default=8010,
-                        help="the port will be listened.")
+    parser.add_argument("-p", "--port", type=int,
+                        help="the port will be listened (default 8010, none with --table).")
     parser.add_argument("-l", "--listen-host", type=str, default="127.0.0.1", dest="host",
-                        help="which host is listened.")
+                        help="which host is listened, or unix:/path (unix:@name for abstract).")
 
     parser.add_argument("-rh", "--remote-host", type=str, dest="rhost",
-                        help="which host is forward to.")
+                        help="which host is forward to, or unix:/path.")
     parser.add_argument("-rp", "--remote_port", type=int, dest="rport",
                         help="the port of remote host.")
     parser.add_argument('--timeout', type=int, default=30,
-                        help='timeout for each connection.')
+                        help='handshake and upstream connect timeout for each connection.')
+    parser.add_argument('--idle-timeout', type=int, default=300,
+                        help='close tunnels without traffic for this many seconds, 0 to disable.')
+    parser.add_argument('--max-lifetime', type=int, default=0,
+                        help='close tunnels older than this many seconds, 0 to disable.')
     parser.add_argument("--size", type=int, default=20,
                         help="how many connections will be accepted same time.")
     parser.add_argument("--type", type=str, default="socks5",
-                        help="what type of forward.")
+                        help="what type of forward: socks5, http, auto (socks5 and http "
+                             "on one port), raw or tunnel-server.")
+    parser.add_argument("--table", type=str,
+                        help="serve every forward of this port-mapping table, reloaded on SIGHUP.")
+    parser.add_argument("--tunnel", type=str,
+                        help="carry upstream connections over a tunnel to this tunnel-server (host:port).")
+    parser.add_argument("--tunnel-connections", type=int, default=2,
+                        help="persistent connections to the tunnel-server.")
+    parser.add_argument("--tunnel-compress", action="store_true",
+                        help="zlib compress tunnel data frames.")
+    parser.add_argument("--tunnel-auth", type=str,
+                        help="username:password for a tunnel-server with --auth-file.")
+    parser.add_argument("--rate-global", type=int,
+                        help="bytes/sec limit of the whole server.")
+    parser.add_argument("--rate-client", type=int,
+                        help="bytes/sec limit of each client address.")
+    parser.add_argument("--rate-dest", type=int,
+                        help="bytes/sec limit of each destination host.")
+    parser.add_argument("--max-client-sessions", type=int,
+                        help="concurrent sessions allowed per client address.")
+    parser.add_argument("--max-client-rate", type=float,
+                        help="new connections/sec allowed per client address.")
+    parser.add_argument("--priority", type=str, default="normal",
+                        help="relay priority of this listener: interactive, normal or bulk.")
+    parser.add_argument("--route", type=str, action="append",
+                        help="destination rule, e.g. '*:22=priority:interactive'.")
+    parser.add_argument("--sockopts", type=str,
+                        help="socket options of the listener and accepted connections: "
+                             "interactive, bulk or e.g. 'nodelay,keepalive=60:10:5,rcvbuf=262144'.")
+    parser.add_argument("--upstream-sockopts", type=str,
+                        help="socket options of upstream connections, routes may override "
+                             "them with 'sockopts:PROFILE'.")
+    parser.add_argument("--shed-target", type=float,
+                        help="shed new connections when the queue wait stays above this "
+                             "many seconds, e.g. 0.1 (off by default).")
+    parser.add_argument("--shed-interval", type=float, default=1.0,
+                        help="seconds the queue wait has to stay above --shed-target.")
+    parser.add_argument("--bind-host", type=str,
+                        help="address socks5 BIND listens on and reports, "
+                             "the address the client connected to by default.")
+    parser.add_argument("--bind-ports", type=str,
+                        help="port range for socks5 BIND, e.g. 40000-40099, any free port by default.")
+    parser.add_argument("--bind-timeout", type=float, default=60,
+                        help="seconds a socks5 BIND waits for the inbound connection.")
+    parser.add_argument("--auth-file", type=str,
+                        help="require username/password from this credential file "
+                             "(see 'localforward passwd').")
+    parser.add_argument("--auth-cache-size", type=int, default=1024,
+                        help="recently verified logins kept to skip the slow hash.")
+    parser.add_argument("--auth-cache-ttl", type=int, default=300,
+                        help="seconds a verified login stays cached.")
+    parser.add_argument("--restart-deadline", type=float, default=300,
+                        help="seconds the old process keeps relaying after a graceful "
+                             "restart (SIGUSR2).")
+    parser.add_argument("--control", type=str,
+                        help="unix socket path for local control (localforward top).")
+    parser.add_argument("--trace-file", type=str,
+                        help="where the flight recorder is dumped on SIGUSR1.")
+    parser.add_argument("--capture", type=str,
+                        help="capture traffic into this ring file.")
+    parser.add_argument("--capture-size", type=int, default=64,
+                        help="size of the capture ring in MB.")
+    parser.add_argument("--capture-dest", type=str, action="append",
+                        help="only capture these destinations (glob or cidr).")
+    parser.add_argument("--capture-client", type=str, action="append",
+                        help="only capture these clients (glob or cidr).")
+    parser.add_argument("--capture-sample", type=float, default=1.0,
+                        help="fraction of the matching sessions captured.")
 
     cmd_options = parser.parse_args()
 
+    remote_addr = (cmd_options.rhost, cmd_options.rport)
+    if cmd_options.rhost and cmd_options.rhost.startswith("unix:"):
+        remote_addr = parse_addr(cmd_options.rhost)
+
     options = {
         "timeout": cmd_options.timeout,
+        "idle_timeout": cmd_options.idle_timeout,
+        "max_lifetime": cmd_options.max_lifetime,
         "remote_host": cmd_options.rhost,
         "remote_port": cmd_options.rport,
-        "remote_addr": (cmd_options.rhost, cmd_options.rport),
+        "remote_addr": remote_addr,
+        "trace_file": cmd_options.trace_file,
+        "control": cmd_options.control,
+        "priority": cmd_options.priority,
+        "routes": RouteTable.parse(cmd_options.route),
+        "tunnel_compress": cmd_options.tunnel_compress,
+        "table": cmd_options.table,
+        "sockopts": cmd_options.sockopts,
+        "upstream_sockopts": cmd_options.upstream_sockopts,
+        "shed_interval": cmd_options.shed_interval,
+        "bind_host": cmd_options.bind_host,
+        "bind_ports": parse_port_range(cmd_options.bind_ports) if cmd_options.bind_ports else None,
+        "bind_timeout": cmd_options.bind_timeout,
+        "restart_deadline": cmd_options.restart_deadline,
     }
+    if cmd_options.shed_target:
+        options["shed_target"] = cmd_options.shed_target
+    port = cmd_options.port
+    if port is None and not cmd_options.table:
+        port = 8010
+    if cmd_options.tunnel:
+        username, password = None, None
+        if cmd_options.tunnel_auth:
+            username, _, password = cmd_options.tunnel_auth.partition(":")
+        options["tunnel"] = TunnelClient(parse_addr(cmd_options.tunnel),
+                                         connections=cmd_options.tunnel_connections,
+                                         compress=cmd_options.tunnel_compress,
+                                         timeout=cmd_options.timeout,
+                                         username=username, password=password)
 
-    ForwordServer(host=cmd_options.host, port=cmd_options.port,
-                  size=cmd_options.size, type=cmd_options.type,
-                  options=options).serve()
+    server = ForwordServer(host=cmd_options.host, port=port,
+                           size=cmd_options.size, type=cmd_options.type,
+                           options=options)
+    if cmd_options.max_client_sessions or cmd_options.max_client_rate:
+        server.set_client_quota(max_sessions=cmd_options.max_client_sessions,
+                                rate=cmd_options.max_client_rate)
+    for scope in ("global", "client", "dest"):
+        rate = getattr(cmd_options, "rate_" + scope)
+        if rate:
+            server.set_rate_limit(scope, rate)
+    if cmd_options.auth_file:
+        server.set_authenticator(Authenticator(CredentialFile(cmd_options.auth_file),
+                                               cache_size=cmd_options.auth_cache_size,
+                                               ttl=cmd_options.auth_cache_ttl))
+    elif cmd_options.type == "tunnel-server":
+        logger.warn("tunnel-server without --auth-file, any client may open any destination")
+    if cmd_options.capture:
+        server.set_capture(Capture(
+            cmd_options.capture, size=cmd_options.capture_size * 1024 * 1024,
+            capture_filter=CaptureFilter(dest=cmd_options.capture_dest,
+                                         client=cmd_options.capture_client,
+                                         sample=cmd_options.capture_sample)))
+    server.serve()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+SOCKS5 client.
+
+The greeting, the username/password sub-negotiation and the CONNECT request
+go out in one write and the replies are read back in order, so a tunnel
+costs one round trip instead of two (three with auth):
+
+    sock = client.connect(("127.0.0.1", 1080), "example.com", 443)
+    reader, writer = await client.open_connection(("127.0.0.1", 1080), "example.com", 443)
+
+`ConnectionPool` and `AsyncConnectionPool` keep tunnels the caller gave back
+after a keep-alive exchange, keyed by destination, and hand them out again
+instead of opening new ones:
+
+    pool = client.ConnectionPool(("127.0.0.1", 1080))
+    with pool.connection("example.com", 80) as sock:
+        ...
+"""
+import time
+import socket
+import struct
+import asyncio
+import threading
+import contextlib
+from collections import deque
+
+from . import outils
+from .address import parse_addr, is_unix
+from .sessions.s5 import (Sock5Request, VER, CMD_CONNECT, METHOD_NO_AUTH, METHOD_USERPASS,
+                          ATYP_IPV4, ATYP_DDMAIN, ATYP_IPv6, REP_SUCCEEDED)
+
+logger = outils.get_logger("localforward")
+
+REP_MESSAGES = {
+    1: "general SOCKS server failure",
+    2: "connection not allowed by ruleset",
+    3: "network unreachable",
+    4: "host unreachable",
+    5: "connection refused",
+    6: "TTL expired",
+    7: "command not supported",
+    8: "address type not supported",
+}
+
+
+class Socks5Error(ConnectionError):
+    """the proxy refused the handshake, rep is the reply code if it got that far"""
+
+    def __init__(self, message, rep=None):
+        ConnectionError.__init__(self, message)
+        self.rep = rep
+
+
+def handshake_bytes(host, port, username=None, password=None, cmd=CMD_CONNECT) -> bytes:
+    """greeting, auth and request in one piece"""
+    if username is None:
+        data = bytes([VER, 1, METHOD_NO_AUTH])
+    else:
+        user, pw = username.encode(), (password or "").encode()
+        data = bytes([VER, 1, METHOD_USERPASS, 1, len(user)]) + user + bytes([len(pw)]) + pw
+    return data + Sock5Request.to(host, port, cmd).to_bytes()
+
+
+def _check_method(raw, username):
+    want = METHOD_NO_AUTH if username is None else METHOD_USERPASS
+    if raw[0] != VER or raw[1] != want:
+        raise Socks5Error("proxy does not accept auth method {}: {!r}".format(want, raw))
+
+
+def _check_auth(raw):
+    if raw[1] != 0:
+        raise Socks5Error("proxy authentication failed")
+
+
+def _check_reply(head):
+    if head[0] != VER:
+        raise Socks5Error("not a socks5 reply: {!r}".format(head))
+    if head[1] != REP_SUCCEEDED:
+        raise Socks5Error(REP_MESSAGES.get(head[1], "reply {}".format(head[1])), head[1])
+
+
+def _addr_length(atyp, first):
+    """bytes of BND.ADDR + BND.PORT after the atyp, first is the next byte"""
+    if atyp == ATYP_IPV4:
+        return 4 + 2
+    if atyp == ATYP_IPv6:
+        return 16 + 2
+    if atyp == ATYP_DDMAIN:
+        return 1 + first + 2
+    raise Socks5Error("bad address type in reply: {}".format(atyp))
+
+
+def _bound(atyp, raw):
+    if atyp == ATYP_DDMAIN:
+        host = raw[1:-2].decode("utf-8", "replace")
+    else:
+        host = socket.inet_ntop(socket.AF_INET if atyp == ATYP_IPV4 else socket.AF_INET6, raw[:-2])
+    return host, struct.unpack("!H", raw[-2:])[0]
+
+
+def _recv_exact(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise Socks5Error("proxy closed the connection during the handshake")
+        data += chunk
+    return data
+
+
+def _proxy_addr(proxy):
+    return parse_addr(proxy) if isinstance(proxy, str) else tuple(proxy)
+
+
+def _open_proxy(proxy, timeout):
+    addr = _proxy_addr(proxy)
+    if is_unix(addr):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(addr)
+        return sock
+    sock = socket.create_connection(addr, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def connect(proxy, host, port, username=None, password=None, timeout=None) -> socket.socket:
+    """
+    a socket tunnelled to host:port through the socks5 proxy, given as
+    (host, port) or "host:port"/"unix:/path"
+    """
+    return connect_ex(proxy, host, port, username, password, timeout)[0]
+
+
+def connect_ex(proxy, host, port, username=None, password=None, timeout=None):
+    """(socket, bound (host, port) reported by the proxy)"""
+    sock = _open_proxy(proxy, timeout)
+    try:
+        sock.sendall(handshake_bytes(host, port, username, password))
+        _check_method(_recv_exact(sock, 2), username)
+        if username is not None:
+            _check_auth(_recv_exact(sock, 2))
+        head = _recv_exact(sock, 5)
+        _check_reply(head)
+        rest = head[4:] + _recv_exact(sock, _addr_length(head[3], head[4]) - 1)
+        sock.settimeout(None)
+        return sock, _bound(head[3], rest)
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def open_connection(proxy, host, port, username=None, password=None, timeout=None):
+    """asyncio (reader, writer) tunnelled to host:port through the proxy"""
+    addr = _proxy_addr(proxy)
+    if is_unix(addr):
+        opening = asyncio.open_unix_connection(addr)
+    else:
+        opening = asyncio.open_connection(addr[0], addr[1])
+    reader, writer = await asyncio.wait_for(opening, timeout)
+    try:
+        await asyncio.wait_for(_handshake(reader, writer, host, port, username, password), timeout)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def _handshake(reader, writer, host, port, username, password):
+    writer.write(handshake_bytes(host, port, username, password))
+    await writer.drain()
+    try:
+        _check_method(await reader.readexactly(2), username)
+        if username is not None:
+            _check_auth(await reader.readexactly(2))
+        head = await reader.readexactly(5)
+        _check_reply(head)
+        await reader.readexactly(_addr_length(head[3], head[4]) - 1)
+    except asyncio.IncompleteReadError:
+        raise Socks5Error("proxy closed the connection during the handshake")
+
+
+def _is_alive(sock):
+    """
+    an idle tunnel is usable while there is nothing to read: data would be
+    a stray response, b"" the other end closing it
+    """
+    try:
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return True
+        finally:
+            sock.setblocking(True)
+    except OSError:
+        pass
+    return False
+
+
+class ConnectionPool(object):
+    """"""
+
+    def __init__(self, proxy, username=None, password=None, max_idle=8, idle_timeout=60,
+                 timeout=None):
+        self.proxy = proxy
+        self.username = username
+        self.password = password
+        # idle tunnels kept per destination
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # (host, port) -> deque of (socket, released at)
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def acquire(self, host, port) -> socket.socket:
+        """an idle tunnel to host:port if one is still good, a new one otherwise"""
+        key = (host, port)
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                sock, released_at = idle.pop()
+            if now - released_at < self.idle_timeout and _is_alive(sock):
+                self.reused += 1
+                return sock
+            sock.close()
+
+        sock = connect(self.proxy, host, port, self.username, self.password, self.timeout)
+        self.opened += 1
+        return sock
+
+    def release(self, sock, host, port, reusable=True):
+        """
+        give a tunnel back. only reusable after a complete keep-alive
+        exchange, anything left unread would end up in the next response.
+        """
+        if not reusable:
+            sock.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault((host, port), deque())
+            idle.append((sock, time.monotonic()))
+            while len(idle) > self.max_idle:
+                idle.popleft()[0].close()
+
+    @contextlib.contextmanager
+    def connection(self, host, port):
+        """
+        a tunnel for one exchange, put back unless the block raises, call
+        release(sock, host, port, False) inside to drop it instead
+        """
+        sock = self.acquire(host, port)
+        try:
+            yield sock
+        except BaseException:
+            sock.close()
+            raise
+        if sock.fileno() != -1:
+            self.release(sock, host, port)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for sock, _ in conns:
+                sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _PooledConnection(object):
+    """a tunnel of an AsyncConnectionPool for one exchange, as ConnectionPool.connection"""
+
+    def __init__(self, pool, host, port):
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.pool.acquire(self.host, self.port)
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.conn[1].close()
+        else:
+            self.pool.release(self.conn, self.host, self.port)
+
+
+class AsyncConnectionPool(object):
+    """ConnectionPool for asyncio, holding (reader, writer) pairs"""
+
+    def __init__(self, proxy, username=None, password=None, max_idle=8, idle_timeout=60,
+                 timeout=None):
+        self.proxy = proxy
+        self.username = username
+        self.password = password
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self.opened = 0
+        self.reused = 0
+
+    async def acquire(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer, released_at = idle.pop()
+            if (now - released_at < self.idle_timeout and not reader.at_eof()
+                    and not writer.transport.is_closing()):
+                self.reused += 1
+                return reader, writer
+            writer.close()
+
+        conn = await open_connection(self.proxy, host, port, self.username, self.password,
+                                     self.timeout)
+        self.opened += 1
+        return conn
+
+    def release(self, conn, host, port, reusable=True):
+        reader, writer = conn
+        if not reusable or writer.transport.is_closing():
+            writer.close()
+            return
+        idle = self._idle.setdefault((host, port), deque())
+        idle.append((reader, writer, time.monotonic()))
+        while len(idle) > self.max_idle:
+            idle.popleft()[1].close()
+
+    def connection(self, host, port):
+        """`async with pool.connection(host, port) as (reader, writer)`"""
+        return _PooledConnection(self, host, port)
+
+    async def close(self):
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, writer, _ in conns:
+                writer.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
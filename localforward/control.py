@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Local control socket.
+
+A unix socket accepting one JSON command per line, {"cmd": "stats", ...},
+answered with one JSON line {"ok": true, "result": ...}. Used by
+`localforward top` and other local tooling. Every connection is served on
+its own thread and may stay open for as long as the client likes, so an
+attached `top` does not hold up other commands.
+"""
+import os
+import json
+import socket
+import threading
+import traceback
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+
+class ControlServer(object):
+    """"""
+
+    def __init__(self, path, commands: dict):
+        self.path = path
+        self.commands = commands
+        self._sock = None
+        self._thread = None
+        self._conns = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._sock.listen(8)
+
+        self._thread = threading.Thread(target=self._serve, name="control")
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info("control socket on {}".format(self.path))
+
+    def stop(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        with self._lock:
+            conns = list(self._conns)
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _serve(self):
+        while self._sock is not None:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break
+            with self._lock:
+                self._conns.add(conn)
+            thread = threading.Thread(target=self._serve_conn, args=(conn,), name="control-conn")
+            thread.daemon = True
+            thread.start()
+
+    def _serve_conn(self, conn):
+        try:
+            self._handle(conn)
+        except Exception:
+            logger.warn("control connection error: {}".format(traceback.format_exc()))
+        finally:
+            with self._lock:
+                self._conns.discard(conn)
+            conn.close()
+
+    def _handle(self, conn):
+        f = conn.makefile("rwb")
+        for line in f:
+            try:
+                req = json.loads(line.decode())
+                handler = self.commands[req.pop("cmd")]
+                rsp = {"ok": True, "result": handler(**req)}
+            except Exception as e:
+                rsp = {"ok": False, "error": "{}: {}".format(type(e).__name__, e)}
+            f.write(json.dumps(rsp).encode() + b"\n")
+            f.flush()
+
+
+class ControlClient(object):
+    """"""
+
+    def __init__(self, path, timeout=5):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path)
+        self._f = self._sock.makefile("rwb")
+
+    def call(self, cmd, **kwargs):
+        kwargs["cmd"] = cmd
+        self._f.write(json.dumps(kwargs).encode() + b"\n")
+        self._f.flush()
+        line = self._f.readline()
+        if not line:
+            raise ConnectionError("control socket is closed")
+        rsp = json.loads(line.decode())
+        if not rsp["ok"]:
+            raise RuntimeError(rsp["error"])
+        return rsp["result"]
+
+    def close(self):
+        try:
+            self._f.close()
+        except OSError:
+            # the server went away with a request unsent
+            pass
+        self._sock.close()
@@ -1,24 +1,91 @@
 #!/usr/bin/env python3
 # coding:utf-8
+import os
+import stat
+import time
+import asyncio
+import functools
+import signal
 import socket
+import itertools
+import collections
+import tempfile
 import threading
 import traceback
-from select import kqueue, kevent, KQ_FILTER_READ
+from select import kqueue, kevent, KQ_FILTER_READ, KQ_EV_ADD, KQ_EV_DELETE
 from . import sessions
 from . import outils
 from . import pool
+from . import trace
+from . import stats
+from . import shaping
+from . import handoff
+from .quota import ClientQuota
+from .timers import TimerWheel
+from .relay import RelayEngine
+from .routes import RouteTable
+from .control import ControlServer
+from .address import parse_addr, format_addr, family_of, peer_credentials
+from .table import load_table
+from .sockopts import get_profile
+from .overload import QueueDelayShedder
 
 FORWORD_TYPE_RAW = 'raw'
 FORWORD_TYPE_SOCKS5 = 'socks5'
+FORWORD_TYPE_TUNNEL = 'tunnel-server'
+FORWORD_TYPE_HTTP = 'http'
+FORWORD_TYPE_AUTO = 'auto'
 
 _SessionCls = {
-    # FORWORD_TYPE_RAW: sessions.RawSession,
+    FORWORD_TYPE_RAW: sessions.RawSession,
     FORWORD_TYPE_SOCKS5: sessions.Sock5Session,
+    FORWORD_TYPE_TUNNEL: sessions.TunnelServerSession,
+    FORWORD_TYPE_HTTP: sessions.HttpProxySession,
+    FORWORD_TYPE_AUTO: sessions.SniffSession,
 }
 
 logger = outils.get_logger('localforward')
 
 
+def _unlink_stale(path):
+    """remove a unix socket file left behind, never a regular file"""
+    if path.startswith("\0"):
+        return
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class Listener(object):
+    """one listening socket, its session class and its own options"""
+
+    __slots__ = ("name", "host", "port", "type", "targets", "session_kls", "options", "sock")
+
+    def __init__(self, name, host, port, type, targets, session_kls, options):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.type = type
+        self.targets = targets
+        self.session_kls = session_kls
+        self.options = options
+        self.sock = None
+
+    @property
+    def unix_path(self):
+        return self.host if self.port is None else None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "listen": format_addr(self.unix_path or (self.host, self.port)),
+            "type": self.type,
+            "targets": [format_addr(target) for target in self.targets],
+        }
+
+
 class SessionPool(object):
 
     def __init__(self, backend=FORWORD_TYPE_SOCKS5, size=20, options={}):
@@ -27,30 +94,124 @@ class SessionPool(object):
         self._session_kls = _SessionCls[backend]
         self.options = options
         self.backend = backend
+        self._sid = itertools.count(1)
+        options.setdefault("engine", RelayEngine())
+        options.setdefault("routes", RouteTable())
+        options.setdefault("bind_counter", itertools.count())
+        # muxes of tunnel server sessions, they relay outside the engine
+        options.setdefault("tunnel_muxes", set())
 
-        self.pool = pool.Pool(size=20)
+        self.pool = pool.Pool(size=size, keep_results=False)
         self.pool.start()
+        options.setdefault("executor", self.pool.execute)
 
-    def new_session(self, conn: socket.socket, addr: tuple):
+    def new_session(self, conn: socket.socket, addr: tuple, accepted_at=None, listener=None):
         """"""
+        quota = self.options.get("quota")
+        ticket = None
+        if quota and conn.family != socket.AF_UNIX:
+            ticket = quota.acquire(addr[0])
+            if ticket is None:
+                logger.warn("connection from {}:{} is over quota".format(addr[0], addr[1]))
+                conn.close()
+                return
+
         logger.info("prepare to start session: {}".format(self.backend))
-        self.pool.execute(self.start_session, (conn, addr))
+        sid = next(self._sid)
+        recorder = self.options.get("recorder")
+        _trace = recorder.begin(sid, addr, accepted_at) if recorder else trace.NULL_TRACE
+        _trace.mark(trace.PHASE_ENQUEUE)
+        self.pool.execute(self.start_session, (conn, addr, sid, _trace, ticket, listener))
+
+    def start_session(self, conn, addr, sid=0, _trace=trace.NULL_TRACE, ticket=None, listener=None):
+        """
+        run the handshake on a pool thread. once connected the session is
+        handed to the relay engine and the thread is free again.
+        """
+        task = pool.current_task()
+        if task:
+            _trace.mark(trace.PHASE_PICKUP, task.picked_at)
+
+        finish = functools.partial(self.finish_session, conn, addr, sid, _trace, ticket)
+        kls = listener.session_kls if listener else self._session_kls
+        shedder = self.options.get("shedder")
+        if task and shedder and shedder.should_shed(task.picked_at - task.enqueued_at,
+                                                    queue_empty=not self.pool.queue_depth()):
+            self.shed_session(kls, conn, addr, task.picked_at - task.enqueued_at)
+            finish()
+            return
 
-    def start_session(self, conn, addr):
-        """"""
         logger.info("session from: {} is started".format(addr))
+        session = None
         try:
-            conn.settimeout(self.options.get("timeout", 10))
-            session = self._session_kls(conn, addr, self.options)
+            session = kls(conn, addr, listener.options if listener else self.options, sid, _trace)
+            session.on_finish = finish
             session.handle()
         except Exception:
             msg = traceback.format_exc()
             logger.warn("session from: {} met error: {}".format(
                 addr, msg
             ))
+            if self.options.get("stats"):
+                self.options["stats"].incr("sessions_failed")
         finally:
-            conn.close()
-            logger.info("session from: {} is finished".format(addr))
+            if session is None:
+                finish()
+            elif not session.detached:
+                session.close()
+
+    def shed_session(self, kls, conn, addr, delay):
+        logger.warn("shed connection from {} after {:.3f}s in queue".format(addr, delay))
+        if self.options.get("stats"):
+            self.options["stats"].incr("sessions_shed")
+        try:
+            kls.reject(conn)
+        except OSError:
+            pass
+
+    def finish_session(self, conn, addr, sid, _trace, ticket):
+        """"""
+        conn.close()
+        if ticket:
+            self.options["quota"].release(ticket)
+        if self.options.get("stats"):
+            self.options["stats"].close_session(sid)
+        recorder = self.options.get("recorder")
+        if recorder:
+            recorder.commit(_trace)
+        logger.info("session from: {} is finished".format(addr))
+
+    def stop(self, drain=True, timeout=None):
+        """
+        wait up to timeout seconds (forever when None) for the relayed
+        sessions to finish when drain, then close the rest and join the pool,
+        relay, tunnel, timer and shaper threads. sessions still queued for
+        the pool are closed without a handshake.
+        """
+        engine = self.options["engine"]
+        muxes = self.options["tunnel_muxes"]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while drain and (len(engine) or any(len(mux) for mux in list(muxes))
+                         or not self.pool.all_is_idle() or self.pool.queue_depth()):
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warn("{} sessions are still relayed, close them".format(len(engine)))
+                break
+            time.sleep(0.05)
+        # the pool first, handshakes finishing now still hand over to the engine
+        self.pool.stop(on_dropped=self._drop_task)
+        engine.stop(abort=True)
+        for mux in list(muxes):
+            mux.close()
+            mux.join()
+        for key in ("timers", "shaper"):
+            if self.options.get(key):
+                self.options[key].stop()
+
+    def _drop_task(self, task):
+        """a session the pool did not start before stopping"""
+        if task.func == self.start_session:
+            conn, addr, sid, _trace, ticket = task.args[:5]
+            self.finish_session(conn, addr, sid, _trace, ticket)
 
     def set_data_send_hook(self, callback):
         self.options['data_send'] = callback
@@ -58,6 +219,28 @@ class SessionPool(object):
     def set_data_recv_hook(self, callback):
         self.options['data_recv'] = callback
 
+    def set_capture(self, capture):
+        self.options['capture'] = capture
+
+    def set_recorder(self, recorder):
+        self.options['recorder'] = recorder
+
+    def stats(self):
+        snapshot = self.options["stats"].snapshot() if self.options.get("stats") else {}
+        snapshot["pool"] = {
+            "size": self.pool.size,
+            "busy": self.pool.busy_count(),
+            "queue": self.pool.queue_depth(),
+        }
+        snapshot["relay"] = {"sessions": len(self.options["engine"])}
+        if self.options.get("tunnel"):
+            snapshot["tunnel"] = self.options["tunnel"].stats()
+        if self.options.get("quota"):
+            snapshot["quota"] = self.options["quota"].snapshot()
+        if self.options.get("shedder"):
+            snapshot["shedder"] = self.options["shedder"].snapshot()
+        return snapshot
+
 
 class ForwordServer(object):
 
@@ -67,11 +250,40 @@ class ForwordServer(object):
 
         self.size = size
 
+        self.type = type
         self._sock_listener = None
+        self._listeners = {}
+        self._fds = {}
+        self._table = {}
+        self._lock = threading.Lock()
+        self._control = None
+        self._thread = None
+        # the thread running the accept loop, and set once it is over
+        self._loop_thread = None
+        self._done = threading.Event()
+        self._address = None
+        self._restarting = False
+        # listening sockets handed over by the process we replace
+        self._inherited = handoff.inherited_listeners()
         self._kq = kqueue()
+        # wakes the accept loop up when stopping
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._kq.control([kevent(self._wake_r.fileno(), KQ_FILTER_READ, KQ_EV_ADD)], 0)
         self.is_working = threading.Event()
 
-        self.session_pool = SessionPool(backend=type, options=options)
+        options = dict(options)
+        options.setdefault("stats", stats.Stats())
+        options.setdefault("shaper", shaping.Shaper())
+        options.setdefault("quota", ClientQuota())
+        options.setdefault("timers", TimerWheel())
+        if options.get("shed_target"):
+            options.setdefault("shedder", QueueDelayShedder(options["shed_target"],
+                                                            options.get("shed_interval", 1.0)))
+        self.session_pool = SessionPool(backend=type, size=size, options=options)
+        if "recorder" not in options:
+            self.set_recorder(trace.FlightRecorder(options.get("trace_size", 4096)))
+        if options.get("auth"):
+            self.set_authenticator(options["auth"])
 
     def set_data_send_hook(self, callback):
         self.session_pool.set_data_send_hook(callback)
@@ -79,52 +291,420 @@ class ForwordServer(object):
     def set_data_recv_hook(self, callback):
         self.session_pool.set_data_recv_hook(callback)
 
+    def set_capture(self, capture):
+        """capture.Capture instance, or None to stop capturing new sessions"""
+        self.session_pool.set_capture(capture)
+
+    def set_authenticator(self, authenticator):
+        """
+        auth.Authenticator required from new socks5/http clients, None to
+        accept clients without credentials again.
+        """
+        if authenticator is not None and authenticator.stats is None:
+            authenticator.stats = self.session_pool.options.get("stats")
+        self.session_pool.options["auth"] = authenticator
+
+    def set_recorder(self, recorder):
+        """trace.FlightRecorder instance, or None to disable session tracing"""
+        self.session_pool.set_recorder(recorder)
+
+    def dump_trace(self, path=None):
+        """write the flight recorder to path, returns the path written"""
+        recorder = self.session_pool.options.get("recorder")
+        if not recorder:
+            return None
+        path = path or self.session_pool.options.get("trace_file") or os.path.join(
+            tempfile.gettempdir(), "localforward-{}.trace".format(os.getpid()))
+        recorder.dump(path)
+        logger.info("flight recorder is dumped to {}".format(path))
+        return path
+
+    def stats(self):
+        """snapshot of counters, live sessions and pool usage"""
+        snapshot = self.session_pool.stats()
+        snapshot["forwards"] = len(self._listeners)
+        return snapshot
+
+    def set_rate_limit(self, scope, rate, burst=None, key=None):
+        """
+        bytes/sec relayed (both directions) for scope "global", "client" or
+        "dest". key picks one client address or destination host, None is the
+        default of the scope. takes effect on live sessions too.
+        """
+        self.session_pool.options["shaper"].set_limit(scope, rate, burst, key)
+
+    def clear_rate_limit(self, scope, key=None):
+        self.session_pool.options["shaper"].clear_limit(scope, key)
+
+    def rate_limits(self):
+        return self.session_pool.options["shaper"].limits()
+
+    def set_client_quota(self, max_sessions=None, rate=None, burst=None, cidr=None):
+        """
+        cap concurrent sessions and new connections/sec per source address, or
+        for a whole network when cidr is given. over-quota connections are
+        closed right after accept.
+        """
+        self.session_pool.options["quota"].set_limit(max_sessions, rate, burst, cidr)
+
+    def remove_client_quota(self, cidr=None):
+        self.session_pool.options["quota"].remove_limit(cidr)
+
+    def _start_control(self):
+        path = self.session_pool.options.get("control")
+        if not path:
+            return
+        self._control = ControlServer(path, {
+            "stats": self.stats,
+            "dump_trace": self.dump_trace,
+            "set_rate_limit": self.set_rate_limit,
+            "clear_rate_limit": self.clear_rate_limit,
+            "rate_limits": self.rate_limits,
+            "set_client_quota": self.set_client_quota,
+            "remove_client_quota": self.remove_client_quota,
+            "add_forward": self.add_forward,
+            "remove_forward": self.remove_forward,
+            "forwards": self.forwards,
+            "reload_table": self.reload_table,
+            "restart": self.restart_in_background,
+        })
+        self._control.start()
+
+    def _install_signal_handlers(self):
+        """
+        SIGUSR1 dumps the flight recorder, SIGHUP reloads the table and
+        SIGUSR2 restarts gracefully. only possible from the main thread
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_trace())
+        if hasattr(signal, "SIGHUP") and self.session_pool.options.get("table"):
+            signal.signal(signal.SIGHUP, lambda signum, frame: self._reload_quietly())
+        if hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR2, lambda signum, frame: self.restart_in_background())
+
+    def add_forward(self, host, port, type=FORWORD_TYPE_RAW, targets=(), name=None, options=None):
+        """
+        start listening on host:port, served by the shared engine and pool.
+        host may be "unix:/path" or "unix:@abstract" to listen on a unix
+        socket, port is ignored then. targets are (host, port) pairs or
+        "host:port"/"unix:/path" strings, used in turn by raw forwards.
+        options override the server options for these sessions only. returns
+        the name of the forward.
+        """
+        if type not in _SessionCls:
+            raise ValueError("unknown forward type: {}".format(type))
+        targets = [tuple(t) if isinstance(t, (tuple, list)) else parse_addr(t) for t in targets]
+        if host.startswith("unix:"):
+            host, port = parse_addr(host), None
+        if type == FORWORD_TYPE_RAW and not targets:
+            raise ValueError("raw forward {}:{} needs a target".format(host, port))
+
+        own = dict(options or {})
+        if targets:
+            own["remote_addr"] = targets[0]
+            own["targets"] = targets
+            own["target_counter"] = itertools.count()
+        if not name and port != 0:
+            name = format_addr(host if port is None else (host, port))
+        listener = Listener(name, host, port, type, targets, _SessionCls[type],
+                            collections.ChainMap(own, self.session_pool.options))
+
+        profile = get_profile(listener.options.get("sockopts"))
+        with self._lock:
+            if name in self._listeners:
+                raise ValueError("forward {} already exists".format(name))
+            sock = self._inherited.pop(name, None)
+            if sock is not None:
+                logger.info("adopt listener {} from the previous process".format(name))
+            else:
+                sock = self._bind_listener(host, port, profile)
+            # another process may accept on it too while handing over
+            sock.setblocking(False)
+            if port == 0:
+                # an ephemeral port, known now
+                listener.port = port = sock.getsockname()[1]
+                listener.name = name = name or format_addr((host, port))
+            listener.sock = sock
+            self._listeners[name] = listener
+            self._fds[sock.fileno()] = listener
+            self._kq.control([kevent(sock.fileno(), KQ_FILTER_READ, KQ_EV_ADD)], 0)
+
+        logger.info("listen on {} ({}) with backlog:{}".format(name, type, self.size))
+        return name
+
+    def _bind_listener(self, host, port, profile):
+        if port is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            _unlink_stale(host)
+        else:
+            sock = socket.socket(family_of((host, port)))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if profile:
+            profile.apply_listener(sock)
+        try:
+            sock.bind(host if port is None else (host, port))
+            sock.listen(self.size)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def remove_forward(self, name, unlink=True):
+        """
+        stop accepting on a forward, its live sessions carry on. unlink=False
+        leaves the socket file of a unix listener, e.g. when handing it over.
+        """
+        with self._lock:
+            listener = self._listeners.pop(name, None)
+            if listener is None:
+                return False
+            self._fds.pop(listener.sock.fileno(), None)
+            try:
+                self._kq.control([kevent(listener.sock.fileno(), KQ_FILTER_READ, KQ_EV_DELETE)], 0)
+            except OSError:
+                pass
+            listener.sock.close()
+            if unlink and listener.unix_path and not listener.unix_path.startswith("\0"):
+                _unlink_stale(listener.unix_path)
+        self._table.pop(name, None)
+        logger.info("forward {} is removed".format(name))
+        return True
+
+    def forwards(self):
+        with self._lock:
+            return [listener.to_dict() for listener in self._listeners.values()]
+
+    def reload_table(self, path=None):
+        """
+        bring the forwards of the table file in line with it: new lines are
+        added, missing ones removed, changed ones restarted. others are left
+        alone. returns (added, removed).
+        """
+        path = path or self.session_pool.options.get("table")
+        entries = {entry.name: entry for entry in load_table(path)}
+        removed = [name for name, entry in self._table.items()
+                   if name not in entries or entries[name].key() != entry.key()]
+        for name in removed:
+            self.remove_forward(name)
+
+        added = []
+        for name, entry in entries.items():
+            if name in self._table:
+                continue
+            try:
+                self.add_forward(entry.listen_host, entry.port, entry.type, entry.targets,
+                                 name=name, options=entry.options)
+            except Exception as e:
+                logger.warn("cannot add forward {}: {}".format(entry, e))
+                continue
+            self._table[name] = entry
+            added.append(name)
+        logger.info("table {} is loaded: {} added, {} removed".format(path, len(added), len(removed)))
+        return added, removed
+
+    def _reload_quietly(self):
+        try:
+            self.reload_table()
+        except Exception:
+            logger.warn("reload table error: {}".format(traceback.format_exc()))
+
+    def restart(self, command=None, deadline=None):
+        """
+        hand the listeners over to a new process started with command (this
+        one's command line by default), then stop accepting and let the live
+        sessions finish within deadline seconds. returns False, still
+        serving, when the new process did not come up.
+        """
+        options = self.session_pool.options
+        deadline = options.get("restart_deadline", 300) if deadline is None else deadline
+        with self._lock:
+            listeners = {name: listener.sock for name, listener in self._listeners.items()}
+        # the new process binds the control socket again
+        if self._control:
+            self._control.stop()
+            self._control = None
+
+        proc = handoff.spawn(listeners, command, options.get("restart_timeout", 30))
+        if proc is None:
+            self._start_control()
+            return False
+
+        for name in list(self._listeners):
+            self.remove_forward(name, unlink=False)
+        logger.info("process {} took over, drain sessions for up to {}s".format(proc.pid, deadline))
+        self.stop(drain=True, timeout=deadline)
+        return True
+
+    def restart_in_background(self):
+        """restart() from a thread of its own, the process lives on until it is done"""
+        if self._restarting:
+            return False
+        self._restarting = True
+        thread = threading.Thread(target=self._restart_quietly, name="restart")
+        thread.start()
+        return True
+
+    def _restart_quietly(self):
+        try:
+            self.restart()
+        except Exception:
+            logger.warn("restart error: {}".format(traceback.format_exc()))
+        finally:
+            self._restarting = False
+
     def serve(self, detach=False):
         """"""
+        self._prepare()
+        self._run()
+
+    def _prepare(self):
+        """bind the listeners, ready to accept once this returns"""
         logger.info("prepare to initialize listener")
         self._init_listener()
+        if self.session_pool.options.get("table"):
+            self.reload_table()
+        self._install_signal_handlers()
+        self._start_control()
+        self.is_working.set()
+        for name, sock in self._inherited.items():
+            logger.info("listener {} is not configured any more, close it".format(name))
+            sock.close()
+        self._inherited = {}
+        handoff.notify_ready()
 
+    def _run(self):
+        self._loop_thread = threading.current_thread()
         try:
             self._serve_forever()
         except:
             msg = traceback.format_exc()
             logger.error("error in ForwardServer: {}".format(msg))
         finally:
-            self._sock_listener.close()
+            self.is_working.clear()
+            for name in list(self._listeners):
+                self.remove_forward(name)
+            if self._control:
+                self._control.stop()
+            self._close_loop()
+            self._done.set()
+
+    def _close_loop(self):
+        self._kq.close()
+        self._wake_r.close()
+        self._wake_w.close()
 
     def _init_listener(self):
-        """"""
-        self._sock_listener = socket.socket()
-        self._sock_listener.bind((self.host, self.port))
-        self._sock_listener.listen(self.size)
-        logger.info("listen on {}:{} with backlog:{}".format(
-            self.host, self.port, self.size))
+        """the listener given to the constructor, none when port is None"""
+        if self.port is None:
+            return
+        options = self.session_pool.options
+        targets = options.get("targets")
+        if not targets and options.get("remote_addr") and options["remote_addr"][0]:
+            targets = [options["remote_addr"]]
+        options.setdefault("target_counter", itertools.count())
+        name = self.add_forward(self.host, self.port, self.type, targets or ())
+        listener = self._listeners[name]
+        # sessions of the main listener use the server options as they are
+        listener.options = self.session_pool.options
+        self._sock_listener = listener.sock
+        self.port = listener.port
+        self._address = listener.sock.getsockname()
 
     def _serve_forever(self):
         """"""
-        events = [
-            kevent(self._sock_listener.fileno(), KQ_FILTER_READ)
-        ]
-        self.is_working.set()
         while self.is_working.is_set():
-            for event in self._kq.control(events, 1, 1):
-                #assert isinstance(event, kevent)
-                if event.ident == self._sock_listener.fileno():
-                    new_conn, addr = self._sock_listener.accept()
-                    logger.info(
-                        "accept connection from {}:{}".format(addr[0], addr[1]))
-                    self.session_pool.new_session(new_conn, addr)
+            for event in self._kq.control(None, 64, 1):
+                listener = self._fds.get(event.ident)
+                if listener is None:
+                    if event.ident == self._wake_r.fileno():
+                        self._wake_r.recv(64)
+                    continue
+                try:
+                    new_conn, addr = listener.sock.accept()
+                except OSError:
+                    # removed meanwhile, or the client is gone already
+                    continue
+                accepted_at = time.monotonic()
+                if new_conn.family == socket.AF_UNIX:
+                    # unix clients are known by their pid, when the system tells
+                    cred = peer_credentials(new_conn)
+                    addr = ("unix", cred.pid or 0 if cred else 0)
+                logger.info(
+                    "accept connection from {}:{}".format(addr[0], addr[1]))
+                try:
+                    self.session_pool.new_session(new_conn, addr, accepted_at, listener)
+                except Exception:
+                    # one bad connection must not take the accept loop down
+                    logger.warn("drop connection from {}: {}".format(addr, traceback.format_exc()))
+                    new_conn.close()
 
     def start(self):
-        """"""
-        rh = threading.Thread(target=self.serve)
-        rh.daemon = True
-        rh.start()
+        """
+        bind in the calling thread, so connecting works and `address` is
+        right (with port 0 too) once this returns, then accept in the
+        background. returns the proxies dict for requests.
+        """
+        self._prepare()
+        self._thread = threading.Thread(target=self._run, name="forward-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.proxies
 
-        return {
-            "http": "socks5://{}:{}".format(self.host, self.port),
-            "https": "socks5://{}:{}".format(self.host, self.port),
-        }
+    def stop(self, drain=True, timeout=None):
+        """
+        stop accepting and close the listeners, then let the live sessions
+        finish (up to timeout seconds) when drain or close them right away,
+        and join every thread the server started.
+        """
+        self.is_working.clear()
+        try:
+            self._wake_w.send(b"\x00")
+        except OSError:
+            pass
+        loop = self._loop_thread
+        if loop is None:
+            # never served, nothing else closes the listeners
+            for name in list(self._listeners):
+                self.remove_forward(name)
+            self._close_loop()
+        elif loop is not threading.current_thread():
+            self._done.wait()
+        self._thread = None
+        self.session_pool.stop(drain, timeout)
+        tunnel = self.session_pool.options.get("tunnel")
+        if tunnel:
+            tunnel.close()
+        logger.info("forward server is stopped")
+
+    @property
+    def address(self):
+        """(host, port) the main listener is bound to, the path of a unix one"""
+        return self._address
+
+    @property
+    def proxies(self):
+        """proxies dict for requests, empty for a unix listener requests cannot use"""
+        if self.port is None or self.host.startswith("unix:"):
+            return {}
+        scheme = "http" if self.type == FORWORD_TYPE_HTTP else "socks5"
+        url = "{}://{}".format(scheme, format_addr((self.host, self.port)))
+        return {"http": url, "https": url}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop(timeout=self.session_pool.options.get("drain_timeout", 5))
+
+    async def __aenter__(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.start)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await asyncio.get_event_loop().run_in_executor(None, self.__exit__, exc_type, exc, tb)
 
 
 if __name__ == "__main__":
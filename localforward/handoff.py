@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Zero-downtime restart.
+
+The running server spawns a new process of itself with the listening sockets
+inherited (`pass_fds`), named in LOCALFORWARD_LISTEN_FDS as a JSON object of
+forward name -> [fd, family, type], plus the write end of a pipe in
+LOCALFORWARD_READY_FD. The new process adopts the sockets of the forwards it
+is configured with instead of binding them, and writes a byte to the pipe once
+it accepts. Only then the old process stops accepting; it keeps relaying its
+sessions until they are done or the deadline passes, then exits. Connections
+queued on the listeners in between are accepted by the new process, nothing
+is refused.
+
+    kill -USR2 <pid>        # or the "restart" control command
+"""
+import os
+import sys
+import json
+import time
+import select
+import socket
+import subprocess
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+LISTEN_FDS_ENV = "LOCALFORWARD_LISTEN_FDS"
+READY_FD_ENV = "LOCALFORWARD_READY_FD"
+
+
+def inherited_listeners() -> dict:
+    """forward name -> listening socket handed over by the old process"""
+    raw = os.environ.pop(LISTEN_FDS_ENV, None)
+    if not raw:
+        return {}
+    socks = {}
+    for name, entry in json.loads(raw).items():
+        try:
+            if isinstance(entry, int):
+                # handed over by an older version, let socket() guess
+                socks[name] = socket.socket(fileno=entry)
+            else:
+                # socket(fileno=) only detects the family from 3.7 on
+                fd, family, type_ = entry
+                socks[name] = socket.socket(family, type_, 0, fd)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warn("inherited listener {} ({}) is unusable: {}".format(name, entry, e))
+    return socks
+
+
+def notify_ready():
+    """tell the old process we are accepting, a no-op when not spawned by it"""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"\x01")
+    except OSError as e:
+        logger.warn("cannot notify the old process: {}".format(e))
+    finally:
+        try:
+            os.close(int(fd))
+        except OSError:
+            pass
+
+
+def _describe(sock) -> list:
+    """[fd, family, type] of sock for LISTEN_FDS_ENV"""
+    # before 3.7 sock.type may carry SOCK_NONBLOCK / SOCK_CLOEXEC
+    flags = getattr(socket, "SOCK_NONBLOCK", 0) | getattr(socket, "SOCK_CLOEXEC", 0)
+    return [sock.fileno(), int(sock.family), int(sock.type) & ~flags]
+
+
+def default_command():
+    return [sys.executable, "-c", "from localforward import cli; cli()"] + sys.argv[1:]
+
+
+def spawn(listeners: dict, command=None, timeout=30):
+    """
+    start the new process with listeners (name -> socket) and wait until it
+    accepts. returns the process, None if it exited or did not get ready in
+    time (it is killed then).
+    """
+    ready_r, ready_w = os.pipe()
+    fds = {name: _describe(sock) for name, sock in listeners.items()}
+    env = dict(os.environ)
+    env[LISTEN_FDS_ENV] = json.dumps(fds)
+    env[READY_FD_ENV] = str(ready_w)
+    try:
+        proc = subprocess.Popen(command or default_command(), env=env,
+                                pass_fds=[entry[0] for entry in fds.values()] + [ready_w])
+    except OSError:
+        os.close(ready_r)
+        os.close(ready_w)
+        raise
+    os.close(ready_w)
+
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            readable, _, _ = select.select([ready_r], [], [], min(left, 1))
+            if readable:
+                # a byte when ready, EOF when it died first
+                if os.read(ready_r, 1):
+                    logger.info("new process {} is accepting".format(proc.pid))
+                    return proc
+                break
+            if proc.poll() is not None:
+                break
+    finally:
+        os.close(ready_r)
+
+    logger.warn("new process {} did not get ready, keep serving".format(proc.pid))
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+    return None
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Incremental HTTP/1.x parsing for data hooks.
+
+`HttpStreamParser` follows one direction of a connection chunk by chunk.
+Only message heads are buffered; bodies are framed by Content-Length or
+chunked encoding and skipped by counting, or handed to `on_body` as
+memoryview slices of the original chunk. Keep-alive and pipelined messages
+are handled, CONNECT and upgrades switch the parser to pass-through.
+
+`HttpTap` wires a request and a response parser per session into the
+data_send/data_recv hooks:
+
+    tap = HttpTap(on_request=lambda session, head: print(head))
+    server.set_data_send_hook(tap.send_hook)
+    server.set_data_recv_hook(tap.recv_hook)
+"""
+from collections import deque
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+REQUEST = "request"
+RESPONSE = "response"
+
+MAX_HEAD_SIZE = 64 * 1024
+
+_ST_HEAD = 0
+_ST_BODY = 1
+_ST_CHUNK_SIZE = 2
+_ST_CHUNK_DATA = 3
+_ST_CHUNK_CRLF = 4
+_ST_TRAILER = 5
+_ST_UNTIL_EOF = 6
+_ST_PASSTHROUGH = 7
+
+
+class HttpParseError(Exception):
+    pass
+
+
+class HttpHead(object):
+    """"""
+
+    __slots__ = ("kind", "method", "target", "version", "status", "reason", "headers")
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.method = None
+        self.target = None
+        self.version = None
+        self.status = None
+        self.reason = None
+        self.headers = []
+
+    @classmethod
+    def parse(cls, kind, raw: bytes):
+        lines = raw.split(b"\r\n")
+        head = cls(kind)
+        try:
+            first = lines[0].decode("latin-1").split(" ", 2)
+            if kind == REQUEST:
+                head.method, head.target, head.version = first
+            else:
+                head.version, head.status = first[0], int(first[1])
+                head.reason = first[2] if len(first) > 2 else ""
+        except (ValueError, IndexError):
+            raise HttpParseError("invalid start line: {!r}".format(lines[0]))
+
+        if not head.version.startswith("HTTP/1."):
+            raise HttpParseError("not HTTP/1.x: {}".format(head.version))
+
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(b":")
+            if not sep:
+                raise HttpParseError("invalid header line: {!r}".format(line))
+            head.headers.append((name.strip().decode("latin-1"),
+                                 value.strip().decode("latin-1")))
+        return head
+
+    def get(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    @property
+    def keep_alive(self):
+        conn = (self.get("connection") or "").lower()
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in conn
+        return "close" not in conn
+
+    def __repr__(self):
+        if self.kind == REQUEST:
+            return "<http-req: {} {} {}>".format(self.method, self.target, self.version)
+        return "<http-rsp: {} {} {}>".format(self.version, self.status, self.reason)
+
+
+class HttpStreamParser(object):
+    """"""
+
+    def __init__(self, kind=REQUEST, on_head=None, on_body=None, on_complete=None,
+                 methods: deque = None):
+        self.kind = kind
+        self.on_head = on_head
+        self.on_body = on_body
+        self.on_complete = on_complete
+        # request methods seen on the other direction, needed to frame
+        # responses to HEAD and CONNECT.
+        self.methods = methods if methods is not None else deque()
+
+        self.state = _ST_HEAD
+        self.head = None
+        self._buf = bytearray()
+        self._remaining = 0
+
+    def feed(self, data):
+        """
+        consume one chunk, bytes or a memoryview, the chunk itself is never
+        modified. a memoryview is only copied if a head or a chunk line
+        starts in it, body bytes are counted or sliced.
+        """
+        state = self.state
+        if state == _ST_PASSTHROUGH:
+            return
+        if state == _ST_BODY and not self.on_body and len(data) < self._remaining:
+            # inside a body of known length, nothing to look at
+            self._remaining -= len(data)
+            return
+
+        view = memoryview(data)
+        # heads and chunk lines are searched in bytes
+        raw = data if isinstance(data, (bytes, bytearray)) else None
+        pos = 0
+        end = len(view)
+        while pos < end:
+            state = self.state
+            if state == _ST_PASSTHROUGH:
+                return
+            elif state == _ST_HEAD:
+                if raw is None:
+                    raw = bytes(view)
+                pos = self._feed_head(raw, pos)
+            elif state == _ST_BODY or state == _ST_CHUNK_DATA or state == _ST_UNTIL_EOF:
+                if state == _ST_UNTIL_EOF:
+                    n = end - pos
+                else:
+                    n = min(self._remaining, end - pos)
+                    self._remaining -= n
+                if self.on_body:
+                    self.on_body(self.head, view[pos:pos + n])
+                pos += n
+                if state == _ST_BODY and not self._remaining:
+                    self._message_complete()
+                elif state == _ST_CHUNK_DATA and not self._remaining:
+                    self.state = _ST_CHUNK_CRLF
+                    self._remaining = 2
+            elif state == _ST_CHUNK_CRLF:
+                n = min(self._remaining, end - pos)
+                self._remaining -= n
+                pos += n
+                if not self._remaining:
+                    self.state = _ST_CHUNK_SIZE
+            elif state == _ST_CHUNK_SIZE or state == _ST_TRAILER:
+                if raw is None:
+                    raw = bytes(view)
+                pos = self._feed_line(raw, pos)
+
+    def _feed_head(self, data, pos):
+        buf = self._buf
+        end = len(data)
+        if not buf:
+            # tolerate empty lines between messages
+            while pos < end and data[pos] in (13, 10):
+                pos += 1
+            if pos == end:
+                return pos
+            idx = data.find(b"\r\n\r\n", pos)
+            if idx >= 0:
+                return self._parse_head(data[pos:idx], idx + 4)
+        else:
+            # the terminator may straddle the previous chunk
+            tail = bytes(buf[-3:]) + data[pos:pos + 3]
+            idx = tail.find(b"\r\n\r\n")
+            if idx >= 0:
+                head_end = pos + idx + 4 - min(3, len(buf))
+                buf += data[pos:head_end]
+                raw = bytes(buf[:-4])
+                del buf[:]
+                return self._parse_head(raw, head_end)
+            idx = data.find(b"\r\n\r\n", pos)
+            if idx >= 0:
+                buf += data[pos:idx]
+                raw = bytes(buf)
+                del buf[:]
+                return self._parse_head(raw, idx + 4)
+
+        buf += data[pos:]
+        if len(buf) > MAX_HEAD_SIZE:
+            self._give_up("head is too large")
+        return end
+
+    def _parse_head(self, raw, pos):
+        try:
+            self.head = HttpHead.parse(self.kind, bytes(raw))
+        except HttpParseError as e:
+            self._give_up(str(e))
+            return pos
+
+        self._head_complete()
+        return pos
+
+    def _feed_line(self, data, pos):
+        buf = self._buf
+        idx = data.find(b"\n", pos)
+        if idx < 0:
+            buf += data[pos:]
+            if len(buf) > MAX_HEAD_SIZE:
+                self._give_up("chunk line is too large")
+            return len(data)
+
+        buf += data[pos:idx + 1]
+        line = bytes(buf).rstrip(b"\r\n")
+        del buf[:]
+
+        if self.state == _ST_CHUNK_SIZE:
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                self._give_up("invalid chunk size: {!r}".format(line))
+                return len(data)
+            if size:
+                self.state = _ST_CHUNK_DATA
+                self._remaining = size
+            else:
+                self.state = _ST_TRAILER
+        elif not line:
+            self._message_complete()
+        return idx + 1
+
+    def _head_complete(self):
+        head = self.head
+        method = None
+        if self.kind == REQUEST:
+            self.methods.append(head.method)
+        elif head.status >= 200 or head.status == 101:
+            method = self.methods.popleft() if self.methods else None
+
+        if self.on_head:
+            self.on_head(head)
+
+        te = (head.get("transfer-encoding") or "").lower()
+        cl = head.get("content-length")
+
+        if self.kind == REQUEST and head.method == "CONNECT":
+            self.state = _ST_PASSTHROUGH
+        elif self.kind == RESPONSE and (
+                head.status == 101 or (method == "CONNECT" and 200 <= head.status < 300)):
+            self.state = _ST_PASSTHROUGH
+        elif self.kind == RESPONSE and (
+                head.status < 200 or head.status in (204, 304) or method == "HEAD"):
+            self._message_complete()
+        elif te.endswith("chunked"):
+            self.state = _ST_CHUNK_SIZE
+        elif cl is not None:
+            try:
+                self._remaining = int(cl)
+            except ValueError:
+                self._give_up("invalid content-length: {}".format(cl))
+                return
+            if self._remaining:
+                self.state = _ST_BODY
+            else:
+                self._message_complete()
+        elif self.kind == RESPONSE:
+            self.state = _ST_UNTIL_EOF
+        else:
+            self._message_complete()
+
+    def _message_complete(self):
+        head = self.head
+        self.state = _ST_HEAD
+        self.head = None
+        if self.on_complete:
+            self.on_complete(head)
+
+    def _give_up(self, reason):
+        logger.warn("stop parsing http {}: {}".format(self.kind, reason))
+        self.state = _ST_PASSTHROUGH
+        del self._buf[:]
+
+
+class _TapHook(object):
+    """"""
+
+    takes_session = True
+    takes_view = True
+
+    def __init__(self, tap, kind):
+        self.tap = tap
+        self.kind = kind
+
+    def __call__(self, buff, conn, session):
+        self.tap.parser(session, self.kind).feed(buff)
+        return buff
+
+
+class HttpTap(object):
+    """
+    per-session request/response parsing on top of the data hooks.
+
+    callbacks are called as on_request(session, head), on_response(session, head)
+    and on_*_body(session, head, chunk) where chunk is a memoryview only valid
+    during the call.
+    """
+
+    def __init__(self, on_request=None, on_response=None,
+                 on_request_body=None, on_response_body=None):
+        self.on_request = on_request
+        self.on_response = on_response
+        self.on_request_body = on_request_body
+        self.on_response_body = on_response_body
+
+        self.send_hook = _TapHook(self, REQUEST)
+        self.recv_hook = _TapHook(self, RESPONSE)
+
+    def parser(self, session, kind):
+        """the parsers live in session.hook_state and go away with the session"""
+        if session.hook_state is None:
+            session.hook_state = {}
+        parsers = session.hook_state.get(self)
+        if parsers is None:
+            parsers = session.hook_state[self] = self._new_parsers(session)
+        return parsers[kind]
+
+    def _new_parsers(self, session):
+        def bind(callback):
+            if callback is None:
+                return None
+            return lambda *args: callback(session, *args)
+
+        methods = deque()
+        return {
+            REQUEST: HttpStreamParser(REQUEST, bind(self.on_request),
+                                      bind(self.on_request_body), methods=methods),
+            RESPONSE: HttpStreamParser(RESPONSE, bind(self.on_response),
+                                       bind(self.on_response_body), methods=methods),
+        }
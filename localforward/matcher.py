@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Multi-pattern matcher for data hooks.
+
+A `PatternSet` compiles a list of byte signatures into an Aho-Corasick
+automaton once. The compiled tables are never mutated afterwards, so one
+set can be shared by every session. Each session scans through its own
+`MatchStream`, which only holds the automaton state and the stream offset,
+so matches straddling two `recv` chunks are still reported.
+
+    patterns = PatternSet([b"password=", b"Authorization: "])
+
+    def on_match(session, offset, pattern):
+        ...
+
+    server.set_data_send_hook(MatchHook(patterns, on_match))
+"""
+import weakref
+from array import array
+from collections import deque
+
+
+class PatternSet(object):
+    """"""
+
+    def __init__(self, patterns):
+        self.patterns = [bytes(p) for p in patterns]
+        if not all(self.patterns):
+            raise ValueError("empty pattern is not allowed.")
+
+        self._delta = None
+        self._output = None
+        self._compile()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _compile(self):
+        """build trie, failure links and then a full transition table"""
+        goto = [{}]
+        output = [()]
+        for pid, pattern in enumerate(self.patterns):
+            state = 0
+            for b in pattern:
+                nxt = goto[state].get(b)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][b] = nxt
+                    goto.append({})
+                    output.append(())
+                state = nxt
+            output[state] += (pid,)
+
+        # delta[state * 256 + byte] -> next state, one lookup per byte
+        # whatever the number of patterns is.
+        delta = array("l", [0]) * (len(goto) * 256)
+        fail = [0] * len(goto)
+
+        queue = deque()
+        for b, nxt in goto[0].items():
+            delta[b] = nxt
+            queue.append(nxt)
+
+        while queue:
+            state = queue.popleft()
+            base = state << 8
+            fbase = fail[state] << 8
+            output[state] += output[fail[state]]
+            for b in range(256):
+                nxt = goto[state].get(b)
+                if nxt is None:
+                    delta[base | b] = delta[fbase | b]
+                else:
+                    fail[nxt] = delta[fbase | b]
+                    delta[base | b] = nxt
+                    queue.append(nxt)
+
+        self._delta = delta
+        self._output = output
+
+    def stream(self):
+        """create a new per-session scanner"""
+        return MatchStream(self)
+
+    def search(self, data: bytes):
+        """scan a single buffer, returns [(offset, pattern_id), ...]"""
+        return self.stream().feed(data)
+
+
+class MatchStream(object):
+    """"""
+
+    __slots__ = ("patternset", "state", "offset")
+
+    def __init__(self, patternset: PatternSet):
+        self.patternset = patternset
+        self.state = 0
+        self.offset = 0
+
+    def feed(self, data):
+        """
+        scan the next chunk, returns [(offset, pattern_id), ...] where offset
+        is the start of the match in stream coordinates.
+        """
+        delta = self.patternset._delta
+        output = self.patternset._output
+        patterns = self.patternset.patterns
+
+        matches = []
+        state = self.state
+        end = self.offset
+        for b in data:
+            state = delta[(state << 8) | b]
+            end += 1
+            if output[state]:
+                for pid in output[state]:
+                    matches.append((end - len(patterns[pid]), pid))
+
+        self.state = state
+        self.offset = end
+        return matches
+
+    def reset(self):
+        self.state = 0
+        self.offset = 0
+
+
+class MatchHook(object):
+    """
+    data hook scanning one direction of every session.
+
+    `on_match(session, offset, pattern)` is called for each match, the data
+    itself is forwarded untouched.
+    """
+
+    takes_session = True
+    takes_view = True
+
+    def __init__(self, patternset: PatternSet, on_match):
+        self.patternset = patternset
+        self.on_match = on_match
+        self._streams = weakref.WeakKeyDictionary()
+
+    def __call__(self, buff, conn, session):
+        stream = self._streams.get(session)
+        if stream is None:
+            stream = self._streams[session] = self.patternset.stream()
+
+        patterns = self.patternset.patterns
+        for offset, pid in stream.feed(buff):
+            self.on_match(session, offset, patterns[pid])
+        return buff
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Queue-delay based load shedding.
+
+Every connection waits in the pool queue before a worker picks it up. Like
+CoDel, the shedder watches the smallest wait seen during each interval: a
+queue that never drains below `target` within a whole interval is a
+standing queue, not a burst. While that is the case, connections that
+waited longer than `target` are shed; bursts are never shed. A queue that
+runs empty, or an idle gap longer than an interval, starts a new interval
+with nothing held against it. Shed connections are answered at once
+without a handshake, so workers go to connections whose clients are still
+there.
+
+It is off unless the server options have a `shed_target`.
+"""
+import time
+import threading
+
+
+class QueueDelayShedder(object):
+    """"""
+
+    def __init__(self, target=0.1, interval=1.0):
+        self.target = target
+        self.interval = interval
+        self.overloaded = False
+        self._min_delay = None
+        self._last_min = None
+        # the first interval starts with the first connection
+        self._interval_end = None
+        self._lock = threading.Lock()
+
+    def should_shed(self, delay, now=None, queue_empty=False) -> bool:
+        """delay is how long the task waited in the queue, queue_empty if none is left behind it"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._interval_end is None or now >= self._interval_end + self.interval:
+                # nothing was picked up for a whole interval, the old minimum says nothing
+                self._restart(now)
+            elif now >= self._interval_end:
+                self._last_min = self._min_delay
+                self.overloaded = self._min_delay is not None and self._min_delay > self.target
+                self._min_delay = None
+                self._interval_end = now + self.interval
+            if self._min_delay is None or delay < self._min_delay:
+                self._min_delay = delay
+
+            shed = self.overloaded and delay > self.target
+            if queue_empty:
+                # drained, no standing queue
+                self._restart(now)
+            return shed
+
+    def _restart(self, now):
+        self.overloaded = False
+        self._min_delay = None
+        self._interval_end = now + self.interval
+
+    def snapshot(self):
+        return {
+            "target": self.target,
+            "interval": self.interval,
+            "overloaded": self.overloaded,
+            "min_delay": self._last_min,
+        }
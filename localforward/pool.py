@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import time
 import uuid
 import unittest
 import threading
@@ -6,6 +7,13 @@ import traceback
 from threading import Thread, Event
 from queue import Queue, Empty
 
+_local = threading.local()
+
+
+def current_task():
+    """the _Task executed by the calling labor thread, or None"""
+    return getattr(_local, "task", None)
+
 
 class _Task(object):
 
@@ -17,6 +25,8 @@ class _Task(object):
         self.func = func
         self.args = args
         self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+        self.picked_at = None
 
 
 class _Result(object):
@@ -50,10 +60,15 @@ class _Labor(Thread):
         while self.labor_is_working:
             try:
                 _task = self.taskq.get(timeout=1)
+                if _task is None:
+                    # woken up by Pool.stop
+                    continue
+                _task.picked_at = time.monotonic()
                 self.is_executing_task.set()
             except Empty:
                 continue
 
+            _local.task = _task
             try:
                 # assert isinstance(_task, _Task)
                 result = _task.func(*_task.args, **_task.kwargs)
@@ -65,9 +80,11 @@ class _Labor(Thread):
                     trackinfo = "UNKNOW ERROR!"
                 result = None
 
-            self.resultq.put(_Result(
-                _task, result, trackinfo
-            ))
+            _local.task = None
+            if self.resultq is not None:
+                self.resultq.put(_Result(
+                    _task, result, trackinfo
+                ))
             self.is_executing_task.clear()
 
     def prepare_stop(self):
@@ -79,7 +96,7 @@ class _Labor(Thread):
 
 class Pool(object):
 
-    def __init__(self, size=20, _laborcls=_Labor, *args, **kwargs):
+    def __init__(self, size=20, _laborcls=_Labor, keep_results=True, *args, **kwargs):
         self.size = size
         self.mainthread = Thread(name="pool-main", target=self._main)
         self.mainthread.daemon = True
@@ -87,15 +104,16 @@ class Pool(object):
         self._working = False
         self._dispatcher_queue = Queue()
         self.task_queue = Queue()
-        self.result_queue = Queue()
+        # nobody reads the results of fire-and-forget pools, don't keep them
+        self.result_queue = Queue() if keep_results else None
         self._laborcls = _laborcls
 
     def start(self):
+        self._working = True
         [self._new_labor() for _ in range(self.size)]
         self.mainthread.start()
 
     def _main(self):
-        self._working = True
         while self._working:
             try:
                 _ret = self._dispatcher_queue.get(timeout=1)
@@ -110,10 +128,26 @@ class Pool(object):
         _t = _Task(func, args, kwargs, id)
         self._dispatcher_queue.put(_t)
 
-    def stop(self):
+    def stop(self, on_dropped=None):
+        """
+        join the dispatcher and the labors. queued tasks not picked up yet
+        are dropped, each passed to on_dropped(task) if given so it can
+        release what the task holds; running ones are waited for.
+        """
         self._working = False
+        self._dispatcher_queue.put(None)
         self.mainthread.join()
         [i.prepare_stop() for i in self._threads.values()]
+        for queue in (self.task_queue, self._dispatcher_queue):
+            while True:
+                try:
+                    _task = queue.get_nowait()
+                except Empty:
+                    break
+                if isinstance(_task, _Task) and on_dropped:
+                    on_dropped(_task)
+        # a None per labor wakes it from the queue instead of the 1s poll
+        [self.task_queue.put(None) for _ in self._threads]
         [i.stop() for i in self._threads.values()]
 
     def _new_labor(self):
@@ -126,6 +160,13 @@ class Pool(object):
     def is_working(self):
         return self._working
 
+    def busy_count(self):
+        return len([labor for labor in self._threads.values()
+                    if labor.is_executing_task.is_set()])
+
+    def queue_depth(self):
+        return self._dispatcher_queue.qsize() + self.task_queue.qsize()
+
     def all_is_idle(self):
         threads = [labor for labor in self._threads.values(
         ) if labor.is_executing_task.is_set()]
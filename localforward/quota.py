@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Per-client admission quotas.
+
+Limits are kept per source address (the default limit) and per configured
+network (e.g. "10.0.0.0/8", counted over the whole network). Each limit
+caps concurrent sessions and the rate of new connections. A lookup costs
+one dict access per distinct prefix length, so accept and close stay O(1)
+whatever the number of clients.
+"""
+import time
+import socket
+import ipaddress
+import threading
+from collections import Counter
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+_SWEEP_EVERY = 1024
+
+
+class _Limit(object):
+    """"""
+
+    __slots__ = ("max_sessions", "rate", "burst")
+
+    def __init__(self, max_sessions=None, rate=None, burst=None):
+        self.max_sessions = max_sessions
+        self.rate = rate
+        self.burst = burst or rate
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def _address(host):
+    """(bits, int) of an ipv4/ipv6 address, the %scope of link-local ones is dropped"""
+    try:
+        packed = socket.inet_pton(socket.AF_INET, host)
+    except OSError:
+        packed = socket.inet_pton(socket.AF_INET6, host.partition("%")[0])
+    return len(packed) * 8, int.from_bytes(packed, "big")
+
+
+class ClientQuota(object):
+    """"""
+
+    def __init__(self):
+        self._default = None
+        # (bits, prefixlen) -> {network int >> host bits: _Limit}
+        self._networks = {}
+        self._active = {}
+        # key -> [tokens, last refill]
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self.counters = Counter()
+
+    def set_limit(self, max_sessions=None, rate=None, burst=None, cidr=None):
+        """
+        limit concurrent sessions and new connections/sec. without cidr the
+        limit applies to every single source address, with cidr to the sum
+        of the network.
+        """
+        limit = _Limit(max_sessions, rate, burst)
+        with self._lock:
+            if cidr is None:
+                self._default = limit
+            else:
+                net = ipaddress.ip_network(cidr, strict=False)
+                bits = net.max_prefixlen
+                key = int(net.network_address) >> (bits - net.prefixlen)
+                self._networks.setdefault((bits, net.prefixlen), {})[key] = limit
+
+    def remove_limit(self, cidr=None):
+        with self._lock:
+            if cidr is None:
+                self._default = None
+                return
+            net = ipaddress.ip_network(cidr, strict=False)
+            bits = net.max_prefixlen
+            nets = self._networks.get((bits, net.prefixlen), {})
+            nets.pop(int(net.network_address) >> (bits - net.prefixlen), None)
+            if not nets:
+                self._networks.pop((bits, net.prefixlen), None)
+
+    def _limits(self, host):
+        bits, addr = _address(host)
+        found = []
+        if self._default:
+            found.append(((bits, bits, addr), self._default))
+        for (nbits, prefixlen), nets in self._networks.items():
+            if nbits != bits:
+                continue
+            key = addr >> (bits - prefixlen)
+            limit = nets.get(key)
+            if limit:
+                found.append(((bits, prefixlen, key), limit))
+        return found
+
+    def acquire(self, host):
+        """
+        returns a ticket to release on close, or None if over quota. never
+        raises, a source address that does not parse is admitted unlimited.
+        """
+        if self._default is None and not self._networks:
+            return ()
+        now = time.monotonic()
+        with self._lock:
+            try:
+                limits = self._limits(host)
+            except (OSError, TypeError, ValueError):
+                logger.warn("no quota for unknown client address: {!r}".format(host))
+                self.counters["unparsed"] += 1
+                return ()
+            for key, limit in limits:
+                if limit.max_sessions is not None and \
+                        self._active.get(key, 0) >= limit.max_sessions:
+                    self.counters["rejected_sessions"] += 1
+                    return None
+                if limit.rate and self._tokens(key, limit, now) < 1:
+                    self.counters["rejected_rate"] += 1
+                    return None
+
+            for key, limit in limits:
+                self._active[key] = self._active.get(key, 0) + 1
+                if limit.rate:
+                    self._buckets[key][0] -= 1
+
+            self.counters["admitted"] += 1
+            self._acquired += 1
+            if self._acquired % _SWEEP_EVERY == 0:
+                self._sweep(now)
+            return tuple(key for key, _ in limits)
+
+    def release(self, ticket):
+        if not ticket:
+            return
+        with self._lock:
+            for key in ticket:
+                count = self._active.get(key, 0) - 1
+                if count > 0:
+                    self._active[key] = count
+                else:
+                    self._active.pop(key, None)
+
+    def _tokens(self, key, limit, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [limit.burst, now]
+        else:
+            bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+        return bucket[0]
+
+    def _sweep(self, now):
+        """forget rate buckets of clients without sessions for a minute"""
+        for key, (tokens, last) in list(self._buckets.items()):
+            if key not in self._active and now - last > 60:
+                del self._buckets[key]
+
+    def snapshot(self, top=10):
+        with self._lock:
+            busiest = sorted(self._active.items(), key=lambda i: i[1], reverse=True)[:top]
+            return {
+                "counters": dict(self.counters),
+                "clients": len(self._active),
+                "busiest": [[self._format(key), count] for key, count in busiest],
+            }
+
+    @staticmethod
+    def _format(key):
+        bits, prefixlen, value = key
+        kls = ipaddress.IPv4Network if bits == 32 else ipaddress.IPv6Network
+        net = kls((value << (bits - prefixlen), prefixlen))
+        return str(net.network_address) if prefixlen == bits else str(net)
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Shared relay engine.
+
+Once a session is connected its two sockets are handed to the engine, which
+relays every session from one thread and one kqueue. Each turn walks the
+ready directions round-robin, class by class, and gives each a bounded
+budget of bytes and recv calls scaled by its priority class. A direction
+with data left after its budget goes to the back of the line, so a fast
+bulk upstream cannot hold the loop while small interactive flows wait.
+
+Writes are non-blocking: a partial send parks the rest, stops reading the
+source and waits for the destination to become writable again.
+
+EOF on one side ends only that direction: once what it read is written the
+half-close is passed on with shutdown(SHUT_WR) and the other direction goes
+on. The session is closed when both directions are done, or right away on
+an error.
+
+Each direction adapts its read size to what it sees: reads that fill the
+buffer double it up to chunk_size, mostly empty reads halve it, so
+interactive flows stay on small reads and bulk flows move to large ones.
+
+Idle sessions own no buffers. Reads go into one scratch buffer of the
+engine and only the bytes parked by a partial send are copied into a
+buffer borrowed from a shared pool, which gets it back once flushed.
+"""
+import socket
+import select
+import threading
+import traceback
+from collections import deque
+
+from . import outils
+from . import trace
+from .capture import DIR_SEND, DIR_RECV
+
+logger = outils.get_logger("localforward")
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_NORMAL = "normal"
+PRIORITY_BULK = "bulk"
+
+# served in this order each turn, with the budget scaled by the weight
+PRIORITY_WEIGHTS = (
+    (PRIORITY_INTERACTIVE, 2.0),
+    (PRIORITY_NORMAL, 1.0),
+    (PRIORITY_BULK, 0.5),
+)
+
+CHUNK_SIZE = 64 * 1024
+MIN_CHUNK = 2 * 1024
+# read size a direction starts with
+INITIAL_CHUNK = {
+    PRIORITY_INTERACTIVE: 4 * 1024,
+    PRIORITY_NORMAL: 16 * 1024,
+    PRIORITY_BULK: 64 * 1024,
+}
+TURN_BYTES = 64 * 1024
+TURN_CALLS = 8
+
+
+class BufferPool(object):
+    """fixed-size bytearrays lent out while data is in flight, engine thread only"""
+
+    def __init__(self, size=CHUNK_SIZE, keep=64):
+        self.size = size
+        self.keep = keep
+        self._free = []
+
+    def take(self):
+        return self._free.pop() if self._free else bytearray(self.size)
+
+    def give(self, buf):
+        if len(self._free) < self.keep:
+            self._free.append(buf)
+
+    def __len__(self):
+        return len(self._free)
+
+
+class _Pipe(object):
+    """one direction of a session"""
+
+    __slots__ = ("session", "src", "dst", "hook_key", "direction", "phase",
+                 "pending", "buffer", "chunk", "queued", "paused", "closed", "eof", "peer")
+
+    def __init__(self, session, src, dst, hook_key, direction, phase):
+        self.session = session
+        self.src = src
+        self.dst = dst
+        self.hook_key = hook_key
+        self.direction = direction
+        self.phase = phase
+        self.pending = None
+        self.buffer = None
+        self.chunk = INITIAL_CHUNK.get(session.priority, MIN_CHUNK)
+        self.queued = False
+        self.paused = False
+        self.closed = False
+        # the source sent EOF, nothing more to read
+        self.eof = False
+        self.peer = None
+
+
+class RelayEngine(object):
+    """"""
+
+    def __init__(self, turn_bytes=TURN_BYTES, turn_calls=TURN_CALLS, chunk_size=CHUNK_SIZE,
+                 min_chunk=MIN_CHUNK, paused_interval=0.02):
+        self.turn_bytes = turn_bytes
+        self.turn_calls = turn_calls
+        self.chunk_size = chunk_size
+        self.min_chunk = min(min_chunk, chunk_size)
+        self.paused_interval = paused_interval
+        self.buffers = BufferPool(chunk_size)
+        self._scratch = memoryview(bytearray(chunk_size))
+
+        self._kq = None
+        self._readers = {}
+        self._writers = {}
+        self._ready = {name: deque() for name, _ in PRIORITY_WEIGHTS}
+        self._paused = set()
+        self._sessions = set()
+
+        self._incoming = deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._thread = None
+        self._working = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def add(self, session):
+        """relay session.conn <-> session.upstream from now on"""
+        self._incoming.append(session)
+        self._ensure_thread()
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wake_w.send(b"\x00")
+        except BlockingIOError:
+            pass
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._kq = select.kqueue()
+                self._kq.control([select.kevent(self._wake_r.fileno(), select.KQ_FILTER_READ,
+                                                select.KQ_EV_ADD)], 0)
+                self._working = True
+                self._thread = threading.Thread(target=self._run, name="relay")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, abort=True):
+        """stop the engine thread, closing the sessions still relayed when abort"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._working = False
+        self._wakeup()
+        thread.join()
+        if abort:
+            for session in list(self._sessions):
+                self._close(session)
+        self._kq.close()
+
+    def _run(self):
+        while self._working:
+            try:
+                self._once()
+            except Exception:
+                logger.error("relay engine error: {}".format(traceback.format_exc()))
+
+    def _once(self):
+        if any(self._ready.values()):
+            timeout = 0
+        elif self._paused:
+            timeout = self.paused_interval
+        else:
+            timeout = None
+
+        for ev in self._kq.control(None, 256, timeout):
+            fd = ev.ident
+            if fd == self._wake_r.fileno():
+                self._drain_wakeup()
+            elif ev.filter == select.KQ_FILTER_READ:
+                pipe = self._readers.get(fd)
+                if pipe is not None:
+                    self._enqueue(pipe)
+            elif ev.filter == select.KQ_FILTER_WRITE:
+                pipe = self._writers.get(fd)
+                if pipe is not None:
+                    self._flush(pipe)
+
+        self._resume_paused()
+        self._turn()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._incoming:
+            self._register(self._incoming.popleft())
+
+    def _register(self, session):
+        conn, upstream = session.conn, session.upstream
+        try:
+            conn.setblocking(False)
+            upstream.setblocking(False)
+            up = _Pipe(session, conn, upstream, "data_send", DIR_SEND, trace.PHASE_FIRST_UP)
+            down = _Pipe(session, upstream, conn, "data_recv", DIR_RECV, trace.PHASE_FIRST_DOWN)
+            up.peer, down.peer = down, up
+            session.pipes = (up, down)
+            self._kq.control([select.kevent(p.src.fileno(), select.KQ_FILTER_READ, select.KQ_EV_ADD)
+                              for p in (up, down)], 0)
+        except OSError:
+            # closed before we got it, e.g. by a timer
+            session.close()
+            return
+        self._readers[conn.fileno()] = up
+        self._readers[upstream.fileno()] = down
+        self._sessions.add(session)
+
+    def _enqueue(self, pipe):
+        if not pipe.queued and not pipe.closed and not pipe.eof:
+            pipe.queued = True
+            self._ready[pipe.session.priority].append(pipe)
+
+    def _turn(self):
+        """one round-robin pass over everything ready at the start of the turn"""
+        for name, weight in PRIORITY_WEIGHTS:
+            ready = self._ready[name]
+            budget = int(self.turn_bytes * weight)
+            calls = max(1, int(self.turn_calls * weight))
+            for _ in range(len(ready)):
+                pipe = ready.popleft()
+                if pipe.closed:
+                    continue
+                more = False
+                try:
+                    more = self._pump(pipe, budget, calls)
+                except Exception:
+                    # a hook or the capture failed, don't leave the session hanging
+                    logger.warn("relay session #{} error: {}".format(
+                        pipe.session.sid, traceback.format_exc()))
+                    self._close(pipe.session)
+                finally:
+                    if more:
+                        ready.append(pipe)
+                    else:
+                        pipe.queued = False
+
+    def _pump(self, pipe, budget, calls):
+        """relay up to the budget, returns True if there may be more to read"""
+        session = pipe.session
+        flow = session.flow
+        used = 0
+        while calls > 0 and used < budget:
+            if pipe.pending is not None:
+                return False
+            size = min(pipe.chunk, self.chunk_size, budget - used)
+            if flow is not None:
+                size = flow.allowance(size)
+                if not size:
+                    self._pause(pipe)
+                    return False
+
+            try:
+                n = pipe.src.recv_into(self._scratch, size)
+            except BlockingIOError:
+                return False
+            except OSError:
+                self._close(session)
+                return False
+            calls -= 1
+
+            if not n:
+                self._finish(pipe)
+                return False
+            self._adapt(pipe, size, n)
+            if flow is not None:
+                flow.consume(n)
+
+            used += n
+            if not self._forward(pipe, self._scratch[:n]):
+                return False
+        return True
+
+    def _forward(self, pipe, buff):
+        """hooks, capture, accounting and the write, False if the pipe is blocked"""
+        session = pipe.session
+        session.trace.mark(pipe.phase)
+        idle = session.timers.get("idle")
+        if idle is not None:
+            idle.reset(session.idle_timeout)
+
+        if session.options.get(pipe.hook_key):
+            # copied for hooks unless they take views
+            buff = session.execute_callback(pipe.hook_key, session.upstream, buff)
+        if session.capture:
+            session.capture.record(pipe.direction, buff)
+        if pipe.direction == DIR_SEND:
+            session.stat.bytes_up += len(buff)
+        else:
+            session.stat.bytes_down += len(buff)
+
+        try:
+            sent = pipe.dst.send(buff)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._close(session)
+            return False
+
+        if sent < len(buff):
+            self._park(pipe, memoryview(buff)[sent:])
+            self._writers[pipe.dst.fileno()] = pipe
+            self._kq.control([
+                select.kevent(pipe.src.fileno(), select.KQ_FILTER_READ, select.KQ_EV_DISABLE),
+                select.kevent(pipe.dst.fileno(), select.KQ_FILTER_WRITE, select.KQ_EV_ADD),
+            ], 0)
+            return False
+        return True
+
+    def _adapt(self, pipe, size, n):
+        if n == size and size == pipe.chunk:
+            pipe.chunk = min(pipe.chunk * 2, self.chunk_size)
+        elif n < pipe.chunk // 4:
+            pipe.chunk = max(pipe.chunk // 2, self.min_chunk)
+
+    def _park(self, pipe, rest):
+        """keep what could not be sent, the scratch buffer is reused by the next read"""
+        if len(rest) <= self.buffers.size:
+            pipe.buffer = self.buffers.take()
+            pipe.buffer[:len(rest)] = rest
+            pipe.pending = memoryview(pipe.buffer)[:len(rest)]
+        else:
+            pipe.pending = memoryview(bytes(rest))
+
+    def _finish(self, pipe):
+        """the source is done, stop reading it and pass the half-close on"""
+        pipe.eof = True
+        self._paused.discard(pipe)
+        fd = pipe.src.fileno()
+        if self._readers.get(fd) is pipe:
+            del self._readers[fd]
+        self._kq.control([select.kevent(fd, select.KQ_FILTER_READ, select.KQ_EV_DELETE)], 0)
+        if pipe.pending is None:
+            self._half_close(pipe)
+
+    def _half_close(self, pipe):
+        """everything read from src is written, close the session once both ways are"""
+        try:
+            pipe.dst.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        peer = pipe.peer
+        if peer.eof and peer.pending is None:
+            self._close(pipe.session)
+
+    def _unpark(self, pipe):
+        pipe.pending = None
+        buf, pipe.buffer = pipe.buffer, None
+        if buf is not None:
+            self.buffers.give(buf)
+
+    def _flush(self, pipe):
+        try:
+            sent = pipe.dst.send(pipe.pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            self._close(pipe.session)
+            return
+
+        pipe.pending = pipe.pending[sent:]
+        if len(pipe.pending):
+            return
+        self._unpark(pipe)
+        del self._writers[pipe.dst.fileno()]
+        self._kq.control([
+            select.kevent(pipe.dst.fileno(), select.KQ_FILTER_WRITE, select.KQ_EV_DELETE),
+        ], 0)
+        if pipe.eof:
+            self._half_close(pipe)
+        elif not pipe.paused:
+            self._kq.control([
+                select.kevent(pipe.src.fileno(), select.KQ_FILTER_READ, select.KQ_EV_ENABLE),
+            ], 0)
+            # data may have piled up while we were blocked
+            self._enqueue(pipe)
+
+    def _pause(self, pipe):
+        pipe.paused = True
+        self._paused.add(pipe)
+        self._kq.control([
+            select.kevent(pipe.src.fileno(), select.KQ_FILTER_READ, select.KQ_EV_DISABLE),
+        ], 0)
+
+    def _resume_paused(self):
+        for pipe in list(self._paused):
+            if pipe.closed or pipe.eof:
+                self._paused.discard(pipe)
+            elif pipe.session.flow.allowance(1):
+                self._paused.discard(pipe)
+                pipe.paused = False
+                if pipe.pending is None:
+                    self._kq.control([
+                        select.kevent(pipe.src.fileno(), select.KQ_FILTER_READ, select.KQ_EV_ENABLE),
+                    ], 0)
+                    self._enqueue(pipe)
+
+    def _close(self, session):
+        if session not in self._sessions:
+            return
+        self._sessions.discard(session)
+        for pipe in session.pipes:
+            pipe.closed = True
+            self._unpark(pipe)
+            self._paused.discard(pipe)
+            for table, sock in ((self._readers, pipe.src), (self._writers, pipe.dst)):
+                try:
+                    fd = sock.fileno()
+                except OSError:
+                    continue
+                if table.get(fd) is pipe:
+                    del table[fd]
+        try:
+            session.close()
+        except Exception:
+            logger.warn("close session #{} error: {}".format(session.sid, traceback.format_exc()))
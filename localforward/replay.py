@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Replay recorded sessions as load.
+
+    localforward replay capture.ring --export sessions.jsonl
+    localforward replay sessions.jsonl --scale 10 --speed 4 --size 50
+
+A session script is one line of JSON: when the session started, where it
+went and what was sent each way when, sizes only unless payloads are kept:
+
+    {"start": 0.013, "dest": ["example.com", 443],
+     "events": [[0.0, "up", 517], [0.048, "down", 4096, "<base64>"], ...]}
+
+Scripts come from such a file or straight from a capture ring. They are
+replayed through a ForwordServer started in a child process, so it does not
+share the GIL with the load, and every destination is connected to one local
+stand-in backend playing the "down" side of the script. --scale replays
+each session that many times, --speed compresses time.
+
+The report has the client view (connect time, lag of each response behind
+its schedule, throughput) and the server's flight recorder summary, which
+shows how long sessions waited in the pool queue.
+"""
+import json
+import time
+import base64
+import random
+import socket
+import struct
+import asyncio
+import logging
+import argparse
+import functools
+import multiprocessing
+
+from . import outils
+from . import trace
+from .capture import CaptureReader, MAGIC as CAPTURE_MAGIC, KIND_OPEN, KIND_DATA, DIR_SEND
+
+logger = outils.get_logger("localforward")
+
+UP = "up"
+DOWN = "down"
+
+# sent by the client after CONNECT, the index of the script to the backend
+_PREAMBLE = struct.Struct("!I")
+
+
+class SessionScript(object):
+    """"""
+
+    __slots__ = ("start", "dest", "events")
+
+    def __init__(self, start, dest, events):
+        self.start = start
+        self.dest = tuple(dest)
+        # (seconds since the session started, UP/DOWN, size, payload or None)
+        self.events = events
+
+    @property
+    def bytes(self):
+        return sum(size for _, _, size, _ in self.events)
+
+    def to_dict(self, payloads=True):
+        events = []
+        for t, direction, size, data in self.events:
+            event = [round(t, 6), direction, size]
+            if payloads and data is not None:
+                event.append(base64.b64encode(data).decode())
+            events.append(event)
+        return {"start": round(self.start, 6), "dest": list(self.dest), "events": events}
+
+    @classmethod
+    def from_dict(cls, raw):
+        events = [(e[0], e[1], e[2], base64.b64decode(e[3]) if len(e) > 3 else None)
+                  for e in raw["events"]]
+        return cls(raw["start"], raw["dest"], events)
+
+
+def from_capture(reader: CaptureReader, payloads=False):
+    """scripts of the sessions in a capture ring whose opening is still in it"""
+    sessions = {}
+    for r in reader.records():
+        if r.kind == KIND_OPEN:
+            meta = json.loads(r.data.decode())
+            sessions[r.sid] = {"start": r.ts, "dest": (meta["host"], meta["dest"][1]),
+                               "events": []}
+            continue
+        item = sessions.get(r.sid)
+        if item is None or r.kind != KIND_DATA:
+            continue
+        direction = UP if r.direction == DIR_SEND else DOWN
+        events = item["events"]
+        # chunks larger than a slot come back as several records of one moment
+        if events and events[-1][0] == r.ts and events[-1][1] == direction:
+            events[-1][2] += len(r.data)
+            events[-1][3] += r.data
+        else:
+            events.append([r.ts, direction, len(r.data), r.data])
+
+    if not sessions:
+        return []
+    t0 = min(item["start"] for item in sessions.values())
+    return [SessionScript(item["start"] - t0, item["dest"],
+                          [(ts - item["start"], d, size, data if payloads else None)
+                           for ts, d, size, data in item["events"]])
+            for _, item in sorted(sessions.items(), key=lambda kv: kv[1]["start"])]
+
+
+def load_scripts(path, payloads=False):
+    """scripts from a capture ring or a file of scripts"""
+    with open(path, "rb") as f:
+        head = f.read(len(CAPTURE_MAGIC))
+    if head == CAPTURE_MAGIC:
+        return from_capture(CaptureReader(path), payloads)
+    with open(path) as f:
+        scripts = [SessionScript.from_dict(json.loads(line)) for line in f if line.strip()]
+    if not payloads:
+        for script in scripts:
+            script.events = [(t, d, size, None) for t, d, size, _ in script.events]
+    return scripts
+
+
+def save_scripts(scripts, path, payloads=False):
+    with open(path, "w") as f:
+        for script in scripts:
+            f.write(json.dumps(script.to_dict(payloads)) + "\n")
+    return len(scripts)
+
+
+def scale_scripts(scripts, scale=1, jitter=0.01):
+    """each session scale times, the copies starting up to jitter seconds apart"""
+    if scale <= 1:
+        return list(scripts)
+    rnd = random.Random(0)
+    scaled = [SessionScript(s.start + (rnd.uniform(0, jitter) if copy else 0), s.dest, s.events)
+              for s in scripts for copy in range(scale)]
+    scaled.sort(key=lambda s: s.start)
+    return scaled
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "-"
+    pick = [trace._percentile(values, p) * 1e3 for p in (50, 90, 99, 100)]
+    return "p50 {:.2f}  p90 {:.2f}  p99 {:.2f}  max {:.2f} ms".format(*pick)
+
+
+def _stand_in_connector(backend, addr, timeout):
+    """every destination is the stand-in backend"""
+    return socket.create_connection(backend, timeout)
+
+
+def _serve(pipe, backend, size, options):
+    """the server process: report the address, wait for the end, report the stats"""
+    from .core import ForwordServer
+
+    logger.setLevel(logging.WARNING)
+    options = dict(options, connector=functools.partial(_stand_in_connector, backend))
+    server = ForwordServer(port=0, size=size, options=options)
+    server.start()
+    pipe.send(server.address)
+    pipe.recv()
+    recorder = server.session_pool.options.get("recorder")
+    pipe.send((server.stats(), recorder.dumps() if recorder else None))
+    server.stop(drain=False)
+
+
+class Replay(object):
+    """"""
+
+    def __init__(self, scripts, proxy, speed=1.0, timeout=30):
+        self.scripts = scripts
+        self.proxy = proxy
+        self.speed = speed
+        self.timeout = timeout
+        self.connect_times = []
+        self.lags = []
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.finished = 0
+        self.errors = []
+        self.active = 0
+        self.peak = 0
+        # writers of the backend connections still being served
+        self._backends = set()
+
+    def _due(self, start, t):
+        return start + t / self.speed
+
+    async def _sleep_until(self, when):
+        delay = when - asyncio.get_event_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def backend(self, reader, writer):
+        """the destination side of a script"""
+        loop = asyncio.get_event_loop()
+        self._backends.add(writer)
+        try:
+            index, = _PREAMBLE.unpack(await reader.readexactly(_PREAMBLE.size))
+            start = loop.time()
+            for t, direction, size, data in self.scripts[index].events:
+                if direction == UP:
+                    await reader.readexactly(size)
+                else:
+                    await self._sleep_until(self._due(start, t))
+                    writer.write(data if data is not None else bytes(size))
+                    await writer.drain()
+            await reader.read()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._backends.discard(writer)
+            writer.close()
+
+    async def close_backends(self, timeout=5):
+        """drop what the stopped server left open and let the handlers finish"""
+        for writer in list(self._backends):
+            writer.close()
+        deadline = asyncio.get_event_loop().time() + timeout
+        while self._backends and asyncio.get_event_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def session(self, index, t0):
+        from . import client
+
+        loop = asyncio.get_event_loop()
+        script = self.scripts[index]
+        await self._sleep_until(self._due(t0, script.start))
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        begin = loop.time()
+        writer = None
+        try:
+            reader, writer = await client.open_connection(self.proxy, script.dest[0], script.dest[1],
+                                                          timeout=self.timeout)
+            start = loop.time()
+            self.connect_times.append(start - begin)
+            writer.write(_PREAMBLE.pack(index))
+            for t, direction, size, data in script.events:
+                due = self._due(start, t)
+                if direction == UP:
+                    await self._sleep_until(due)
+                    writer.write(data if data is not None else bytes(size))
+                    await writer.drain()
+                    self.bytes_up += size
+                else:
+                    await asyncio.wait_for(reader.readexactly(size), self.timeout)
+                    self.lags.append(max(loop.time() - due, 0.0))
+                    self.bytes_down += size
+            self.finished += 1
+        except Exception as e:
+            self.errors.append("{} {}:{}: {}".format(type(e).__name__, script.dest[0],
+                                                     script.dest[1], e))
+        finally:
+            self.active -= 1
+            if writer is not None:
+                writer.close()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        t0 = loop.time() + 0.1
+        started = time.monotonic()
+        await asyncio.gather(*[self.session(i, t0) for i in range(len(self.scripts))])
+        return time.monotonic() - started
+
+
+def replay(scripts, speed=1.0, size=20, options=None, timeout=30):
+    """replay scripts against a fresh server process, returns the report as a dict"""
+    ctx = multiprocessing.get_context()
+    # bound before the server process starts, served once it runs
+    backend_sock = socket.socket()
+    backend_sock.bind(("127.0.0.1", 0))
+    backend_sock.listen(1024)
+    backend_addr = backend_sock.getsockname()
+
+    parent, child = ctx.Pipe()
+    proc = ctx.Process(target=_serve, args=(child, backend_addr, size, options or {}))
+    proc.daemon = True
+    proc.start()
+    backend_sock_owned = True
+
+    loop = asyncio.new_event_loop()
+    runner = Replay(scripts, None, speed, timeout)
+    try:
+        backend = loop.run_until_complete(asyncio.start_server(runner.backend, sock=backend_sock))
+        backend_sock_owned = False
+        try:
+            if not parent.poll(30):
+                raise RuntimeError("server process did not come up")
+            runner.proxy = parent.recv()
+            elapsed = loop.run_until_complete(runner.run())
+            parent.send("stop")
+            server_stats, dump = parent.recv()
+        finally:
+            proc.join(10)
+            if proc.is_alive():
+                proc.terminate()
+        backend.close()
+        loop.run_until_complete(backend.wait_closed())
+        loop.run_until_complete(runner.close_backends())
+    finally:
+        if backend_sock_owned:
+            backend_sock.close()
+        loop.close()
+
+    moved = runner.bytes_up + runner.bytes_down
+    return {
+        "sessions": len(scripts),
+        "finished": runner.finished,
+        "failed": len(runner.errors),
+        "errors": runner.errors[:5],
+        "peak": runner.peak,
+        "elapsed": elapsed,
+        "bytes_up": runner.bytes_up,
+        "bytes_down": runner.bytes_down,
+        "throughput": moved / elapsed if elapsed else 0,
+        "session_rate": len(scripts) / elapsed if elapsed else 0,
+        "connect": _percentiles(runner.connect_times),
+        "lag": _percentiles(runner.lags),
+        "counters": server_stats.get("counters", {}),
+        "trace": trace.summarize(trace.load(dump), top=0) if dump else "",
+    }
+
+
+def main(argv):
+    """localforward replay SOURCE [--export FILE] [--scale N] [--speed X]"""
+    parser = argparse.ArgumentParser(prog="localforward replay")
+    parser.add_argument("source", help="a capture ring or a file of session scripts.")
+    parser.add_argument("--export", type=str,
+                        help="write the session scripts to this file instead of replaying.")
+    parser.add_argument("--payloads", action="store_true",
+                        help="keep the captured payloads, zeros of the same size otherwise.")
+    parser.add_argument("--limit", type=int, help="only the first N sessions.")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="replay every session this many times.")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="time compression, 4 replays an hour in 15 minutes.")
+    parser.add_argument("--size", type=int, default=20,
+                        help="--size (pool workers) of the server under test.")
+    parser.add_argument("--route", type=str, action="append",
+                        help="destination rule of the server under test, as for the server.")
+    parser.add_argument("--shed-target", type=float,
+                        help="--shed-target of the server under test, off by default.")
+    cmd_options = parser.parse_args(argv)
+
+    scripts = load_scripts(cmd_options.source, cmd_options.payloads)[:cmd_options.limit]
+    if cmd_options.export:
+        count = save_scripts(scripts, cmd_options.export, cmd_options.payloads)
+        print("{} sessions exported to {}".format(count, cmd_options.export))
+        return
+
+    from .routes import RouteTable
+    options = {"routes": RouteTable.parse(cmd_options.route), "idle_timeout": 0}
+    if cmd_options.shed_target:
+        options["shed_target"] = cmd_options.shed_target
+
+    scripts = scale_scripts(scripts, cmd_options.scale)
+    if not scripts:
+        print("no sessions to replay")
+        return
+    logger.setLevel(logging.WARNING)
+    result = replay(scripts, cmd_options.speed, cmd_options.size, options)
+    print("sessions:      {sessions} ({finished} finished, {failed} failed), "
+          "peak concurrency {peak}\n"
+          "elapsed:       {elapsed:.2f} s, {session_rate:.1f} sessions/s\n"
+          "throughput:    {0:.2f} MB/s ({bytes_up} bytes up, {bytes_down} down)\n"
+          "connect:       {connect}\n"
+          "response lag:  {lag}".format(result["throughput"] / 1e6, **result))
+    for error in result["errors"]:
+        print("  error: {}".format(error))
+    print("server:        {}".format(", ".join(
+        "{}={}".format(k, v) for k, v in sorted(result["counters"].items()))))
+    print("\n" + result["trace"])
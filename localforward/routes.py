@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Destination rules.
+
+A route matches a destination "host:port" glob and carries settings for the
+sessions going there, e.g. {"priority": "interactive"}. The first matching
+route wins.
+
+    routes = RouteTable()
+    routes.add("*:22", priority="interactive")
+    routes.add("*.cdn.example.com:*", priority="bulk")
+"""
+import fnmatch
+
+
+class Route(object):
+    """"""
+
+    __slots__ = ("host", "port", "attrs")
+
+    def __init__(self, pattern, attrs):
+        host, sep, port = pattern.rpartition(":")
+        if not sep:
+            host, port = pattern, "*"
+        self.host = host or "*"
+        self.port = port or "*"
+        self.attrs = attrs
+
+    def match(self, host, port):
+        if self.port != "*" and self.port != str(port):
+            return False
+        return fnmatch.fnmatch(str(host), self.host)
+
+    def __repr__(self):
+        return "<route: {}:{} {}>".format(self.host, self.port, self.attrs)
+
+
+class RouteTable(object):
+    """"""
+
+    def __init__(self):
+        self.routes = []
+
+    def add(self, pattern, **attrs):
+        route = Route(pattern, attrs)
+        self.routes.append(route)
+        return route
+
+    def lookup(self, host, port) -> dict:
+        for route in self.routes:
+            if route.match(host, port):
+                return route.attrs
+        return {}
+
+    @classmethod
+    def parse(cls, specs):
+        """specs like ["*:22=priority:interactive", "*.example.com=priority:bulk"]"""
+        table = cls()
+        for spec in specs or []:
+            pattern, _, settings = spec.partition("=")
+            attrs = {}
+            for item in settings.split(","):
+                if item:
+                    key, _, value = item.partition(":")
+                    attrs[key.strip()] = value.strip()
+            table.add(pattern.strip(), **attrs)
+        return table
@@ -5,9 +5,12 @@ import socket
 
 from .s5 import Sock5Session
 from .raw import RawSession
+from .tunnel import TunnelServerSession
+from .http import HttpProxySession
+from .sniff import SniffSession
 
 __all__ = [
-    "Sock5Session", "RawSession"
+    "Sock5Session", "RawSession", "TunnelServerSession", "HttpProxySession", "SniffSession"
 ]
 
 
@@ -1,16 +1,100 @@
 #!/usr/bin/env python3
 # coding:utf-8
 import socket
+import struct
+import functools
+import traceback
+
+from .. import outils
+from .. import trace
+from ..stats import SessionStats
+from ..capture import DIR_SEND
+from ..address import is_unix, parse_addr, peer_credentials
+from ..sockopts import get_profile
+from ..relay import PRIORITY_NORMAL, PRIORITY_WEIGHTS
+
+logger = outils.get_logger("localforward")
+
+PRIORITIES = [name for name, _ in PRIORITY_WEIGHTS]
+
+_PORT = struct.Struct("!H")
+
+
+def pack_addr(addr):
+    """(host, port) as packed address + 2 port bytes, anything else is kept as is"""
+    if isinstance(addr, tuple) and len(addr) >= 2:
+        host, port = addr[:2]
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        try:
+            return socket.inet_pton(family, host) + _PORT.pack(port)
+        except (OSError, TypeError, struct.error):
+            pass
+    return addr
+
+
+def unpack_addr(raw):
+    if not isinstance(raw, bytes):
+        return raw
+    family = socket.AF_INET if len(raw) == 6 else socket.AF_INET6
+    return socket.inet_ntop(family, raw[:-2]), _PORT.unpack(raw[-2:])[0]
 
 
 class SessionBase:
 
-    def __init__(self, conn: socket.socket, addr, options):
+    # sessions live for as long as their tunnel, keep them small
+    __slots__ = ("conn", "_addr", "options", "sid", "trace", "capture", "upstream",
+                 "flow", "priority", "idle_timeout", "pipes", "detached", "closed",
+                 "on_finish", "stat", "timers", "peercred", "route", "username",
+                 "hook_state", "__weakref__")
+
+    def __init__(self, conn: socket.socket, addr, options, sid=0, trace=trace.NULL_TRACE):
         self.conn = conn
-        self.addr = addr
+        self._addr = pack_addr(addr)
+        # (pid, uid, gid) of the client process on unix socket listeners
+        self.peercred = peer_credentials(conn) if conn.family == socket.AF_UNIX else None
+        self.route = None
+        # set once the client authenticated
+        self.username = None
+        profile = get_profile(options.get("sockopts"))
+        if profile:
+            profile.apply(conn)
         self.options = options
+        self.sid = sid
+        self.trace = trace
+        self.capture = None
+        self.upstream = None
+        self.flow = None
+        self.priority = PRIORITY_NORMAL
+        self.idle_timeout = None
+        self.pipes = ()
+        # set once the relay engine owns the session
+        self.detached = False
+        self.closed = False
+        # called once by close()
+        self.on_finish = None
+        # per-session state of hooks, keyed by the hook, dropped by close()
+        self.hook_state = None
+
+        stats = options.get("stats")
+        self.stat = stats.open_session(sid, addr) if stats else SessionStats(sid, addr)
+
+        self.timers = {}
+        self.start_timer("handshake", options.get("handshake_timeout", options.get("timeout", 10)))
+        self.start_timer("lifetime", options.get("max_lifetime"))
+        try:
+            self.on_connect()
+        except:
+            self.cancel_timers()
+            raise
+
+    @property
+    def addr(self):
+        return unpack_addr(self._addr)
 
-        self.on_connect()
+    @classmethod
+    def reject(cls, conn: socket.socket):
+        """turn a connection away without a handshake, it is closed afterwards"""
+        pass
 
     def on_connect(self):
         """"""
@@ -19,3 +103,196 @@ class SessionBase:
     def handle(self):
         """"""
         pass
+
+    def close(self):
+        """release everything the session holds, safe to call twice"""
+        if self.closed:
+            return
+        self.closed = True
+        self.cancel_timers()
+        self.close_capture()
+        if self.flow is not None:
+            self.flow.close()
+        if self.upstream is not None:
+            self.upstream.close()
+        self.conn.close()
+        self.hook_state = None
+        if self.on_finish is not None:
+            self.on_finish()
+
+    def start_timer(self, kind, delay):
+        """expire the session after delay seconds unless the timer is cancelled/reset"""
+        timers = self.options.get("timers")
+        if not timers or not delay:
+            return None
+        self.timers[kind] = timers.schedule(delay, functools.partial(self.expire, kind))
+        return self.timers[kind]
+
+    def cancel_timer(self, kind):
+        timer = self.timers.pop(kind, None)
+        if timer:
+            timer.cancel()
+
+    def cancel_timers(self):
+        for kind in list(self.timers):
+            self.cancel_timer(kind)
+
+    def expire(self, kind):
+        """
+        called from the timer wheel, shutting the sockets down wakes up the
+        session thread wherever it is blocked.
+        """
+        logger.info("session #{} from {} hits {} timeout".format(self.sid, self.addr, kind))
+        stats = self.options.get("stats")
+        if stats:
+            stats.incr("timeouts_{}".format(kind))
+        for sock in (self.conn, self.upstream):
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def connect_upstream(self, addr):
+        """
+        blocking connect bounded by the connect timeout. addr is (host, port),
+        or a path for unix sockets. names and ip literals are resolved to
+        every address family they have, tried in order. with a tunnel client in the options tcp
+        connections are streams over the tunnel instead, with a connector
+        (see transport) whatever it returns.
+        """
+        route = self.lookup_route(*addr) if not is_unix(addr) else {}
+        self.upstream = self.open_upstream(addr, route)
+        self.trace.mark(trace.PHASE_CONNECTED)
+        return self.upstream
+
+    def open_upstream(self, addr, route) -> socket.socket:
+        """connect like connect_upstream, with the sockopts of route, and leave the session alone"""
+        timeout = self.options.get("connect_timeout", self.options.get("timeout", 10))
+        tunnel = self.options.get("tunnel")
+        connector = self.options.get("connector")
+        if is_unix(addr):
+            tunnel = None
+        if connector:
+            return connector(addr, timeout)
+        if tunnel:
+            return tunnel.open(addr[0], addr[1], timeout)
+        profile = get_profile(route.get("sockopts") or self.options.get("upstream_sockopts"))
+        if is_unix(addr):
+            candidates = [(socket.AF_UNIX, addr)]
+        else:
+            candidates = [(info[0], info[4]) for info in
+                          socket.getaddrinfo(addr[0], addr[1], 0, socket.SOCK_STREAM)]
+        error = None
+        for family, sockaddr in candidates:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                if profile:
+                    profile.apply_before_connect(sock)
+                sock.settimeout(timeout)
+                sock.connect(sockaddr)
+                sock.settimeout(None)
+                if profile:
+                    profile.apply(sock)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+            except BaseException:
+                sock.close()
+                raise
+        raise error
+
+    def authenticate(self, username, password) -> bool:
+        """check against options["auth"], an auth.Authenticator, on this worker thread"""
+        if not self.options["auth"].verify(username, password):
+            logger.info("authentication of {!r} from {} failed".format(username, self.addr))
+            return False
+        self.username = username
+        self.stat.user = username
+        return True
+
+    def connect_destination(self, host, port):
+        """connect to what the client asked for, a route may send it elsewhere, e.g. a unix socket"""
+        target = self.lookup_route(host, port).get("target")
+        return self.connect_upstream(parse_addr(target) if target else (host, port))
+
+    def send_upstream(self, data: bytes):
+        """
+        data the handshake already read from the client, sent before relaying
+        starts and seen by hooks, capture and stats like relayed data.
+        """
+        if not data:
+            return
+        data = self.execute_callback("data_send", self.upstream, data)
+        if self.capture:
+            self.capture.record(DIR_SEND, data)
+        self.stat.bytes_up += len(data)
+        self.trace.mark(trace.PHASE_FIRST_UP)
+        self.upstream.sendall(data)
+
+    def open_capture(self, upstream: socket.socket, host=None):
+        """start capturing once the upstream is connected"""
+        capture = self.options.get("capture")
+        if capture:
+            peer = upstream.getpeername()
+            if not isinstance(peer, tuple):
+                # a tunnel stream, the peer is only known by name
+                peer = (host, 0)
+            self.capture = capture.open_session(self.sid, self.addr, peer, host)
+
+    def close_capture(self):
+        capture, self.capture = self.capture, None
+        if capture:
+            capture.close()
+
+    def relay(self, upstream: socket.socket, dest_host=None, dest_port=None):
+        """
+        hand the connected pair over to the relay engine and return, the
+        engine closes the session once either side is done.
+        """
+        self.upstream = upstream
+        shaper = self.options.get("shaper")
+        self.flow = shaper.open_flow(self.addr[0], dest_host) if shaper else None
+
+        route = self.lookup_route(dest_host, dest_port)
+        priority = route.get("priority") or self.options.get("priority") or PRIORITY_NORMAL
+        if priority not in PRIORITIES:
+            logger.warn("unknown priority: {}, use {}".format(priority, PRIORITY_NORMAL))
+            priority = PRIORITY_NORMAL
+        self.priority = priority
+
+        self.idle_timeout = self.options.get("idle_timeout")
+        self.start_timer("idle", self.idle_timeout)
+        self.detached = True
+        self.options["engine"].add(self)
+
+    def lookup_route(self, host, port) -> dict:
+        """settings of the first route matching the destination, looked up once"""
+        if self.route is None:
+            routes = self.options.get("routes")
+            self.route = routes.lookup(host, port) if routes else {}
+        return self.route
+
+    def execute_callback(self, hook_key, conn: socket.socket, buff: bytes):
+        """
+        hooks are called as callback(buff, conn), or callback(buff, conn, session)
+        if the callback has a true `takes_session` attribute. buff is bytes of
+        their own, unless the callback has a true `takes_view` attribute: then
+        it may be a memoryview of the read buffer, only valid during the call.
+        """
+        try:
+            callback = self.options.get(hook_key)
+            if callback:
+                if not getattr(callback, "takes_view", False):
+                    buff = bytes(buff)
+                if getattr(callback, "takes_session", False):
+                    buff = callback(buff, conn, self)
+                else:
+                    buff = callback(buff, conn)
+                return buff
+        except:
+            logger.warn("execute hook: {} error: {}".format(hook_key, traceback.format_exc()))
+
+        return buff
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import socket
+import base64
+import binascii
+from urllib.parse import urlsplit
+
+from .. import outils
+from .. import trace
+from ..http1 import HttpHead, HttpParseError, REQUEST, MAX_HEAD_SIZE
+from .base import SessionBase
+
+logger = outils.get_logger("localforward")
+
+_HOP_HEADERS = ("proxy-connection", "proxy-authorization", "connection", "keep-alive")
+
+RSP_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+RSP_AUTH_REQUIRED = (b"HTTP/1.1 407 Proxy Authentication Required\r\n"
+                     b"Proxy-Authenticate: Basic realm=\"localforward\"\r\n"
+                     b"Connection: close\r\nContent-Length: 0\r\n\r\n")
+
+
+def _error_response(status, reason):
+    return "HTTP/1.1 {} {}\r\nConnection: close\r\nContent-Length: 0\r\n\r\n".format(
+        status, reason).encode()
+
+
+def parse_authority(target):
+    """CONNECT target "host:port" or "[ipv6]:port" -> (host, port), ValueError if malformed"""
+    host, sep, port = target.rpartition(":")
+    if not sep or not host or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError("bad authority: {!r}".format(target))
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+        try:
+            socket.inet_pton(socket.AF_INET6, host)
+        except (OSError, ValueError):
+            raise ValueError("bad ipv6 address: {!r}".format(target))
+    elif "[" in host or "]" in host or ":" in host:
+        raise ValueError("bad authority: {!r}".format(target))
+    return host, int(port)
+
+
+class HttpProxySession(SessionBase):
+    """
+    http proxy front end: CONNECT host:port tunnels, and plain requests with
+    an absolute uri, forwarded in origin form. plain requests are sent with
+    "Connection: close", the next request may be for another host.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def reject(cls, conn):
+        """"""
+        conn.setblocking(False)
+        conn.send(_error_response(503, "Service Unavailable"))
+
+    def handle(self):
+        """"""
+        try:
+            head, rest = self._read_head()
+        except HttpParseError as e:
+            logger.info("bad http proxy request from {}: {}".format(self.addr, e))
+            self.conn.sendall(_error_response(400, "Bad Request"))
+            return
+        if head is None:
+            return
+        if self.options.get("auth") and not self._auth_basic(head):
+            self.conn.sendall(RSP_AUTH_REQUIRED)
+            return
+        self.cancel_timer("handshake")
+        self.trace.mark(trace.PHASE_REQUEST)
+        logger.info("accept http proxy request: {}".format(head))
+
+        try:
+            if head.method == "CONNECT":
+                host, port = parse_authority(head.target)
+            else:
+                url = urlsplit(head.target)
+                if url.scheme != "http" or not url.hostname:
+                    raise ValueError("not an absolute http uri: {!r}".format(head.target))
+                host, port = url.hostname, url.port or 80
+        except ValueError as e:
+            logger.info("bad http proxy request from {}: {}".format(self.addr, e))
+            self.conn.sendall(_error_response(400, "Bad Request"))
+            return
+
+        if head.method == "CONNECT":
+            self._forward(host, port, RSP_ESTABLISHED, rest)
+        else:
+            self._forward(host, port, None, self._origin_form(head, url) + rest)
+
+    def _auth_basic(self, head: HttpHead):
+        scheme, _, token = (head.get("proxy-authorization") or "").partition(" ")
+        if scheme.lower() != "basic":
+            return False
+        try:
+            username, sep, password = base64.b64decode(token.strip()).decode("utf-8").partition(":")
+        except (binascii.Error, UnicodeDecodeError):
+            return False
+        return bool(sep) and self.authenticate(username, password)
+
+    def _read_head(self):
+        """(HttpHead, bytes read past the head), head is None if the client left"""
+        buf = b""
+        while True:
+            data = self.conn.recv(4096)
+            if not data:
+                return None, b""
+            start = max(len(buf) - 3, 0)
+            buf += data
+            idx = buf.find(b"\r\n\r\n", start)
+            if idx >= 0:
+                return HttpHead.parse(REQUEST, buf[:idx]), buf[idx + 4:]
+            if len(buf) > MAX_HEAD_SIZE:
+                raise HttpParseError("head is too large")
+
+    def _origin_form(self, head: HttpHead, url):
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        lines = ["{} {} {}".format(head.method, path, head.version)]
+        if head.get("host") is None:
+            lines.append("Host: {}".format(url.netloc))
+        for name, value in head.headers:
+            if name.lower() not in _HOP_HEADERS:
+                lines.append("{}: {}".format(name, value))
+        lines.append("Connection: close")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def _forward(self, host, port, reply, first):
+        self.trace.dest_port = port
+        self.stat.dest = "{}:{}".format(host, port)
+        try:
+            new_sock = self.connect_destination(host, port)
+        except (OSError, ValueError) as e:
+            logger.info("http proxy cannot connect {}:{}: {}".format(host, port, e))
+            self.conn.sendall(_error_response(502, "Bad Gateway"))
+            return
+        if reply:
+            self.conn.sendall(reply)
+        self.open_capture(new_sock, host)
+        self.send_upstream(first)
+        self.relay(new_sock, host, port)
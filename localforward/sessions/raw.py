@@ -1,71 +1,43 @@
 #!/usr/bin/env python3
 # coding:utf-8
 import socket
-import select
+
+from .. import outils
+from ..address import is_unix, format_addr
 from .base import SessionBase
 
+logger = outils.get_logger("localforward")
+
 
 class RawSession(SessionBase):
 
+    __slots__ = ()
+
     def on_connect(self):
         """"""
         pass
 
     def handle(self):
         """"""
-        remote_host, remote_port = self.options['remote_addr']
-
-        new_sock = socket.socket()
-        new_sock.settimeout(self.options.get("timeout", 10))
-        new_sock.connect((remote_host, remote_port))
-
-        events = [
-            select.kevent(self.conn.fileno(), select.KQ_FILTER_READ),
-            select.kevent(new_sock.fileno(), select.KQ_FILTER_READ)
-        ]
-        kq = select.kqueue()
-
-        should_close = False
-        while True:
-            if should_close == True:
-                break
-
-            for _es in kq.control(events, 2, 1):
-                if _es.ident == self.conn.fileno():
-                    buff = b""
-                    while True:
-                        try:
-                            data = self.conn.recv(1024)
-                        except BlockingIOError:
-                            break
-
-                        if not data:
-                            should_close = True
-                            break
-                        else:
-                            buff += data
-                        break
-                    if buff:
-                        print(buff)
-                        new_sock.sendall(buff)
-                elif _es.ident == new_sock.fileno():
-                    buff = b""
-                    while True:
-                        try:
-                            data = new_sock.recv(1024)
-                        except:
-                            break
-
-                        if not data:
-                            should_close = True
-                            break
-                        else:
-                            buff += data
-                    if buff:
-                        print(buff)
-
-                        self.conn.sendall(buff)
-
-        self.conn.close()
-        new_sock.close()
-
+        self.cancel_timer("handshake")
+        target, new_sock = self._connect_target()
+        remote_host, remote_port = (format_addr(target), 0) if is_unix(target) else target
+        self.trace.dest_port = remote_port
+        self.stat.dest = format_addr(target)
+        self.open_capture(new_sock, remote_host)
+
+        self.relay(new_sock, remote_host, remote_port)
+
+    def _connect_target(self):
+        """targets are used round-robin, falling over to the next one on errors"""
+        targets = self.options.get("targets") or [self.options['remote_addr']]
+        first = next(self.options["target_counter"]) if len(targets) > 1 else 0
+        for i in range(len(targets)):
+            target = targets[(first + i) % len(targets)]
+            try:
+                return target, self.connect_upstream(target)
+            except OSError:
+                if i == len(targets) - 1:
+                    raise
+                logger.warn("target {} is unreachable, try the next one".format(
+                    format_addr(target)))
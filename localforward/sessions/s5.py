@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 # coding:utf-8
+import time
 import select
+import selectors
 import threading
 import traceback
 import socket
-import ipaddress
 import struct
 
 from .. import outils
+from .. import trace
 from .base import SessionBase
 
 
@@ -17,6 +19,29 @@ class ConnectionIsClosedByPeer(Exception):
 
 logger = outils.get_logger("localforward")
 
+# client data buffered while a BIND waits for its peer
+_BIND_EARLY_LIMIT = 64 * 1024
+
+
+def _unmapped(host: str) -> str:
+    """the ipv4 address of an ipv4-mapped ipv6 one ("::ffff:1.2.3.4"), host otherwise"""
+    if host.lower().startswith("::ffff:") and "." in host:
+        return host[7:]
+    return host
+
+
+def _recv_exact(sock, n) -> bytes:
+    """n bytes, however the peer split them up"""
+    data = sock.recv(n)
+    while len(data) < n:
+        if not data:
+            raise ConnectionIsClosedByPeer()
+        more = sock.recv(n - len(data))
+        if not more:
+            raise ConnectionIsClosedByPeer()
+        data += more
+    return data
+
 '''
 The SOCKS request is formed as follows:
     +----+-----+-------+------+----------+----------+
@@ -51,6 +76,10 @@ CMD_TABLE = {
     CMD_UDP: "UDP"
 }
 
+METHOD_NO_AUTH = 0
+METHOD_USERPASS = 2
+METHOD_NO_ACCEPTABLE = 0xff
+
 ATYP_IPV4 = 1
 ATYP_DDMAIN = 3
 ATYP_IPv6 = 4
@@ -109,45 +138,87 @@ REP_ADDRESS_TYPE_NOT_SUPPORTED = 8
 class Sock5Response(object):
     """"""
 
+    @classmethod
+    def failed(self, rep=REP_S5ERR):
+        """"""
+        return b"\x05" + bytes([rep]) + b"\x00\x01\x00\x00\x00\x00\x00\x00"
+
     @classmethod
     def succeeded(self, bnd_addr, bnd_port):
         """"""
         return b"\x05\x00\x00\x01" + bnd_addr + bnd_port
 
+    @classmethod
+    def bound(self, sockaddr):
+        """
+        success with sockaddr as BND, ATYP 1 or 4 by its family. anything that
+        is not an ip address (unix path, tunnel stream) is sent as 0.0.0.0:0.
+        """
+        host, port = sockaddr[:2] if isinstance(sockaddr, tuple) else ("", 0)
+        host = _unmapped(host.partition("%")[0])
+        for family, atyp in ((socket.AF_INET, ATYP_IPV4), (socket.AF_INET6, ATYP_IPv6)):
+            try:
+                raw = socket.inet_pton(family, host)
+            except OSError:
+                continue
+            return b"\x05\x00\x00" + bytes([atyp]) + raw + struct.pack("!H", port)
+        return self.succeeded(b"\x00\x00\x00\x00", b"\x00\x00")
+
 
 class Sock5Request(object):
-    """"""
+    """the destination is kept packed as received: 4/16 address bytes or the domain"""
 
-    def __init__(self, cmd, atyp, host, port, ipraw=b''):
+    __slots__ = ("cmd", "atyp", "addr", "port")
+
+    def __init__(self, cmd, atyp, addr, port):
         """Constructor"""
         self.cmd = cmd
         self.atyp = atyp
-        self.host = host
+        self.addr = addr
         self.port = port
-        self.ipraw = ipraw
+
+    @property
+    def host(self) -> str:
+        if self.atyp == ATYP_IPV4:
+            return socket.inet_ntop(socket.AF_INET, self.addr)
+        if self.atyp == ATYP_IPv6:
+            return socket.inet_ntop(socket.AF_INET6, self.addr)
+        return self.addr.decode("utf-8", "replace")
+
+    @property
+    def ipraw(self):
+        return self.addr if self.atyp == ATYP_IPV4 else b''
 
     @classmethod
-    def from_sock(cls, sock):
-        # ver
-        ver = sock.recv(1)
-        cmd = ord(sock.recv(1))
-        _ = sock.recv(1)
+    def to(cls, host, port, cmd=CMD_CONNECT):
+        """a request for host:port, an ip literal is sent as such"""
+        for family, atyp in ((socket.AF_INET, ATYP_IPV4), (socket.AF_INET6, ATYP_IPv6)):
+            try:
+                return cls(cmd, atyp, socket.inet_pton(family, host), port)
+            except OSError:
+                pass
+        return cls(cmd, ATYP_DDMAIN, host.encode("idna"), port)
+
+    def to_bytes(self) -> bytes:
+        addr = bytes([len(self.addr)]) + self.addr if self.atyp == ATYP_DDMAIN else self.addr
+        return bytes([VER, self.cmd, 0, self.atyp]) + addr + struct.pack("!H", self.port)
 
-        ipraw = b''
-        atyp = ord(sock.recv(1))
+    @classmethod
+    def from_sock(cls, sock):
+        # ver, cmd, rsv, atyp
+        ver, cmd, _, atyp = _recv_exact(sock, 4)
         if atyp == ATYP_DDMAIN:
-            _dl = ord(sock.recv(1))
-            addr = sock.recv(_dl)
+            _dl = ord(_recv_exact(sock, 1))
+            addr = _recv_exact(sock, _dl)
         elif atyp == ATYP_IPV4:
-            ipraw = sock.recv(4)
-            addr = ipaddress.IPv4Address(ipraw)
+            addr = _recv_exact(sock, 4)
         elif atyp == ATYP_IPv6:
-            raise NotImplementedError("IPv6 is not supported.")
+            addr = _recv_exact(sock, 16)
         else:
             raise NotImplementedError("No Defination: {}".format(atyp))
 
-        port = struct.unpack('!h', sock.recv(2))[0]
-        return cls(cmd, atyp, addr, port, ipraw)
+        port = struct.unpack('!H', _recv_exact(sock, 2))[0]
+        return cls(cmd, atyp, addr, port)
 
     def __repr__(self):
         return "<sock5-req: {} to {}:{}>".format(
@@ -157,107 +228,199 @@ class Sock5Request(object):
 
 class Sock5Session(SessionBase):
 
+    __slots__ = ()
+
+    @classmethod
+    def reject(cls, conn):
+        """accept no-auth and fail the request right away, without reading anything"""
+        conn.setblocking(False)
+        conn.send(b"\x05\x00" + Sock5Response.failed(REP_S5ERR))
+
     def on_connect(self):
         """"""
-        if ord(self.conn.recv(1)) != 5:
+        ver, nmethods = _recv_exact(self.conn, 2)
+        if ver != 5:
             logger.info("not a socks5 connection.")
             raise ConnectionRefusedError()
 
-        nmethods = ord(self.conn.recv(1))
-        methods = self.conn.recv(nmethods)
-        self.conn.send(b"\x05\x00")
+        methods = _recv_exact(self.conn, nmethods)
+        if self.options.get("auth"):
+            self._auth_userpass(methods)
+        else:
+            self.conn.send(b"\x05\x00")
+        self.trace.mark(trace.PHASE_GREETING)
+
+    def _auth_userpass(self, methods):
+        """RFC 1929 username/password sub-negotiation"""
+        if METHOD_USERPASS not in methods:
+            self.conn.send(b"\x05" + bytes([METHOD_NO_ACCEPTABLE]))
+            raise ConnectionRefusedError("no acceptable auth method")
+        self.conn.send(b"\x05" + bytes([METHOD_USERPASS]))
+
+        ver, ulen = _recv_exact(self.conn, 2)
+        username = _recv_exact(self.conn, ulen)
+        password = _recv_exact(self.conn, ord(_recv_exact(self.conn, 1)))
+        if ver != 1 or not self.authenticate(username.decode("utf-8", "replace"),
+                                             password.decode("utf-8", "replace")):
+            self.conn.send(b"\x01\x01")
+            raise ConnectionRefusedError("authentication failed")
+        self.conn.send(b"\x01\x00")
 
     def handle(self):
         """"""
         try:
             req = Sock5Request.from_sock(self.conn)
+            self.cancel_timer("handshake")
+            self.trace.mark(trace.PHASE_REQUEST)
+            self.trace.dest_port = req.port
+            self.stat.dest = "{}:{}".format(req.host, req.port)
             logger.info("accept socks5 request: {}".format(req))
 
             if req.cmd == CMD_CONNECT:
                 self._handle_connect(req)
+            elif req.cmd == CMD_BIND:
+                self._handle_bind(req)
             else:
                 logger.warn(
-                    "cannot handle req: {} with invalid cmd: BIND/UDP".format(req))
+                    "cannot handle req: {} with invalid cmd: UDP".format(req))
+                self.conn.send(Sock5Response.failed(REP_COMMAND_NOT_SUPPORTED))
         except ConnectionIsClosedByPeer:
             pass
-        finally:
-            self.conn.close()
 
     def _handle_connect(self, req: Sock5Request):
         """"""
-        new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        new_sock.settimeout(self.options.get("timeout", 10))
-        new_sock.connect((req.host.compressed, req.port))
-        _ip, port = new_sock.getpeername()
-        _ipraw = ipaddress.IPv4Address(_ip).packed
-        _portraw = struct.pack("!h", port)
-
-        rsp = Sock5Response.succeeded(
-            _ipraw, _portraw
-        )
-        self.conn.send(rsp)
-
-        events = [
-            select.kevent(self.conn.fileno(), select.KQ_FILTER_READ),
-            select.kevent(new_sock.fileno(), select.KQ_FILTER_READ)
-        ]
-        kq = select.kqueue()
-
-        while True:
-            for _es in kq.control(events, 2, 1):
-                if _es.ident == self.conn.fileno():
-                    buff = b""
-                    while True:
+        host = req.host
+        new_sock = self.connect_destination(host, req.port)
+        if new_sock.family in (socket.AF_INET, socket.AF_INET6):
+            peer = new_sock.getpeername()
+        else:
+            # unix socket or tunnel stream, no address worth reporting
+            peer = None
+        self.conn.send(Sock5Response.bound(peer))
+        self.open_capture(new_sock, host)
+
+        self.relay(new_sock, host, req.port)
+
+    def _listen_for_bind(self):
+        """
+        a listening socket on options["bind_host"], on a free port of
+        options["bind_ports"] (first, last) if given, or any port otherwise.
+        without a bind host it listens on the address the client connected
+        to, or on all ipv4 addresses when that is not a tcp one (unix listener).
+        """
+        host = self.options.get("bind_host")
+        if not host:
+            if self.conn.family in (socket.AF_INET, socket.AF_INET6):
+                host = self.conn.getsockname()[0]
+            else:
+                host = "0.0.0.0"
+        # the family of the bind host, an ipv6 one keeps its scope
+        family, _, _, _, sockaddr = socket.getaddrinfo(
+            host, 0, 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+        ports = self.options.get("bind_ports")
+        if ports:
+            first, last = ports
+            count = last - first + 1
+            start = next(self.options["bind_counter"]) % count
+            candidates = [first + (start + i) % count for i in range(count)]
+        else:
+            candidates = [0]
+
+        for port in candidates:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.bind((sockaddr[0], port) + sockaddr[2:])
+                sock.listen(1)
+                return sock
+            except OSError:
+                sock.close()
+        raise OSError("no free port for BIND on {} in {}".format(host, ports or "any"))
+
+    def _accept_bind(self, listener, expected_host, timeout, early: bytearray):
+        """
+        the inbound connection, or None when the timeout passed or the client
+        went away. with an ip DST.ADDR in the request other peers are
+        turned away. data the client sends meanwhile is kept in early, up to
+        a limit, so its connection stays registered and a hang up is seen.
+        """
+        deadline = time.monotonic() + timeout
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
+        selector.register(self.conn, selectors.EVENT_READ)
+        try:
+            while True:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    logger.info("BIND of session #{} from {} timed out".format(self.sid, self.addr))
+                    stats = self.options.get("stats")
+                    if stats:
+                        stats.incr("timeouts_bind")
+                    return None
+                for key, _ in selector.select(left):
+                    if key.fileobj is self.conn:
                         try:
-                            data = self.conn.recv(1024)
-                        except BlockingIOError:
-                            break
-
+                            data = self.conn.recv(_BIND_EARLY_LIMIT - len(early))
+                        except OSError:
+                            data = b""
                         if not data:
-                            raise ConnectionIsClosedByPeer()
-                        elif len(data) < 1024:
-                            buff += data
-                            break
-                        else:
-                            buff += data
-                        break
-                    if buff:
-                        logger.info("send to {}: {}".format(
-                            new_sock.getpeername(), buff))
-                        buff = self.execute_callback("data_send", new_sock, buff)
-                        new_sock.sendall(buff)
-                elif _es.ident == new_sock.fileno():
-                    buff = b""
-                    while True:
-                        try:
-                            data = new_sock.recv(1024)
-                        except:
-                            break
+                            # the client hung up, or expired by a session timer
+                            return None
+                        early += data
+                        if len(early) >= _BIND_EARLY_LIMIT:
+                            # the rest waits in the socket, the deadline still applies
+                            selector.unregister(self.conn)
+                        continue
+                    try:
+                        inbound, peer = listener.accept()
+                    except OSError:
+                        return None
+                    if expected_host and _unmapped(peer[0].partition("%")[0]) != expected_host:
+                        logger.info("BIND of session #{} refuses {}, expecting {}".format(
+                            self.sid, peer, expected_host))
+                        inbound.close()
+                        continue
+                    return inbound
+        finally:
+            selector.close()
 
-                        if not data:
-                            raise ConnectionIsClosedByPeer()
-                        elif len(data) < 1024:
-                            buff += data
-                            break
-                        else:
-                            buff += data
-                    if buff:
-                        logger.info("send to {}: {}".format(
-                            self.conn.getpeername(), buff
-                        ))
-                        buff = self.execute_callback("data_recv", new_sock, buff)
-                        self.conn.sendall(buff)
-
-        self.conn.close()
-        new_sock.close()
-
-    def execute_callback(self, hook_key, conn: socket.socket, buff: bytes):
+    def _handle_bind(self, req: Sock5Request):
+        """
+        two replies: the address we listen on, then the peer that connected,
+        the pair is relayed like a CONNECT afterwards.
+        """
+        try:
+            listener = self._listen_for_bind()
+        except (OSError, UnicodeError) as e:
+            logger.warn("socks5 BIND failed: {}".format(e))
+            self.conn.send(Sock5Response.failed(REP_S5ERR))
+            return
+
+        early = bytearray()
         try:
-            callback = self.options.get(hook_key)
-            if callback:
-                buff = callback(buff, conn)
-                return buff
-        except:
-            logger.warn("execute hook: {} error: {}".format(hook_key, traceback.format_exc()))
-
-        return buff
+            bound = listener.getsockname()
+            self.conn.send(Sock5Response.bound(bound))
+            logger.info("socks5 BIND of session #{} listens on {}:{}".format(self.sid, *bound[:2]))
+
+            expected = None
+            if req.atyp in (ATYP_IPV4, ATYP_IPv6) and any(req.addr):
+                expected = _unmapped(req.host)
+            inbound = self._accept_bind(listener, expected, self.options.get("bind_timeout", 60),
+                                        early)
+        finally:
+            listener.close()
+
+        if inbound is None:
+            try:
+                self.conn.send(Sock5Response.failed(REP_TTL_EXPIRED))
+            except OSError:
+                pass
+            return
+
+        self.trace.mark(trace.PHASE_CONNECTED)
+        peer = inbound.getpeername()
+        peer_host, peer_port = _unmapped(peer[0]), peer[1]
+        self.conn.send(Sock5Response.bound(peer))
+        self.upstream = inbound
+        self.open_capture(inbound, peer_host)
+        self.send_upstream(bytes(early))
+        self.relay(inbound, peer_host, peer_port)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import socket
+
+from .. import outils
+from .s5 import Sock5Session
+from .http import HttpProxySession
+
+logger = outils.get_logger("localforward")
+
+SOCKS5 = b"\x05"
+
+
+class SniffSession(Sock5Session, HttpProxySession):
+    """
+    socks5 and http proxy clients on one port. the first byte is peeked, not
+    read: 0x05 is a socks5 greeting, anything else is taken as http.
+    """
+
+    __slots__ = ("protocol",)
+
+    @classmethod
+    def reject(cls, conn):
+        """"""
+        conn.setblocking(False)
+        try:
+            first = conn.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            # nothing sent yet, closing is all we can do
+            return
+        if first == SOCKS5:
+            Sock5Session.reject(conn)
+        elif first:
+            HttpProxySession.reject(conn)
+
+    def on_connect(self):
+        """"""
+        first = self.conn.recv(1, socket.MSG_PEEK)
+        if first == SOCKS5:
+            self.protocol = "socks5"
+            Sock5Session.on_connect(self)
+        else:
+            self.protocol = "http"
+
+    def handle(self):
+        """"""
+        if self.protocol == "socks5":
+            Sock5Session.handle(self)
+        else:
+            HttpProxySession.handle(self)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import socket
+
+from .. import outils
+from ..address import parse_addr
+from ..tunnel import Mux, TunnelError, FRAME_AUTH, FRAME_CLOSE, pack_frame, read_frame
+from .base import SessionBase
+
+logger = outils.get_logger("localforward")
+
+
+class TunnelServerSession(SessionBase):
+    """
+    one connection of a tunnel client. streams opened by the client are
+    connected here and carried over the connection until either side drops.
+    with options["auth"] the client has to log in first, every stream goes
+    through the routes and the client quota like a socks5 session would.
+    """
+
+    __slots__ = ("mux", "tickets")
+
+    def handle(self):
+        """"""
+        if self.options.get("auth") and not self._login():
+            return
+        self.cancel_timer("handshake")
+        self.stat.dest = "tunnel"
+        # socket -> quota ticket of the stream
+        self.tickets = {}
+        self.mux = Mux(self.conn, initiator=False, on_open=self._open_stream,
+                       executor=self.options.get("executor"),
+                       compress=self.options.get("tunnel_compress", False))
+        self.mux.on_close = self.close
+        self.mux.on_stream_close = self._stream_closed
+        self.detached = True
+        self.options["tunnel_muxes"].add(self.mux)
+        self.mux.start()
+        logger.info("tunnel from {} is up".format(self.addr))
+
+    def _login(self) -> bool:
+        try:
+            ftype, sid, payload = read_frame(self.conn)
+        except TunnelError as e:
+            logger.info("tunnel from {} failed: {}".format(self.addr, e))
+            return False
+        if ftype == FRAME_AUTH and not sid:
+            username, _, password = payload.decode("utf-8", "replace").partition("\0")
+            if self.authenticate(username, password):
+                return True
+        self.conn.sendall(pack_frame(FRAME_CLOSE, 0, b"authentication failed"))
+        return False
+
+    def close(self):
+        mux = getattr(self, "mux", None)
+        if mux is not None:
+            self.options["tunnel_muxes"].discard(mux)
+        SessionBase.close(self)
+        # streams the mux did not get to close
+        for sock in list(getattr(self, "tickets", ())):
+            self._stream_closed(sock)
+
+    def _open_stream(self, host, port):
+        """on a pool thread"""
+        quota = self.options.get("quota")
+        ticket = None
+        if quota and self.conn.family != socket.AF_UNIX:
+            ticket = quota.acquire(self.addr[0])
+            if ticket is None:
+                raise ConnectionRefusedError("over quota")
+        routes = self.options.get("routes")
+        route = routes.lookup(host, port) if routes else {}
+        target = route.get("target")
+        try:
+            sock = self.open_upstream(parse_addr(target) if target else (host, port), route)
+        except BaseException:
+            self._release(ticket)
+            raise
+        if ticket is not None:
+            self.tickets[sock] = ticket
+        if self.closed:
+            self._stream_closed(sock)
+            sock.close()
+            raise TunnelError("tunnel is closed")
+        return sock
+
+    def _stream_closed(self, sock):
+        """the stream of sock is gone, give its quota back"""
+        self._release(self.tickets.pop(sock, None))
+
+    def _release(self, ticket):
+        if ticket is not None:
+            self.options["quota"].release(ticket)
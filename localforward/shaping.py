@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Hierarchical bandwidth shaping.
+
+Limits are token buckets at three levels: one global bucket, one bucket per
+client address and one per destination host. A relayed chunk draws from
+every bucket of its session, so a session moves at the pace of its
+tightest level. One refill thread per `Shaper` tops up all buckets; the
+relay loops never sleep, they stop polling a socket while its buckets are
+empty and pick it up again after the next refill.
+"""
+import time
+import threading
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+SCOPE_GLOBAL = "global"
+SCOPE_CLIENT = "client"
+SCOPE_DEST = "dest"
+SCOPES = (SCOPE_GLOBAL, SCOPE_CLIENT, SCOPE_DEST)
+
+
+class TokenBucket(object):
+    """"""
+
+    __slots__ = ("scope", "key", "rate", "burst", "tokens", "refs")
+
+    def __init__(self, scope, key, rate, burst):
+        self.scope = scope
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refs = 0
+
+    def refill(self, elapsed):
+        self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
+
+    def rerate(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+
+class Flow(object):
+    """the buckets one session draws from, refreshed when limits change"""
+
+    __slots__ = ("shaper", "client", "dest", "buckets", "version")
+
+    def __init__(self, shaper, client, dest):
+        self.shaper = shaper
+        self.client = client
+        self.dest = dest
+        self.buckets = ()
+        self.version = -1
+
+    def allowance(self, want):
+        """how many bytes may be read now, 0 means pause"""
+        if self.version != self.shaper.version:
+            self.shaper._resolve(self)
+        if not self.buckets:
+            return want
+        tokens = min(b.tokens for b in self.buckets)
+        return max(0, min(want, int(tokens)))
+
+    def consume(self, n):
+        if not self.buckets:
+            return
+        # the refill thread updates the same tokens
+        with self.shaper._lock:
+            for b in self.buckets:
+                b.tokens -= n
+
+    def close(self):
+        self.shaper._release(self)
+
+
+class Shaper(object):
+    """"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.version = 0
+        # scope -> {key: (rate, burst)}, key None is the default of the scope
+        self._limits = {scope: {} for scope in SCOPES}
+        # scope -> {key: TokenBucket}
+        self._buckets = {scope: {} for scope in SCOPES}
+        self._lock = threading.Lock()
+        # the refill thread, it runs while it is this one
+        self._timer = None
+
+    def set_limit(self, scope, rate, burst=None, key=None):
+        """
+        limit scope ("global", "client" or "dest") to rate bytes/sec. key is a
+        client address or destination host, None sets the default for every
+        client/destination without its own limit.
+        """
+        if scope not in SCOPES:
+            raise ValueError("unknown scope: {}".format(scope))
+        if rate <= 0:
+            raise ValueError("rate must be positive: {}".format(rate))
+        with self._lock:
+            self._limits[scope][key] = (rate, burst or rate)
+            self._rerate(scope)
+            self.version += 1
+            self._ensure_timer()
+
+    def clear_limit(self, scope, key=None):
+        with self._lock:
+            self._limits[scope].pop(key, None)
+            self._rerate(scope)
+            self.version += 1
+
+    def _rerate(self, scope):
+        """live buckets follow the new limits, those left without one go when their flows resolve"""
+        for bkey, bucket in self._buckets[scope].items():
+            limit = self._limit(scope, bkey)
+            if limit:
+                bucket.rerate(*limit)
+
+    def limits(self):
+        with self._lock:
+            return {scope: {str(k) if k else "*": list(v) for k, v in limits.items()}
+                    for scope, limits in self._limits.items()}
+
+    def open_flow(self, client, dest):
+        return Flow(self, client, dest)
+
+    def _limit(self, scope, key):
+        limits = self._limits[scope]
+        return limits.get(key) or limits.get(None)
+
+    def _resolve(self, flow: Flow):
+        with self._lock:
+            self._unref(flow)
+            buckets = []
+            for scope, key in ((SCOPE_GLOBAL, None), (SCOPE_CLIENT, flow.client),
+                               (SCOPE_DEST, flow.dest)):
+                limit = self._limit(scope, key)
+                if not limit:
+                    continue
+                bucket = self._buckets[scope].get(key)
+                if bucket is None:
+                    bucket = self._buckets[scope][key] = TokenBucket(scope, key, *limit)
+                bucket.refs += 1
+                buckets.append(bucket)
+            flow.buckets = tuple(buckets)
+            flow.version = self.version
+            if buckets:
+                self._ensure_timer()
+
+    def _release(self, flow: Flow):
+        with self._lock:
+            self._unref(flow)
+            flow.buckets = ()
+
+    def _unref(self, flow):
+        for bucket in flow.buckets:
+            bucket.refs -= 1
+            if bucket.refs <= 0:
+                self._buckets[bucket.scope].pop(bucket.key, None)
+
+    def _ensure_timer(self):
+        """under the lock"""
+        if self._timer is None:
+            self._timer = threading.Thread(target=self._refill, name="shaper")
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self):
+        """stop the refill thread, it comes back with the next limited flow"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.join()
+
+    def _refill(self):
+        last = time.monotonic()
+        while self._timer is threading.current_thread():
+            time.sleep(self.interval)
+            now = time.monotonic()
+            elapsed, last = now - last, now
+            with self._lock:
+                for buckets in self._buckets.values():
+                    for bucket in buckets.values():
+                        bucket.refill(elapsed)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Socket option profiles.
+
+A profile is a set of options applied to a listener, the connections it
+accepts or the upstream connections of a route. It is written as a named
+profile or a comma separated spec:
+
+    interactive
+    nodelay,quickack,notsent_lowat=16384,keepalive=60:10:5
+    rcvbuf=4194304+sndbuf=4194304+fastopen=256
+
+("+" separates options too, for places where "," is taken, e.g. routes.)
+
+Options the system does not know are skipped, so one spec can be shared by
+linux and bsd/macos hosts.
+"""
+import sys
+import socket
+import functools
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+_LINUX = sys.platform.startswith("linux")
+_DARWIN = sys.platform == "darwin"
+
+
+def _const(name, linux=None, darwin=None):
+    value = getattr(socket, name, None)
+    if value is None:
+        value = linux if _LINUX else darwin if _DARWIN else None
+    return value
+
+
+TCP_QUICKACK = _const("TCP_QUICKACK", linux=12)
+TCP_NOTSENT_LOWAT = _const("TCP_NOTSENT_LOWAT", linux=25, darwin=0x201)
+TCP_FASTOPEN = _const("TCP_FASTOPEN", linux=23, darwin=0x105)
+TCP_FASTOPEN_CONNECT = _const("TCP_FASTOPEN_CONNECT", linux=30)
+TCP_KEEPIDLE = _const("TCP_KEEPIDLE", linux=4) or _const("TCP_KEEPALIVE", darwin=0x10)
+TCP_KEEPINTVL = _const("TCP_KEEPINTVL", linux=5, darwin=0x101)
+TCP_KEEPCNT = _const("TCP_KEEPCNT", linux=6, darwin=0x102)
+
+_TCP_FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+
+class SocketProfile(object):
+    """"""
+
+    __slots__ = ("nodelay", "rcvbuf", "sndbuf", "keepalive", "fastopen", "quickack",
+                 "notsent_lowat")
+
+    def __init__(self, nodelay=None, rcvbuf=None, sndbuf=None, keepalive=None, fastopen=None,
+                 quickack=None, notsent_lowat=None):
+        self.nodelay = nodelay
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        # (idle, interval, count) seconds/probes
+        self.keepalive = keepalive
+        self.fastopen = fastopen
+        self.quickack = quickack
+        self.notsent_lowat = notsent_lowat
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__
+                if getattr(self, name) is not None}
+
+    def _set(self, sock, level, name, value):
+        if name is None:
+            return
+        try:
+            sock.setsockopt(level, name, value)
+        except OSError as e:
+            logger.debug("setsockopt {} {}={} failed: {}".format(level, name, value, e))
+
+    def apply_listener(self, sock: socket.socket):
+        """before bind/listen, accepted sockets inherit the buffer sizes"""
+        self._apply_buffers(sock)
+        if self.fastopen and sock.family in _TCP_FAMILIES:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN,
+                      1 if _DARWIN else int(self.fastopen))
+
+    def apply_before_connect(self, sock: socket.socket):
+        self._apply_buffers(sock)
+        if self.fastopen and sock.family in _TCP_FAMILIES:
+            self._set(sock, socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+
+    def apply(self, sock: socket.socket):
+        """on an accepted or connected socket"""
+        if sock.family not in _TCP_FAMILIES:
+            return
+        tcp = socket.IPPROTO_TCP
+        if self.nodelay is not None:
+            self._set(sock, tcp, socket.TCP_NODELAY, int(bool(self.nodelay)))
+        if self.quickack:
+            self._set(sock, tcp, TCP_QUICKACK, 1)
+        if self.notsent_lowat:
+            self._set(sock, tcp, TCP_NOTSENT_LOWAT, int(self.notsent_lowat))
+        if self.keepalive:
+            idle, interval, count = self.keepalive
+            self._set(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self._set(sock, tcp, TCP_KEEPIDLE, int(idle))
+            self._set(sock, tcp, TCP_KEEPINTVL, int(interval))
+            self._set(sock, tcp, TCP_KEEPCNT, int(count))
+
+    def _apply_buffers(self, sock):
+        if self.rcvbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.rcvbuf))
+        if self.sndbuf:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, int(self.sndbuf))
+
+    def __repr__(self):
+        return "<sockopts: {}>".format(self.to_dict())
+
+
+PROFILES = {
+    "default": SocketProfile(),
+    "interactive": SocketProfile(nodelay=True, quickack=True, notsent_lowat=16 * 1024,
+                                 keepalive=(60, 10, 5)),
+    "bulk": SocketProfile(nodelay=False, rcvbuf=4 * 1024 * 1024, sndbuf=4 * 1024 * 1024,
+                          notsent_lowat=128 * 1024, keepalive=(120, 30, 4)),
+}
+
+
+@functools.lru_cache(maxsize=128)
+def parse_profile(spec) -> SocketProfile:
+    """a name of PROFILES or "opt[=value],..." as described above"""
+    if spec in PROFILES:
+        return PROFILES[spec]
+
+    kwargs = {}
+    for item in spec.replace("+", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, sep, value = item.partition("=")
+        if name not in SocketProfile.__slots__:
+            raise ValueError("unknown socket option: {}".format(name))
+        if not sep:
+            kwargs[name] = (60, 10, 5) if name == "keepalive" else True
+        elif name == "keepalive":
+            parts = [int(v) for v in value.split(":")]
+            if len(parts) != 3:
+                raise ValueError("keepalive expects idle:interval:count")
+            kwargs[name] = tuple(parts)
+        elif name == "nodelay":
+            kwargs[name] = value.lower() not in ("0", "false", "no", "off")
+        else:
+            kwargs[name] = int(value)
+    return SocketProfile(**kwargs)
+
+
+def get_profile(value):
+    """SocketProfile from a profile, a spec or None"""
+    if value is None or isinstance(value, SocketProfile):
+        return value
+    return parse_profile(str(value))
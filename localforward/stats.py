@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import time
+import threading
+from collections import Counter
+
+
+class SessionStats(object):
+    """"""
+
+    __slots__ = ("sid", "client", "dest", "user", "started", "bytes_up", "bytes_down")
+
+    def __init__(self, sid, client):
+        self.sid = sid
+        self.client = "{}:{}".format(*client[:2]) if isinstance(client, tuple) else str(client)
+        self.dest = None
+        self.user = None
+        self.started = time.time()
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Stats(object):
+    """counters and live sessions of one server, read through snapshot()"""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.sessions = {}
+        # username -> [sessions, bytes up, bytes down] of closed sessions
+        self.users = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def open_session(self, sid, client):
+        stat = SessionStats(sid, client)
+        self.sessions[sid] = stat
+        self.incr("sessions_total")
+        return stat
+
+    def close_session(self, sid):
+        stat = self.sessions.pop(sid, None)
+        if stat is not None:
+            with self._lock:
+                self.counters["bytes_up"] += stat.bytes_up
+                self.counters["bytes_down"] += stat.bytes_down
+                if stat.user is not None:
+                    user = self.users.setdefault(stat.user, [0, 0, 0])
+                    user[0] += 1
+                    user[1] += stat.bytes_up
+                    user[2] += stat.bytes_down
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            users = {name: list(value) for name, value in self.users.items()}
+        sessions = [stat.to_dict() for stat in list(self.sessions.values())]
+        for item in sessions:
+            counters["bytes_up"] = counters.get("bytes_up", 0) + item["bytes_up"]
+            counters["bytes_down"] = counters.get("bytes_down", 0) + item["bytes_down"]
+        return {
+            "time": time.time(),
+            "counters": counters,
+            "sessions": sessions,
+            "users": users,
+        }
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Port-mapping table, one forward per line:
+
+    # listen            mode            targets                 options
+    127.0.0.1:2201      raw             10.0.0.5:22             priority=interactive
+    0.0.0.0:8443        raw             10.0.0.7:443,10.0.0.8:443  idle_timeout=600
+    127.0.0.1:1080      socks5
+    unix:/run/lf.sock   raw             unix:/run/app.sock
+
+Several targets of a raw forward are used round-robin, the next one is tried
+when a connect fails. Options are session options of that forward only, the
+values are converted to int/float when they look like numbers.
+"""
+from .address import parse_addr, is_unix, format_addr
+
+
+class ForwardEntry(object):
+    """"""
+
+    __slots__ = ("host", "port", "type", "targets", "options")
+
+    def __init__(self, host, port, type, targets=(), options=None):
+        # a unix listener has its path as host and None as port
+        self.host = host
+        self.port = port
+        self.type = type
+        self.targets = tuple(targets)
+        self.options = options or {}
+
+    @property
+    def name(self):
+        return format_addr(self.host if self.port is None else (self.host, self.port))
+
+    @property
+    def listen_host(self):
+        """the host argument of ForwordServer.add_forward"""
+        return format_addr(self.host) if self.port is None else self.host
+
+    def key(self):
+        """entries with the same key need no restart on reload"""
+        return self.host, self.port, self.type, self.targets, tuple(sorted(self.options.items()))
+
+    def __repr__(self):
+        return "<forward: {} {} {}>".format(self.name, self.type, ",".join(
+            format_addr(target) for target in self.targets) or "-")
+
+
+def _value(raw):
+    for kls in (int, float):
+        try:
+            return kls(raw)
+        except ValueError:
+            pass
+    return raw
+
+
+def parse_table(lines):
+    """ForwardEntry list, raises ValueError naming the bad line"""
+    entries = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) < 2:
+            raise ValueError("line {}: expect 'listen mode [targets] [key=value ...]'".format(lineno))
+
+        try:
+            listen = parse_addr(fields[0])
+            if is_unix(listen):
+                host, port = listen, None
+            else:
+                host, port = listen
+                host = host or "127.0.0.1"
+            targets, options = [], {}
+            for field in fields[2:]:
+                if "=" in field:
+                    key, _, value = field.partition("=")
+                    options[key] = _value(value)
+                else:
+                    targets.extend(parse_addr(t) for t in field.split(",") if t)
+        except (ValueError, TypeError) as e:
+            raise ValueError("line {}: {}".format(lineno, e))
+        entries.append(ForwardEntry(host, port, fields[1], targets, options))
+    return entries
+
+
+def load_table(path):
+    with open(path) as f:
+        return parse_table(f)
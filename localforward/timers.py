@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Hierarchical timer wheel shared by all sessions.
+
+Timers are hashed into wheel slots by expiry tick: 256 slots of one tick,
+then 64 slots of 256 ticks and 64 slots of 16384 ticks, cascading down as
+time moves on. Scheduling and cancelling are O(1). `Timer.reset` only
+moves the deadline forward and does not touch the wheel; when the old slot
+comes up the timer is simply re-hashed, which makes per-chunk idle resets
+as cheap as an attribute write. A single thread drives the wheel and
+sleeps while there is nothing to expire.
+"""
+import math
+import time
+import threading
+import traceback
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+_LEVELS = ((256, 0), (64, 8), (64, 14))
+# in ticks
+_EPSILON = 1e-6
+
+
+class Timer(object):
+    """"""
+
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def reset(self, delay):
+        """push the deadline to delay seconds from now (never earlier)"""
+        self.deadline = time.monotonic() + delay
+
+    def cancel(self):
+        self.cancelled = True
+        # the slot keeps the timer until it comes up, not what it would call
+        self.callback = None
+
+
+class TimerWheel(object):
+    """"""
+
+    def __init__(self, tick=0.1):
+        self.tick = tick
+        self._start = time.monotonic()
+        self._current = 0
+        self._wheels = [[[] for _ in range(size)] for size, _ in _LEVELS]
+        self._counts = [0] * len(_LEVELS)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._working = False
+
+    def schedule(self, delay, callback) -> Timer:
+        """call callback() from the wheel thread after delay seconds"""
+        timer = Timer(time.monotonic() + delay, callback)
+        with self._cond:
+            self._insert(timer)
+            self._cond.notify()
+        self._ensure_thread()
+        return timer
+
+    def _tick_of(self, deadline):
+        """the first tick at or after deadline, float noise aside"""
+        return int(math.ceil((deadline - self._start) / self.tick - _EPSILON))
+
+    def _insert(self, timer):
+        expiry = max(self._tick_of(timer.deadline), self._current + 1)
+        diff = expiry - self._current
+        for level, (size, shift) in enumerate(_LEVELS):
+            if diff < (size << shift) or level == len(_LEVELS) - 1:
+                if diff >= (size << shift):
+                    # beyond the wheel, park in the farthest slot and re-hash later
+                    expiry = self._current + ((size - 1) << shift)
+                self._wheels[level][(expiry >> shift) % size].append(timer)
+                self._counts[level] += 1
+                return
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._working = True
+            self._thread = threading.Thread(target=self._run, name="timer-wheel")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._working = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _next_wakeup(self):
+        """monotonic time of the next tick worth waking up for"""
+        if self._counts[0]:
+            tick = self._current + 1
+        elif any(self._counts):
+            # nothing on the first level, sleep until the next cascade
+            size = _LEVELS[0][0]
+            tick = (self._current // size + 1) * size
+        else:
+            return None
+        return self._start + tick * self.tick
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._working:
+                    wakeup = self._next_wakeup()
+                    now = time.monotonic()
+                    if wakeup is not None and wakeup <= now:
+                        break
+                    self._cond.wait(None if wakeup is None else wakeup - now)
+                if not self._working:
+                    return
+                expired = self._advance(time.monotonic())
+
+            for timer in expired:
+                callback = timer.callback
+                if callback is None:
+                    continue
+                try:
+                    callback()
+                except Exception:
+                    logger.warn("timer callback error: {}".format(traceback.format_exc()))
+
+    def _advance(self, now):
+        """move the wheel up to now, returns the timers to fire"""
+        expired = []
+        # only ticks that have fully passed, timers never fire early
+        target = int((now - self._start) / self.tick + _EPSILON) if now > self._start else 0
+        while self._current < target:
+            self._current += 1
+            cur = self._current
+            for level in range(len(_LEVELS) - 1, 0, -1):
+                size, shift = _LEVELS[level]
+                if cur % (1 << shift) == 0:
+                    self._cascade(level, (cur >> shift) % size)
+
+            size0 = _LEVELS[0][0]
+            slot = self._wheels[0][cur % size0]
+            if not slot:
+                continue
+            self._wheels[0][cur % size0] = []
+            self._counts[0] -= len(slot)
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                if self._tick_of(timer.deadline) > cur:
+                    self._insert(timer)
+                else:
+                    expired.append(timer)
+        return expired
+
+    def _cascade(self, level, index):
+        slot = self._wheels[level][index]
+        if not slot:
+            return
+        self._wheels[level][index] = []
+        self._counts[level] -= len(slot)
+        for timer in slot:
+            if not timer.cancelled:
+                self._insert(timer)
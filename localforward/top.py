@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""`localforward top`: live view of a running server over its control socket"""
+import time
+
+from . import outils
+from .control import ControlClient
+
+
+def _human(n):
+    for unit in ("B", "K", "M", "G"):
+        if abs(n) < 1024:
+            return "{:.1f}{}".format(n, unit)
+        n /= 1024.0
+    return "{:.1f}T".format(n)
+
+
+def _rates(prev, cur):
+    """bytes/sec per session and per destination between two snapshots"""
+    elapsed = max(cur["time"] - prev["time"], 1e-6) if prev else None
+    before = {s["sid"]: s for s in prev["sessions"]} if prev else {}
+
+    sessions = []
+    dests = {}
+    for s in cur["sessions"]:
+        old = before.get(s["sid"])
+        if elapsed and old:
+            up = (s["bytes_up"] - old["bytes_up"]) / elapsed
+            down = (s["bytes_down"] - old["bytes_down"]) / elapsed
+        elif elapsed:
+            up = s["bytes_up"] / elapsed
+            down = s["bytes_down"] / elapsed
+        else:
+            up = down = 0.0
+        sessions.append((up + down, up, down, s))
+
+        dest = dests.setdefault(s["dest"] or "-", [0, 0.0, 0.0])
+        dest[0] += 1
+        dest[1] += up
+        dest[2] += down
+
+    sessions.sort(key=lambda item: item[0], reverse=True)
+    dests = sorted(dests.items(), key=lambda item: item[1][1] + item[1][2], reverse=True)
+    return sessions, dests
+
+
+def render(prev, cur, rows=24):
+    sessions, dests = _rates(prev, cur)
+    pool = cur.get("pool", {})
+    counters = cur["counters"]
+
+    busy, size = pool.get("busy", 0), pool.get("size", 0) or 1
+    usage = "{}/{}".format(busy, size)
+    usage = outils.red(usage) if busy >= size else outils.green(usage)
+
+    lines = [
+        outils.bright("localforward top") + "  {}".format(time.strftime("%H:%M:%S")),
+        "sessions: {}  total: {}  workers busy: {}  queue: {}  up: {}  down: {}".format(
+            len(cur["sessions"]), counters.get("sessions_total", 0), usage,
+            pool.get("queue", 0), _human(counters.get("bytes_up", 0)),
+            _human(counters.get("bytes_down", 0))),
+    ]
+    quota = cur.get("quota")
+    if quota:
+        qc = quota["counters"]
+        rejected = qc.get("rejected_sessions", 0) + qc.get("rejected_rate", 0)
+        lines.append("clients: {}  quota rejected: {}".format(
+            quota["clients"], outils.red(str(rejected)) if rejected else 0))
+    shed = counters.get("sessions_shed", 0)
+    shedder = cur.get("shedder") or {}
+    if shed or shedder.get("overloaded"):
+        state = outils.red("overloaded") if shedder.get("overloaded") else "ok"
+        lines.append("load: {}  shed: {}".format(state, shed))
+    lines.append("")
+
+    budget = max(rows - len(lines) - 6, 4)
+    dest_rows = min(len(dests), budget // 3)
+    lines.append(outils.bright("{:<40}{:>8}{:>12}{:>12}".format(
+        "DESTINATION", "SESS", "UP/s", "DOWN/s")))
+    for dest, (count, up, down) in dests[:dest_rows]:
+        lines.append("{:<40}{:>8}{:>12}{:>12}".format(
+            dest[:39], count, _human(up), _human(down)))
+    lines.append("")
+
+    lines.append(outils.bright("{:>8}  {:<22}{:<30}{:>10}{:>10}{:>8}".format(
+        "SID", "CLIENT", "DEST", "UP/s", "DOWN/s", "AGE")))
+    now = cur["time"]
+    for _, up, down, s in sessions[:budget - dest_rows]:
+        line = "{:>8}  {:<22}{:<30}{:>10}{:>10}{:>7.0f}s".format(
+            s["sid"], s["client"][:21], (s["dest"] or "-")[:29],
+            _human(up), _human(down), now - s["started"])
+        lines.append(outils.yellow(line) if up + down > 0 else line)
+    return lines
+
+
+def run(path, interval=1.0):
+    client = ControlClient(path)
+    prev = None
+    try:
+        while True:
+            cur = client.call("stats")
+            size = outils.get_stty_size()
+            rows = int(size[0]) if size else 24
+
+            outils.clear_screen()
+            for line in render(prev, cur, rows):
+                outils.println(line)
+            outils.lastline(outils.dim("refresh every {}s, ctrl-c to quit".format(interval)))
+
+            prev = cur
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        outils.println()
+    finally:
+        client.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Session flight recorder.
+
+Every session carries a `SessionTrace` collecting a monotonic timestamp per
+lifecycle phase. When the session closes the trace is packed into one
+fixed-size record of the recorder ring, so the recorder never grows and a
+dump is a plain copy of the ring. `summarize` turns a dump back into
+per-phase latency percentiles.
+"""
+import time
+import struct
+import itertools
+
+PHASE_ACCEPT = 0
+PHASE_ENQUEUE = 1
+PHASE_PICKUP = 2
+PHASE_GREETING = 3
+PHASE_REQUEST = 4
+PHASE_CONNECTED = 5
+PHASE_FIRST_UP = 6
+PHASE_FIRST_DOWN = 7
+PHASE_CLOSE = 8
+
+PHASES = [
+    "accept", "enqueue", "pickup", "greeting", "request",
+    "connected", "first_up", "first_down", "close",
+]
+
+# (name, from phase, to phase) reported by summarize
+INTERVALS = [
+    ("accept", PHASE_ACCEPT, PHASE_ENQUEUE),
+    ("queue", PHASE_ENQUEUE, PHASE_PICKUP),
+    ("greeting", PHASE_PICKUP, PHASE_GREETING),
+    ("request", PHASE_GREETING, PHASE_REQUEST),
+    ("connect", PHASE_REQUEST, PHASE_CONNECTED),
+    ("first_up", PHASE_CONNECTED, PHASE_FIRST_UP),
+    ("first_down", PHASE_CONNECTED, PHASE_FIRST_DOWN),
+    ("total", PHASE_ACCEPT, PHASE_CLOSE),
+]
+
+MAGIC = b"LFTRC001"
+
+# magic, record size, capacity, records written
+_DUMP_HDR = struct.Struct("<8sIIQ")
+# sid, wall clock of accept, dest port, client port, microseconds since
+# accept for each phase after accept (-1: phase not reached)
+_RECORD = struct.Struct("<QdHH{}i".format(len(PHASES) - 1))
+
+
+class SessionTrace(object):
+    """"""
+
+    __slots__ = ("sid", "client_port", "dest_port", "accepted", "marks")
+
+    def __init__(self, sid=0, client_port=0, accepted=None):
+        self.sid = sid
+        self.client_port = client_port
+        self.dest_port = 0
+        self.accepted = time.time()
+        self.marks = [None] * len(PHASES)
+        self.marks[PHASE_ACCEPT] = accepted if accepted is not None else time.monotonic()
+
+    def mark(self, phase, ts=None):
+        """the first mark of a phase wins"""
+        if self.marks[phase] is None:
+            self.marks[phase] = ts if ts is not None else time.monotonic()
+
+    def pack(self):
+        start = self.marks[PHASE_ACCEPT]
+        deltas = [-1 if ts is None else min(int((ts - start) * 1e6), 0x7fffffff)
+                  for ts in self.marks[1:]]
+        return _RECORD.pack(self.sid, self.accepted, self.dest_port & 0xffff,
+                            self.client_port & 0xffff, *deltas)
+
+
+class _NullTrace(object):
+    """trace used when no recorder is configured"""
+
+    __slots__ = ()
+    sid = 0
+    dest_port = 0
+
+    def mark(self, phase, ts=None):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+
+class FlightRecorder(object):
+    """"""
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._buf = bytearray(capacity * _RECORD.size)
+        self._seq = itertools.count()
+        self._written = 0
+
+    def begin(self, sid, addr, accepted=None):
+        return SessionTrace(sid, addr[1] if addr else 0, accepted)
+
+    def commit(self, trace: SessionTrace):
+        if not isinstance(trace, SessionTrace):
+            return
+        trace.mark(PHASE_CLOSE)
+        seq = next(self._seq)
+        off = (seq % self.capacity) * _RECORD.size
+        self._buf[off:off + _RECORD.size] = trace.pack()
+        self._written = max(self._written, seq + 1)
+
+    def dumps(self):
+        return _DUMP_HDR.pack(MAGIC, _RECORD.size, self.capacity, self._written) + bytes(self._buf)
+
+    def dump(self, path):
+        with open(path, "wb") as f:
+            f.write(self.dumps())
+        return path
+
+
+def load(raw: bytes):
+    """decode a dump into [{"sid":..., "accepted":..., "phases": [...]}, ...]"""
+    magic, size, capacity, written = _DUMP_HDR.unpack_from(raw, 0)
+    if magic != MAGIC or size != _RECORD.size:
+        raise ValueError("not a localforward trace dump")
+
+    count = min(written, capacity)
+    first = written - count
+    records = []
+    for seq in range(first, written):
+        off = _DUMP_HDR.size + (seq % capacity) * size
+        sid, accepted, dest_port, client_port, *deltas = _RECORD.unpack_from(raw, off)
+        phases = [0.0] + [None if d < 0 else d / 1e6 for d in deltas]
+        records.append({
+            "sid": sid,
+            "accepted": accepted,
+            "client_port": client_port,
+            "dest_port": dest_port,
+            "phases": phases,
+        })
+    return records
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    idx = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+def summarize(records, top=5):
+    """percentiles in milliseconds per interval, plus the slowest sessions"""
+    lines = ["{:<12}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+        "interval", "count", "p50", "p90", "p99", "max")]
+    for name, a, b in INTERVALS:
+        values = sorted(r["phases"][b] - r["phases"][a] for r in records
+                        if r["phases"][a] is not None and r["phases"][b] is not None)
+        cols = [_percentile(values, p) for p in (50, 90, 99, 100)]
+        lines.append("{:<12}{:>8}".format(name, len(values)) + "".join(
+            "{:>10}".format("-" if v is None else "{:.2f}".format(v * 1e3)) for v in cols))
+
+    slowest = sorted(records, key=lambda r: r["phases"][PHASE_CLOSE] or 0, reverse=True)[:top]
+    if slowest:
+        lines.append("")
+        lines.append("slowest sessions (ms since accept):")
+        for r in slowest:
+            marks = " ".join("{}={:.2f}".format(PHASES[i], ts * 1e3)
+                             for i, ts in enumerate(r["phases"]) if ts is not None and i)
+            lines.append("  #{} port:{} {}".format(r["sid"], r["dest_port"], marks))
+    return "\n".join(lines)
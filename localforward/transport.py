@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Transports under the sessions.
+
+Sessions only use a small part of the socket API on their connections:
+recv/recv_into (with MSG_PEEK), send/sendall, shutdown/close, setblocking/
+settimeout, getpeername/getsockname, setsockopt and `family`. Anything that
+has those can be handed to a session as conn, and options["connector"], a
+callable (addr, timeout) -> transport, replaces the upstream connect.
+
+`MemoryTransport` is such a thing without the kernel: `memory_pair()` gives
+two connected ends. Faults are injected on the sending side:
+
+    latency       seconds before sent bytes can be read
+    bandwidth     bytes/sec, later sends queue behind earlier ones
+    max_read      at most this many bytes per recv, to exercise short reads
+    reset_after   bytes sent before the connection is reset
+
+It has no file descriptor, the kqueue relay engine cannot poll it; it is
+for handshakes, protocol edge cases and simulations.
+"""
+import time
+import socket
+import itertools
+import threading
+from collections import deque
+
+from .address import is_unix
+
+
+class _Channel(object):
+    """bytes in flight in one direction"""
+
+    def __init__(self, latency=0, bandwidth=None, max_read=None, reset_after=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_read = max_read
+        self.reset_after = reset_after
+        # (readable at, bytes)
+        self.chunks = deque()
+        self.sent = 0
+        self.busy_until = 0
+        self.eof = False
+        self.reset = False
+        self.cond = threading.Condition()
+
+    def put(self, data):
+        with self.cond:
+            if self.reset:
+                raise ConnectionResetError("connection reset (simulated)")
+            if self.eof:
+                raise BrokenPipeError("send after shutdown")
+            if self.reset_after is not None and self.sent + len(data) > self.reset_after:
+                data = data[:self.reset_after - self.sent]
+                self.reset = True
+            now = time.monotonic()
+            ready_at = now
+            if self.bandwidth:
+                self.busy_until = max(self.busy_until, now) + len(data) / float(self.bandwidth)
+                ready_at = self.busy_until
+            if data:
+                self.chunks.append((ready_at + self.latency, bytes(data)))
+                self.sent += len(data)
+            self.cond.notify_all()
+            return len(data)
+
+    def take(self, n, peek=False, timeout=None):
+        """up to n readable bytes, b"" at eof. timeout 0 is non-blocking, None waits"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.chunks and self.chunks[0][0] <= now:
+                    break
+                if self.reset and not self.chunks:
+                    raise ConnectionResetError("connection reset (simulated)")
+                if self.eof and not self.chunks:
+                    return b""
+                wait = self.chunks[0][0] - now if self.chunks else None
+                if deadline is not None:
+                    left = deadline - now
+                    if left <= 0:
+                        if timeout == 0:
+                            raise BlockingIOError("no data ready")
+                        raise socket.timeout("timed out")
+                    wait = left if wait is None else min(wait, left)
+                self.cond.wait(wait)
+
+            if self.max_read:
+                n = min(n, self.max_read)
+            out = []
+            size = 0
+            for ready_at, chunk in self.chunks:
+                if ready_at > now or size >= n:
+                    break
+                out.append(chunk[:n - size])
+                size += len(out[-1])
+            data = b"".join(out)
+            if not peek:
+                left = size
+                while left:
+                    ready_at, chunk = self.chunks.popleft()
+                    if len(chunk) > left:
+                        self.chunks.appendleft((ready_at, chunk[left:]))
+                        break
+                    left -= len(chunk)
+            return data
+
+    def close(self, reset=False):
+        with self.cond:
+            self.eof = True
+            if reset:
+                self.reset = True
+                self.chunks.clear()
+            self.cond.notify_all()
+
+
+class MemoryTransport(object):
+    """one end of a memory_pair, quacks like a connected stream socket"""
+
+    type = socket.SOCK_STREAM
+
+    def __init__(self, inbound: _Channel, outbound: _Channel, local, remote):
+        self._in = inbound
+        self._out = outbound
+        self._local = local
+        self._remote = remote
+        self.family = socket.AF_UNIX if is_unix(local) else socket.AF_INET
+        self._timeout = None
+        self._closed = False
+
+    def fileno(self):
+        return -1
+
+    def getsockname(self):
+        return self._local
+
+    def getpeername(self):
+        if self._closed:
+            raise OSError("transport is closed")
+        return self._remote
+
+    def setblocking(self, flag):
+        self._timeout = None if flag else 0
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def setsockopt(self, *args):
+        pass
+
+    def getsockopt(self, *args):
+        return 0
+
+    def recv(self, n, flags=0):
+        if self._closed:
+            raise OSError("transport is closed")
+        return self._in.take(n, bool(flags & socket.MSG_PEEK), self._timeout)
+
+    def recv_into(self, buf, n=0, flags=0):
+        data = self.recv(n or len(buf), flags)
+        buf[:len(data)] = data
+        return len(data)
+
+    def send(self, data):
+        if self._closed:
+            raise OSError("transport is closed")
+        return self._out.put(data)
+
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            sent = self.send(view)
+            if not sent:
+                raise ConnectionResetError("connection reset (simulated)")
+            view = view[sent:]
+
+    def shutdown(self, how):
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            self._out.close()
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            self._in.close()
+
+    def reset(self):
+        """abort both directions, like a RST from the peer"""
+        self._in.close(reset=True)
+        self._out.close(reset=True)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._out.close()
+            self._in.close()
+
+    def __repr__(self):
+        return "<memory-transport {} -> {}>".format(self._local, self._remote)
+
+
+def memory_pair(local=("127.0.0.1", 40000), remote=("127.0.0.1", 1080), latency=0,
+                bandwidth=None, max_read=None, reset_after=None):
+    """(local end, remote end), faults apply in both directions"""
+    faults = dict(latency=latency, bandwidth=bandwidth, max_read=max_read, reset_after=reset_after)
+    a_to_b, b_to_a = _Channel(**faults), _Channel(**faults)
+    return (MemoryTransport(b_to_a, a_to_b, local, remote),
+            MemoryTransport(a_to_b, b_to_a, remote, local))
+
+
+class MemoryNetwork(object):
+    """
+    a connector for options["connector"]: connecting to addr gives a memory
+    transport whose other end is passed to the backend registered for addr
+    """
+
+    def __init__(self, **faults):
+        self.faults = faults
+        self._backends = {}
+        self._ports = itertools.count()
+
+    def listen(self, addr, backend):
+        """backend(transport) is called with the server end of each connection"""
+        self._backends[addr] = backend
+
+    def __call__(self, addr, timeout=None):
+        backend = self._backends.get(addr) or self._backends.get("*")
+        if backend is None:
+            raise ConnectionRefusedError("nothing listens on {}".format(addr))
+        local = ("127.0.0.1", 40000 + next(self._ports) % 25000)
+        client, server = memory_pair(local, addr, **self.faults)
+        backend(server)
+        return client
@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+# coding:utf-8
+"""
+Multiplexed tunnel between two localforward instances.
+
+A tunnel client carries the upstream connections of its sessions as logical
+streams over a few persistent TCP connections to a tunnel server, which
+connects to the real destinations. Both ends run the same `Mux`.
+
+Every frame is
+
+    +------+-------+-----------+--------+---------+
+    | TYPE | FLAGS | STREAM ID | LENGTH | PAYLOAD |
+    +------+-------+-----------+--------+---------+
+    |  1   |   1   |     4     |   4    | LENGTH  |
+    +------+-------+-----------+--------+---------+
+
+OPEN carries the receive window of the opener, the port and the host,
+OPENED the receive window of the other side. A side never sends more DATA
+than the window its peer granted; WINDOW frames hand credit back once data
+has been written to the local socket. DATA payloads may be zlib compressed
+(FLAGS & FLAG_ZLIB), windows always count uncompressed bytes. No frame
+carries more than MAX_FRAME bytes, compressed or not.
+
+When the server wants a login, the client's first frame is AUTH on stream 0
+with "username\0password"; the server answers a bad one with CLOSE on
+stream 0 and hangs up. Stream ids are 32 bits, a mux that used them up
+takes no new streams and goes once its last one closes.
+
+Frames of all streams queue up in one buffer and go out with a single send
+per loop turn, so small writes of many sessions share packets.
+"""
+import zlib
+import socket
+import select
+import struct
+import itertools
+import threading
+import traceback
+from collections import deque
+
+from . import outils
+
+logger = outils.get_logger("localforward")
+
+FRAME_OPEN = 1
+FRAME_OPENED = 2
+FRAME_DATA = 3
+FRAME_WINDOW = 4
+FRAME_CLOSE = 5
+FRAME_AUTH = 6
+
+FLAG_ZLIB = 1
+
+_HEADER = struct.Struct("!BBII")
+_OPEN = struct.Struct("!IH")
+_WINDOW = struct.Struct("!I")
+
+MAX_FRAME = 64 * 1024
+WINDOW = 256 * 1024
+COMPRESS_MIN = 128
+MAX_STREAM_ID = 0xffffffff
+
+
+class TunnelError(ConnectionError):
+    pass
+
+
+def pack_frame(ftype, sid, payload=b"", flags=0) -> bytes:
+    return _HEADER.pack(ftype, flags, sid, len(payload)) + payload
+
+
+def read_frame(sock: socket.socket):
+    """(type, stream id, payload) of one frame from a blocking socket, for handshakes"""
+    ftype, flags, sid, length = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    if length > MAX_FRAME or flags:
+        raise TunnelError("bad frame: type {} length {}".format(ftype, length))
+    return ftype, sid, _recv_exact(sock, length)
+
+
+def _recv_exact(sock, n) -> bytes:
+    data = b""
+    while len(data) < n:
+        more = sock.recv(n - len(data))
+        if not more:
+            raise TunnelError("tunnel closed by peer")
+        data += more
+    return data
+
+
+def _inflate(payload) -> bytes:
+    """a compressed DATA payload, refusing anything that inflates past MAX_FRAME"""
+    inflater = zlib.decompressobj()
+    try:
+        data = inflater.decompress(payload, MAX_FRAME)
+    except zlib.error as e:
+        raise TunnelError("bad compressed frame: {}".format(e))
+    if inflater.unconsumed_tail or not inflater.eof:
+        raise TunnelError("compressed frame is larger than {} bytes".format(MAX_FRAME))
+    return data
+
+
+def _spawn(func, args=()):
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+
+
+class _Stream(object):
+    """"""
+
+    __slots__ = ("sid", "sock", "send_window", "outq", "unacked", "attached",
+                 "remote_closed", "ready", "error")
+
+    def __init__(self, sid, sock=None, send_window=0):
+        self.sid = sid
+        self.sock = sock
+        self.send_window = send_window
+        self.outq = deque()
+        self.unacked = 0
+        self.attached = False
+        self.remote_closed = False
+        self.ready = None
+        self.error = None
+
+
+class Mux(object):
+    """
+    one tunnel connection. on_open(host, port) returns a connected socket for
+    streams opened by the peer, it runs through executor(func, args) since it
+    blocks. without on_open the peer cannot open streams. on_stream_close(sock)
+    is called for every socket on_open returned, before it is closed.
+    """
+
+    def __init__(self, sock: socket.socket, initiator=True, on_open=None, executor=None,
+                 compress=False, window=WINDOW):
+        self.sock = sock
+        self.on_open = on_open
+        self.executor = executor or _spawn
+        self.compress = compress
+        self.window = window
+        self.on_close = None
+        self.on_stream_close = None
+
+        # ids of each side never collide: odd for the initiator
+        self._ids = itertools.count(1 if initiator else 2, 2)
+        self._streams = {}
+        self._fds = {}
+        self._filters = set()
+        self._inbuf = bytearray()
+        self._outbuf = bytearray()
+        self._calls = deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._kq = None
+        self._thread = None
+        self._working = False
+        # set once the stream ids ran out, no new streams
+        self._retired = False
+        # why the peer closed the whole tunnel, if it said so
+        self._reason = None
+
+    def __len__(self):
+        return len(self._streams)
+
+    @property
+    def alive(self):
+        return self._working and not self._retired
+
+    def start(self):
+        self.sock.setblocking(False)
+        self._kq = select.kqueue()
+        self._want(self._wake_r.fileno(), select.KQ_FILTER_READ, True)
+        self._want(self.sock.fileno(), select.KQ_FILTER_READ, True)
+        self._working = True
+        self._thread = threading.Thread(target=self._run, name="tunnel-mux")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._working = False
+        self._wakeup()
+
+    def join(self, timeout=None):
+        """wait for the mux thread to close everything, after close()"""
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def open(self, host, port, timeout=None) -> socket.socket:
+        """
+        open a stream to host:port on the peer, returns a local socket
+        connected to it. raises TunnelError if the peer refuses.
+        """
+        if not self.alive:
+            raise TunnelError("tunnel is closed")
+        sid = next(self._ids)
+        if sid > MAX_STREAM_ID:
+            raise TunnelError("stream ids of this tunnel are used up")
+        if sid + 2 > MAX_STREAM_ID:
+            self._call(self._retire)
+        local, remote = socket.socketpair()
+        stream = _Stream(sid, remote)
+        stream.ready = threading.Event()
+        self._call(self._start_open, stream, host, port)
+        if not stream.ready.wait(timeout):
+            self._call(self._drop, stream, True)
+            local.close()
+            raise socket.timeout("open {}:{} over tunnel timed out".format(host, port))
+        if stream.error:
+            local.close()
+            raise TunnelError(stream.error)
+        return local
+
+    def _call(self, func, *args):
+        """run func(*args) on the mux thread"""
+        self._calls.append((func, args))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wake_w.send(b"\x00")
+        except OSError:
+            # full, or closed by the mux thread already
+            pass
+
+    def _want(self, fd, kind, on):
+        """keep the kqueue registration of (fd, kind) as wanted"""
+        key = (fd, kind)
+        if on == (key in self._filters):
+            return
+        flags = select.KQ_EV_ADD if on else select.KQ_EV_DELETE
+        try:
+            self._kq.control([select.kevent(fd, kind, flags)], 0)
+        except OSError:
+            pass
+        if on:
+            self._filters.add(key)
+        else:
+            self._filters.discard(key)
+
+    def _run(self):
+        try:
+            while self._working:
+                self._once()
+        except Exception:
+            logger.warn("tunnel error: {}".format(traceback.format_exc()))
+        finally:
+            self._shutdown()
+
+    def _once(self):
+        for ev in self._kq.control(None, 256, None):
+            fd = ev.ident
+            if fd == self._wake_r.fileno():
+                self._drain_calls()
+            elif fd == self.sock.fileno():
+                if ev.filter == select.KQ_FILTER_READ:
+                    self._read_tunnel()
+                else:
+                    self._flush_tunnel()
+            else:
+                stream = self._fds.get(fd)
+                if stream is None:
+                    continue
+                if ev.filter == select.KQ_FILTER_READ:
+                    self._read_local(stream)
+                else:
+                    self._flush_local(stream)
+        self._flush_tunnel()
+
+    def _drain_calls(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            func, args = self._calls.popleft()
+            func(*args)
+
+    def _retire(self):
+        self._retired = True
+        if not self._streams:
+            self._working = False
+
+    def _shutdown(self):
+        self._working = False
+        for stream in list(self._streams.values()):
+            self._drop(stream, False)
+            if stream.ready is not None and not stream.ready.is_set():
+                stream.error = self._reason or "tunnel is closed"
+                stream.ready.set()
+        self._kq.close()
+        self.sock.close()
+        self._wake_r.close()
+        self._wake_w.close()
+        if self.on_close:
+            self.on_close()
+
+    # frames out
+
+    def _send(self, ftype, sid, payload=b""):
+        flags = 0
+        if ftype == FRAME_DATA and self.compress and len(payload) >= COMPRESS_MIN:
+            packed = zlib.compress(payload, 1)
+            if len(packed) < len(payload):
+                payload, flags = packed, FLAG_ZLIB
+        self._outbuf += pack_frame(ftype, sid, payload, flags)
+
+    def _flush_tunnel(self):
+        if self._outbuf:
+            try:
+                sent = self.sock.send(self._outbuf)
+                del self._outbuf[:sent]
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._working = False
+                return
+        self._want(self.sock.fileno(), select.KQ_FILTER_WRITE, bool(self._outbuf))
+
+    # frames in
+
+    def _read_tunnel(self):
+        try:
+            data = self.sock.recv(MAX_FRAME + _HEADER.size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._working = False
+            return
+
+        buf = self._inbuf
+        buf += data
+        pos = 0
+        while len(buf) - pos >= _HEADER.size:
+            ftype, flags, sid, length = _HEADER.unpack_from(buf, pos)
+            if length > MAX_FRAME:
+                self._broken("frame of {} bytes".format(length))
+                return
+            end = pos + _HEADER.size + length
+            if len(buf) < end:
+                break
+            payload = bytes(buf[pos + _HEADER.size:end])
+            pos = end
+            try:
+                if flags & FLAG_ZLIB:
+                    payload = _inflate(payload)
+                self._on_frame(ftype, sid, payload)
+            except (TunnelError, struct.error) as e:
+                self._broken(e)
+                return
+        del buf[:pos]
+
+    def _broken(self, reason):
+        """the peer does not speak the protocol, drop the whole tunnel"""
+        logger.warn("tunnel protocol error: {}".format(reason))
+        self._inbuf.clear()
+        self._working = False
+
+    def _on_frame(self, ftype, sid, payload):
+        stream = self._streams.get(sid)
+        if ftype == FRAME_OPEN:
+            if stream is not None or not sid:
+                raise TunnelError("stream {} opened twice".format(sid))
+            window, port = _OPEN.unpack_from(payload)
+            host = payload[_OPEN.size:].decode("utf-8", "replace")
+            stream = self._streams[sid] = _Stream(sid, send_window=window)
+            if self.on_open is None:
+                self._send(FRAME_CLOSE, sid, b"opening streams is not allowed")
+                del self._streams[sid]
+                return
+            self.executor(self._connect, (stream, host, port))
+        elif stream is None:
+            if ftype == FRAME_CLOSE and not sid:
+                self._reason = payload.decode("utf-8", "replace")
+                logger.warn("tunnel closed by peer: {}".format(self._reason))
+            return
+        elif ftype == FRAME_OPENED:
+            stream.send_window = _WINDOW.unpack(payload)[0]
+            self._attach(stream)
+            stream.ready.set()
+        elif ftype == FRAME_DATA:
+            stream.outq.append(payload)
+            self._flush_local(stream)
+        elif ftype == FRAME_WINDOW:
+            stream.send_window += _WINDOW.unpack(payload)[0]
+            self._update_read(stream)
+        elif ftype == FRAME_CLOSE:
+            stream.remote_closed = True
+            if stream.ready is not None and not stream.ready.is_set():
+                stream.error = payload.decode("utf-8", "replace") or "refused by peer"
+                self._drop(stream, False)
+                stream.ready.set()
+            elif not stream.outq:
+                self._drop(stream, False)
+
+    # streams
+
+    def _start_open(self, stream, host, port):
+        if not self._working:
+            stream.error = "tunnel is closed"
+            stream.ready.set()
+            return
+        self._streams[stream.sid] = stream
+        self._send(FRAME_OPEN, stream.sid, _OPEN.pack(self.window, port) + host.encode())
+
+    def _connect(self, stream, host, port):
+        """on an executor thread"""
+        try:
+            sock = self.on_open(host, port)
+        except Exception as e:
+            self._call(self._refuse, stream, "{}:{} {}".format(host, port, e))
+            return
+        self._call(self._accepted, stream, sock)
+
+    def _refuse(self, stream, reason):
+        if self._streams.get(stream.sid) is stream:
+            self._send(FRAME_CLOSE, stream.sid, reason.encode())
+            del self._streams[stream.sid]
+
+    def _accepted(self, stream, sock):
+        if self._streams.get(stream.sid) is not stream:
+            # closed by the peer meanwhile
+            self._close_sock(sock)
+            return
+        stream.sock = sock
+        self._send(FRAME_OPENED, stream.sid, _WINDOW.pack(self.window))
+        self._attach(stream)
+        self._flush_local(stream)
+
+    def _attach(self, stream):
+        stream.sock.setblocking(False)
+        stream.attached = True
+        self._fds[stream.sock.fileno()] = stream
+        self._update_read(stream)
+
+    def _update_read(self, stream):
+        if stream.attached:
+            self._want(stream.sock.fileno(), select.KQ_FILTER_READ, stream.send_window > 0)
+
+    def _read_local(self, stream):
+        size = min(stream.send_window, MAX_FRAME)
+        if not size:
+            self._update_read(stream)
+            return
+        try:
+            data = stream.sock.recv(size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(stream, True)
+            return
+        stream.send_window -= len(data)
+        self._send(FRAME_DATA, stream.sid, data)
+        if not stream.send_window:
+            self._update_read(stream)
+
+    def _flush_local(self, stream):
+        if not stream.attached:
+            return
+        delivered = 0
+        try:
+            while stream.outq:
+                chunk = stream.outq[0]
+                sent = stream.sock.send(chunk)
+                delivered += sent
+                if sent < len(chunk):
+                    stream.outq[0] = chunk[sent:]
+                    break
+                stream.outq.popleft()
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(stream, True)
+            return
+
+        stream.unacked += delivered
+        if stream.unacked >= self.window // 2 or (stream.unacked and not stream.outq):
+            self._send(FRAME_WINDOW, stream.sid, _WINDOW.pack(stream.unacked))
+            stream.unacked = 0
+        if stream.outq:
+            self._want(stream.sock.fileno(), select.KQ_FILTER_WRITE, True)
+        else:
+            self._want(stream.sock.fileno(), select.KQ_FILTER_WRITE, False)
+            if stream.remote_closed:
+                self._drop(stream, False)
+
+    def _drop(self, stream, notify):
+        if self._streams.get(stream.sid) is stream:
+            del self._streams[stream.sid]
+            if notify and self._working:
+                self._send(FRAME_CLOSE, stream.sid)
+            if self._retired and not self._streams:
+                self._working = False
+        if stream.sock is None:
+            return
+        if stream.attached:
+            fd = stream.sock.fileno()
+            self._want(fd, select.KQ_FILTER_READ, False)
+            self._want(fd, select.KQ_FILTER_WRITE, False)
+            self._fds.pop(fd, None)
+            stream.attached = False
+        self._close_sock(stream.sock)
+
+    def _close_sock(self, sock):
+        if self.on_stream_close is not None:
+            self.on_stream_close(sock)
+        sock.close()
+
+
+class TunnelClient(object):
+    """
+    keeps up to `connections` muxes to a tunnel server and spreads new
+    streams over them, least loaded first. dead muxes are replaced on demand.
+    username and password log in to a server that wants it.
+    """
+
+    def __init__(self, addr, connections=2, compress=False, window=WINDOW, timeout=10,
+                 username=None, password=None):
+        self.addr = addr
+        self.connections = connections
+        self.compress = compress
+        self.window = window
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+        self._muxes = []
+        # connections being dialed, outside the lock
+        self._dialing = 0
+        self._lock = threading.Condition()
+
+    def _pick(self):
+        with self._lock:
+            while True:
+                self._muxes = [mux for mux in self._muxes if mux.alive]
+                if self._muxes and len(self._muxes) + self._dialing >= self.connections:
+                    return min(self._muxes, key=len)
+                if len(self._muxes) + self._dialing < self.connections:
+                    self._dialing += 1
+                    break
+                # nothing up yet, wait for the dials in flight
+                self._lock.wait(self.timeout)
+
+        mux = None
+        try:
+            mux = self._dial()
+        finally:
+            with self._lock:
+                self._dialing -= 1
+                if mux is not None:
+                    self._muxes.append(mux)
+                self._lock.notify_all()
+        logger.info("tunnel connection #{} to {}:{} is up".format(
+            len(self._muxes), *self.addr))
+        return mux
+
+    def _dial(self) -> Mux:
+        sock = socket.create_connection(self.addr, timeout=self.timeout)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.username is not None:
+                sock.sendall(pack_frame(FRAME_AUTH, 0, "{}\0{}".format(
+                    self.username, self.password or "").encode()))
+        except OSError:
+            sock.close()
+            raise
+        mux = Mux(sock, initiator=True, compress=self.compress, window=self.window)
+        mux.start()
+        return mux
+
+    def open(self, host, port, timeout=None) -> socket.socket:
+        return self._pick().open(host, port, timeout or self.timeout)
+
+    def close(self):
+        with self._lock:
+            muxes, self._muxes = self._muxes, []
+        for mux in muxes:
+            mux.close()
+
+    def stats(self):
+        return {"connections": len(self._muxes),
+                "streams": sum(len(mux) for mux in self._muxes)}
+
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import socket
+import unittest
+
+from localforward.address import (parse_addr, format_addr, family_of, is_unix,
+                                  parse_port_range, peer_credentials)
+
+
+class AddressTester(unittest.TestCase):
+    """"""
+
+    def test_parse_tcp(self):
+        self.assertEqual(parse_addr("127.0.0.1:80"), ("127.0.0.1", 80))
+        self.assertEqual(parse_addr("example.com", 1080), ("example.com", 1080))
+        with self.assertRaises(ValueError):
+            parse_addr("example.com")
+        with self.assertRaises(ValueError):
+            parse_addr("example.com:http")
+
+    def test_parse_ipv6(self):
+        self.assertEqual(parse_addr("[::1]:80"), ("::1", 80))
+        self.assertEqual(parse_addr("[::1]", 1080), ("::1", 1080))
+        self.assertEqual(parse_addr("::1", 1080), ("::1", 1080))
+
+    def test_parse_unix(self):
+        self.assertEqual(parse_addr("unix:/run/lf.sock"), "/run/lf.sock")
+        self.assertEqual(parse_addr("unix:@lf"), "\0lf")
+        with self.assertRaises(ValueError):
+            parse_addr("unix:")
+
+    def test_round_trip(self):
+        for spec in ("127.0.0.1:80", "[::1]:80", "unix:/run/lf.sock", "unix:@lf"):
+            self.assertEqual(format_addr(parse_addr(spec)), spec)
+
+    def test_family(self):
+        self.assertEqual(family_of(("127.0.0.1", 80)), socket.AF_INET)
+        self.assertEqual(family_of(("::1", 80)), socket.AF_INET6)
+        self.assertEqual(family_of("/run/lf.sock"), socket.AF_UNIX)
+        self.assertTrue(is_unix("/run/lf.sock"))
+        self.assertFalse(is_unix(("127.0.0.1", 80)))
+
+    def test_port_range(self):
+        self.assertEqual(parse_port_range("40000-40099"), (40000, 40099))
+        self.assertEqual(parse_port_range(40000), (40000, 40000))
+        for spec in ("0", "40099-40000", "1-65536"):
+            with self.assertRaises(ValueError):
+                parse_port_range(spec)
+
+    @unittest.skipUnless(hasattr(socket, "AF_UNIX"), "no unix sockets")
+    def test_peer_credentials(self):
+        a, b = socket.socketpair(socket.AF_UNIX)
+        try:
+            cred = peer_credentials(a)
+            if cred is not None:
+                self.assertEqual(cred.uid, os.getuid())
+        finally:
+            a.close()
+            b.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
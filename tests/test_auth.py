@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import stat
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from localforward.auth import (hash_password, verify_password, CredentialFile,
+                               CallbackStore, Authenticator)
+
+
+class PasswordHashTester(unittest.TestCase):
+    """"""
+
+    def test_pbkdf2(self):
+        encoded = hash_password("secret")
+        self.assertTrue(encoded.startswith("pbkdf2_sha256$"))
+        self.assertTrue(verify_password("secret", encoded))
+        self.assertFalse(verify_password("Secret", encoded))
+
+    @unittest.skipUnless(hasattr(hashlib, "scrypt"), "no scrypt in this build")
+    def test_scrypt(self):
+        encoded = hash_password("secret", method="scrypt")
+        self.assertTrue(verify_password("secret", encoded))
+        self.assertFalse(verify_password("other", encoded))
+
+    def test_salted(self):
+        self.assertNotEqual(hash_password("secret"), hash_password("secret"))
+
+    def test_garbage(self):
+        self.assertFalse(verify_password("secret", "nonsense"))
+        self.assertFalse(verify_password("secret", "md5$1$AAAA$AAAA"))
+        with self.assertRaises(ValueError):
+            hash_password("secret", method="md5")
+
+
+class CredentialFileTester(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "users")
+        self.store = CredentialFile(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_set_and_check(self):
+        self.store.set("alice", "secret")
+        self.store.set("bob", "hunter2")
+        self.store.set("alice", "changed")
+        self.assertTrue(self.store.check("alice", "changed"))
+        self.assertFalse(self.store.check("alice", "secret"))
+        self.assertTrue(self.store.check("bob", "hunter2"))
+        self.assertFalse(self.store.check("carol", "secret"))
+
+    def test_file_is_private(self):
+        self.store.set("alice", "secret")
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        self.assertEqual(os.listdir(self.dir), ["users"])
+
+    def test_reload_on_change(self):
+        self.store.set("alice", "secret")
+        generation = self.store.generation()
+        self.assertEqual(self.store.generation(), generation)
+        with open(self.path, "a") as f:
+            f.write("# a comment\n")
+        self.assertNotEqual(self.store.generation(), generation)
+        self.assertTrue(self.store.check("alice", "secret"))
+
+
+class AuthenticatorTester(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.checks = []
+        self.store = CallbackStore(self._check)
+
+    def _check(self, username, password):
+        self.checks.append(username)
+        return password == "secret"
+
+    def test_cache_hits(self):
+        auth = Authenticator(self.store)
+        self.assertTrue(auth.verify("alice", "secret"))
+        self.assertTrue(auth.verify("alice", "secret"))
+        self.assertEqual(self.checks, ["alice"])
+
+    def test_wrong_password_misses_the_cache(self):
+        auth = Authenticator(self.store)
+        auth.verify("alice", "secret")
+        self.assertFalse(auth.verify("alice", "guess"))
+        self.assertFalse(auth.verify("alice", "guess"))
+        self.assertEqual(self.checks, ["alice"] * 3)
+
+    def test_ttl_and_forget(self):
+        auth = Authenticator(self.store, ttl=0)
+        auth.verify("alice", "secret")
+        auth.verify("alice", "secret")
+        self.assertEqual(len(self.checks), 2)
+        auth = Authenticator(self.store)
+        auth.verify("alice", "secret")
+        auth.forget("alice")
+        auth.verify("alice", "secret")
+        self.assertEqual(len(self.checks), 4)
+
+    def test_bounded(self):
+        auth = Authenticator(self.store, cache_size=2)
+        for user in ("a", "b", "c"):
+            auth.verify(user, "secret")
+        self.assertEqual(list(auth._cache), ["b", "c"])
+
+    def test_store_errors_fail_closed(self):
+        auth = Authenticator(CallbackStore(lambda u, p: 1 / 0))
+        self.assertFalse(auth.verify("alice", "secret"))
+
+    def test_file_change_drops_the_cache(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            store = CredentialFile(os.path.join(tmp, "users"))
+            store.set("alice", "secret")
+            auth = Authenticator(store)
+            self.assertTrue(auth.verify("alice", "secret"))
+            store.set("alice", "changed")
+            self.assertFalse(auth.verify("alice", "secret"))
+            self.assertTrue(auth.verify("alice", "changed"))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
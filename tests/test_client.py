@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import shutil
+import socket
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from localforward import ForwordServer, client
+from localforward.auth import Authenticator, CallbackStore
+
+
+class FakeProxy(object):
+    """
+    a socks5 server on a unix socket that reads exactly `expect` bytes and
+    only then answers with `reply`, so a client that waits for a reply
+    before sending the rest of its handshake gets stuck.
+    """
+
+    def __init__(self, path, expect, reply, hang_up=False):
+        self.path = path
+        self.expect = expect
+        self.reply = reply
+        self.hang_up = hang_up
+        self.received = []
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.bind(path)
+        self.sock.listen(8)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    self._answer(conn)
+                except OSError:
+                    # the client gave up on us
+                    pass
+
+    def _answer(self, conn):
+        conn.settimeout(5)
+        data = b""
+        while len(data) < len(self.expect):
+            chunk = conn.recv(len(self.expect) - len(data))
+            if not chunk:
+                break
+            data += chunk
+        self.received.append(data)
+        conn.sendall(self.reply)
+        # keep the tunnel open until the client hangs up
+        while not self.hang_up and conn.recv(4096):
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+class HandshakeBytesTester(unittest.TestCase):
+    """"""
+
+    def test_no_auth(self):
+        self.assertEqual(client.handshake_bytes("10.0.0.1", 80),
+                         b"\x05\x01\x00" + b"\x05\x01\x00\x01\x0a\x00\x00\x01\x00\x50")
+
+    def test_userpass(self):
+        self.assertEqual(client.handshake_bytes("example.com", 443, "alice", "pw"),
+                         b"\x05\x01\x02" + b"\x01\x05alice\x02pw" +
+                         b"\x05\x01\x00\x03\x0bexample.com\x01\xbb")
+
+    def test_ipv6(self):
+        data = client.handshake_bytes("::1", 80)
+        self.assertEqual(data[3:7], b"\x05\x01\x00\x04")
+        self.assertEqual(len(data), 3 + 4 + 16 + 2)
+
+
+class ClientTester(unittest.TestCase):
+    """connect against a scripted proxy"""
+
+    OK_V4 = b"\x05\x00\x00\x01\x7f\x00\x00\x01\x1f\x90"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "proxy.sock")
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy:
+            self.proxy.close()
+        shutil.rmtree(self.dir)
+
+    def serve(self, reply, username=None, password=None, host="example.com", port=80,
+              hang_up=False):
+        expect = client.handshake_bytes(host, port, username, password)
+        self.proxy = FakeProxy(self.path, expect, reply, hang_up)
+        return expect
+
+    def connect(self, username=None, password=None, host="example.com", port=80):
+        return client.connect_ex("unix:" + self.path, host, port, username, password, timeout=5)
+
+    def test_pipelined(self):
+        expect = self.serve(b"\x05\x00" + self.OK_V4)
+        sock, bound = self.connect()
+        sock.close()
+        self.assertEqual(bound, ("127.0.0.1", 8080))
+        self.assertEqual(self.proxy.received, [expect])
+
+    def test_auth(self):
+        self.serve(b"\x05\x02\x01\x00" + self.OK_V4, "alice", "secret")
+        sock, _ = self.connect("alice", "secret")
+        sock.close()
+
+    def test_auth_failed(self):
+        self.serve(b"\x05\x02\x01\x01", "alice", "wrong")
+        with self.assertRaisesRegex(client.Socks5Error, "authentication failed"):
+            self.connect("alice", "wrong")
+
+    def test_method_refused(self):
+        self.serve(b"\x05\xff", "alice", "secret")
+        with self.assertRaisesRegex(client.Socks5Error, "auth method"):
+            self.connect("alice", "secret")
+
+    def test_refused(self):
+        self.serve(b"\x05\x00" + b"\x05\x05\x00\x01" + bytes(6))
+        with self.assertRaises(client.Socks5Error) as cm:
+            self.connect()
+        self.assertEqual(cm.exception.rep, 5)
+
+    def test_bound_addresses(self):
+        v6 = socket.inet_pton(socket.AF_INET6, "2001:db8::1")
+        self.serve(b"\x05\x00" + b"\x05\x00\x00\x04" + v6 + b"\x00\x50")
+        sock, bound = self.connect()
+        sock.close()
+        self.assertEqual(bound, ("2001:db8::1", 80))
+        self.proxy.close()
+        os.unlink(self.path)
+
+        self.serve(b"\x05\x00" + b"\x05\x00\x00\x03\x04host\x00\x51")
+        sock, bound = self.connect()
+        sock.close()
+        self.assertEqual(bound, ("host", 81))
+
+    def test_closed_early(self):
+        self.serve(b"\x05\x00\x05", hang_up=True)
+        with self.assertRaisesRegex(client.Socks5Error, "closed"):
+            self.connect()
+
+    def open_connection(self, username=None, password=None):
+        loop = asyncio.new_event_loop()
+        try:
+            reader, writer = loop.run_until_complete(client.open_connection(
+                "unix:" + self.path, "example.com", 80, username, password, timeout=5))
+            writer.close()
+        finally:
+            loop.close()
+
+    def test_async(self):
+        expect = self.serve(b"\x05\x02\x01\x00" + self.OK_V4, "alice", "secret")
+        self.open_connection("alice", "secret")
+        self.assertEqual(self.proxy.received, [expect])
+
+    def test_async_auth_failed(self):
+        self.serve(b"\x05\x02\x01\x01", "alice", "wrong")
+        with self.assertRaisesRegex(client.Socks5Error, "authentication failed"):
+            self.open_connection("alice", "wrong")
+
+    def test_async_closed_early(self):
+        self.serve(b"\x05\x00", hang_up=True)
+        with self.assertRaisesRegex(client.Socks5Error, "closed"):
+            self.open_connection()
+
+    def test_pool(self):
+        self.serve(b"\x05\x00" + self.OK_V4)
+        with client.ConnectionPool("unix:" + self.path, timeout=5) as pool:
+            with pool.connection("example.com", 80) as first:
+                pass
+            with pool.connection("example.com", 80) as second:
+                self.assertIs(second, first)
+            with self.assertRaises(RuntimeError):
+                with pool.connection("example.com", 80):
+                    raise RuntimeError()
+            # dropped after the error, a new tunnel is opened
+            with pool.connection("example.com", 80) as third:
+                self.assertIsNot(third, first)
+            self.assertEqual((pool.opened, pool.reused), (2, 2))
+
+
+class ServerTester(unittest.TestCase):
+    """the client against a real server with username/password auth"""
+
+    def setUp(self):
+        self.backend = socket.socket()
+        self.backend.bind(("127.0.0.1", 0))
+        self.backend.listen(4)
+        self.auth = Authenticator(CallbackStore(lambda username, password: password == "secret"))
+
+    def tearDown(self):
+        self.backend.close()
+
+    def echo_once(self):
+        def serve():
+            conn, _ = self.backend.accept()
+            with conn:
+                conn.sendall(conn.recv(64))
+        threading.Thread(target=serve, daemon=True).start()
+
+    def test_auth(self):
+        self.echo_once()
+        with ForwordServer(port=0, options={"auth": self.auth}) as server:
+            sock = client.connect(server.address, *self.backend.getsockname(),
+                                  username="alice", password="secret", timeout=5)
+            with sock:
+                sock.sendall(b"ping")
+                self.assertEqual(sock.recv(4), b"ping")
+            with self.assertRaisesRegex(client.Socks5Error, "authentication failed"):
+                client.connect(server.address, *self.backend.getsockname(),
+                               username="alice", password="wrong", timeout=5)
+            with self.assertRaises(client.Socks5Error):
+                client.connect(server.address, *self.backend.getsockname(), timeout=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
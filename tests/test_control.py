@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from localforward.control import ControlServer, ControlClient
+
+
+class ControlServerTester(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "control.sock")
+        self.server = ControlServer(self.path, {"echo": lambda **kw: kw,
+                                                "fail": lambda: 1 / 0})
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def test_call(self):
+        client = ControlClient(self.path)
+        self.assertEqual(client.call("echo", a=1), {"a": 1})
+        with self.assertRaises(RuntimeError):
+            client.call("fail")
+        with self.assertRaises(RuntimeError):
+            client.call("nope")
+        client.close()
+
+    def test_clients_do_not_wait_for_each_other(self):
+        attached = ControlClient(self.path)
+        attached.call("echo")
+        other = ControlClient(self.path, timeout=1)
+        self.assertEqual(other.call("echo", b=2), {"b": 2})
+        other.close()
+        self.assertEqual(attached.call("echo", c=3), {"c": 3})
+        attached.close()
+
+    def test_stop_drops_clients(self):
+        client = ControlClient(self.path, timeout=2)
+        client.call("echo")
+        self.server.stop()
+        with self.assertRaises((ConnectionError, OSError)):
+            client.call("echo")
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
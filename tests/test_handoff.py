@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import unittest
+
+from localforward import handoff
+
+
+class InheritedListenersTester(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.socks = []
+
+    def tearDown(self):
+        os.environ.pop(handoff.LISTEN_FDS_ENV, None)
+        for sock in self.socks:
+            sock.close()
+        shutil.rmtree(self.dir)
+
+    def _listen(self, family, addr):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        self.socks.append(sock)
+        sock.bind(addr)
+        sock.listen(1)
+        return sock
+
+    def _inherit(self, listeners):
+        """what the new process sees for listeners (name -> socket)"""
+        # the new process owns its own fds
+        fds = {}
+        for name, sock in listeners.items():
+            dup = sock.dup()
+            fds[name] = handoff._describe(dup)
+            dup.detach()
+        os.environ[handoff.LISTEN_FDS_ENV] = json.dumps(fds)
+        socks = handoff.inherited_listeners()
+        self.socks.extend(socks.values())
+        return socks
+
+    def test_nothing_inherited(self):
+        self.assertEqual(handoff.inherited_listeners(), {})
+
+    def test_families(self):
+        listeners = {"v4": self._listen(socket.AF_INET, ("127.0.0.1", 0)),
+                     "unix": self._listen(socket.AF_UNIX, os.path.join(self.dir, "s"))}
+        if socket.has_ipv6:
+            try:
+                listeners["v6"] = self._listen(socket.AF_INET6, ("::1", 0))
+            except OSError:
+                pass
+        socks = self._inherit(listeners)
+        self.assertEqual(set(socks), set(listeners))
+        for name, sock in socks.items():
+            self.assertEqual(sock.family, listeners[name].family)
+            self.assertEqual(sock.type, socket.SOCK_STREAM)
+            self.assertEqual(sock.getsockname(), listeners[name].getsockname())
+
+    def test_accepts(self):
+        listener = self._listen(socket.AF_UNIX, os.path.join(self.dir, "s"))
+        sock = self._inherit({"unix": listener})["unix"]
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(listener.getsockname())
+        conn, _ = sock.accept()
+        client.sendall(b"ping")
+        self.assertEqual(conn.recv(4), b"ping")
+        conn.close()
+        client.close()
+
+    def test_plain_fd(self):
+        """as handed over by an older version"""
+        listener = self._listen(socket.AF_INET, ("127.0.0.1", 0))
+        dup = listener.dup()
+        os.environ[handoff.LISTEN_FDS_ENV] = json.dumps({"v4": dup.detach()})
+        socks = handoff.inherited_listeners()
+        self.socks.extend(socks.values())
+        self.assertEqual(socks["v4"].getsockname(), listener.getsockname())
+
+    def test_unusable(self):
+        os.environ[handoff.LISTEN_FDS_ENV] = json.dumps({"gone": [-1, socket.AF_INET, socket.SOCK_STREAM],
+                                                          "bad": ["x"]})
+        self.assertEqual(handoff.inherited_listeners(), {})
+
+
+class SpawnTester(unittest.TestCase):
+    """"""
+
+    CHILD = "\n".join([
+        "import os, json, socket",
+        "fds = json.loads(os.environ['{}'])".format(handoff.LISTEN_FDS_ENV),
+        "fd, family, type_ = fds['unix']",
+        "sock = socket.socket(family, type_, 0, fd)",
+        "assert sock.family == socket.AF_UNIX, sock.family",
+        "os.write(int(os.environ['{}']), b'\\x01')".format(handoff.READY_FD_ENV),
+        "conn, _ = sock.accept()",
+        "conn.sendall(b'new')",
+    ])
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.listener = socket.socket(socket.AF_UNIX)
+        self.listener.bind(os.path.join(self.dir, "s"))
+        self.listener.listen(1)
+
+    def tearDown(self):
+        self.listener.close()
+        shutil.rmtree(self.dir)
+
+    def test_ready(self):
+        proc = handoff.spawn({"unix": self.listener}, [sys.executable, "-c", self.CHILD], timeout=10)
+        self.assertIsNotNone(proc)
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(self.listener.getsockname())
+        self.assertEqual(client.recv(3), b"new")
+        client.close()
+        self.assertEqual(proc.wait(10), 0)
+
+    def test_died(self):
+        proc = handoff.spawn({"unix": self.listener}, [sys.executable, "-c", "raise SystemExit(1)"], timeout=10)
+        self.assertIsNone(proc)
+
+
+if __name__ == '__main__':
+    unittest.main()
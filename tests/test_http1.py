@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import unittest
+from collections import deque
+
+from localforward.http1 import HttpStreamParser, HttpHead, HttpTap, REQUEST, RESPONSE
+
+
+class Recorder(object):
+    """"""
+
+    def __init__(self, kind=REQUEST, methods=None):
+        self.heads = []
+        self.bodies = []
+        self.completed = []
+        self.parser = HttpStreamParser(kind, on_head=self.heads.append, on_body=self.on_body,
+                                       on_complete=self.completed.append, methods=methods)
+
+    def on_body(self, head, chunk):
+        # a slice of the fed chunk, not a copy
+        assert isinstance(chunk, memoryview), type(chunk)
+        self.bodies.append(bytes(chunk))
+
+    def feed(self, data, step=None):
+        for i in range(0, len(data), step or len(data)):
+            self.parser.feed(data[i:i + (step or len(data))])
+
+
+class HttpHeadTester(unittest.TestCase):
+    """"""
+
+    def test_parse_request(self):
+        head = HttpHead.parse(REQUEST, b"GET /a HTTP/1.1\r\nHost: x\r\nConnection: close")
+        self.assertEqual((head.method, head.target, head.version), ("GET", "/a", "HTTP/1.1"))
+        self.assertEqual(head.get("host"), "x")
+        self.assertFalse(head.keep_alive)
+
+    def test_keep_alive_http10(self):
+        self.assertFalse(HttpHead.parse(REQUEST, b"GET / HTTP/1.0").keep_alive)
+        self.assertTrue(HttpHead.parse(
+            REQUEST, b"GET / HTTP/1.0\r\nConnection: keep-alive").keep_alive)
+
+
+class HttpStreamParserTester(unittest.TestCase):
+    """"""
+
+    REQUESTS = (b"POST /a HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+                b"GET /b HTTP/1.1\r\n\r\n")
+
+    def test_pipelined(self):
+        rec = Recorder()
+        rec.feed(self.REQUESTS)
+        self.assertEqual([h.target for h in rec.completed], ["/a", "/b"])
+        self.assertEqual(rec.bodies, [b"hello"])
+
+    def test_byte_by_byte(self):
+        rec = Recorder()
+        rec.feed(self.REQUESTS, step=1)
+        self.assertEqual([h.target for h in rec.completed], ["/a", "/b"])
+        self.assertEqual(b"".join(rec.bodies), b"hello")
+
+    def test_memoryview_input(self):
+        rec = Recorder()
+        data = memoryview(self.REQUESTS)
+        rec.parser.feed(data[:30])
+        rec.parser.feed(data[30:])
+        self.assertEqual(len(rec.completed), 2)
+
+    def test_body_counted_without_callback(self):
+        parser = HttpStreamParser(REQUEST)
+        parser.feed(b"PUT / HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc")
+        parser.feed(b"defg")
+        self.assertEqual(parser._remaining, 3)
+        parser.feed(b"hij")
+        self.assertIsNone(parser.head)
+
+    def test_chunked_response(self):
+        rec = Recorder(RESPONSE, deque(["GET"]))
+        rec.feed(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                 b"5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n", step=3)
+        self.assertEqual(b"".join(rec.bodies), b"hello world")
+        self.assertEqual(len(rec.completed), 1)
+
+    def test_head_response_has_no_body(self):
+        rec = Recorder(RESPONSE, deque(["HEAD", "GET"]))
+        rec.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n"
+                 b"HTTP/1.1 204 No Content\r\n\r\n")
+        self.assertEqual([h.status for h in rec.completed], [200, 204])
+
+    def test_response_until_eof(self):
+        rec = Recorder(RESPONSE, deque(["GET"]))
+        rec.feed(b"HTTP/1.0 200 OK\r\n\r\nall of it")
+        self.assertEqual(rec.bodies, [b"all of it"])
+        self.assertEqual(rec.completed, [])
+
+    def test_connect_passes_through(self):
+        rec = Recorder()
+        rec.feed(b"CONNECT example.com:443 HTTP/1.1\r\n\r\n\x16\x03\x01")
+        self.assertEqual(len(rec.heads), 1)
+        rec.feed(b"GET / HTTP/1.1\r\n\r\n")
+        self.assertEqual(len(rec.heads), 1)
+
+    def test_gives_up_on_garbage(self):
+        rec = Recorder()
+        rec.feed(b"\x16\x03\x01 not http\r\n\r\nGET / HTTP/1.1\r\n\r\n")
+        self.assertEqual(rec.heads, [])
+
+
+class HttpTapTester(unittest.TestCase):
+    """"""
+
+    def test_pairs_requests_and_responses(self):
+        class Session(object):
+            hook_state = None
+
+        seen = []
+        tap = HttpTap(on_request=lambda s, h: seen.append((s, h.method)),
+                      on_response=lambda s, h: seen.append((s, h.status)))
+        session = Session()
+        tap.send_hook(memoryview(b"HEAD / HTTP/1.1\r\n\r\n"), None, session)
+        tap.recv_hook(memoryview(b"HTTP/1.1 200 OK\r\nContent-Length: 9\r\n\r\n"), None, session)
+        tap.send_hook(memoryview(b"GET / HTTP/1.1\r\n\r\n"), None, session)
+        self.assertEqual(seen, [(session, "HEAD"), (session, 200), (session, "GET")])
+        self.assertIn(tap, session.hook_state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import time
+import base64
+import socket
+import threading
+import unittest
+
+from localforward.auth import Authenticator, CallbackStore
+from localforward.relay import RelayEngine
+from localforward.sessions.http import HttpProxySession, parse_authority, RSP_ESTABLISHED
+
+
+def recv_until_closed(sock):
+    data = bytearray()
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+
+
+class ParseAuthorityTester(unittest.TestCase):
+    """"""
+
+    def test_host_port(self):
+        self.assertEqual(parse_authority("example.com:443"), ("example.com", 443))
+        self.assertEqual(parse_authority("10.0.0.1:80"), ("10.0.0.1", 80))
+
+    def test_ipv6(self):
+        self.assertEqual(parse_authority("[::1]:8443"), ("::1", 8443))
+
+    def test_malformed(self):
+        for target in ("example.com", "example.com:", ":80", "example.com:0",
+                       "example.com:65536", "example.com:http", "::1:80",
+                       "[::1:80", "[not-ipv6]:80", "a]:80"):
+            with self.assertRaises(ValueError, msg=target):
+                parse_authority(target)
+
+
+class HttpProxySessionTester(unittest.TestCase):
+    """requests handled by a session, upstreams are socketpairs handed out by a connector"""
+
+    def setUp(self):
+        self.engine = RelayEngine()
+        self.socks = []
+        # (host, port) the session connected to
+        self.dialed = []
+        # the far end of every upstream
+        self.backends = []
+
+    def tearDown(self):
+        self.engine.stop()
+        for sock in self.socks + self.backends:
+            sock.close()
+
+    def connector(self, addr, timeout):
+        self.dialed.append(addr)
+        if addr[0] == "unreachable":
+            raise ConnectionRefusedError("refused")
+        upstream, backend = socket.socketpair()
+        backend.settimeout(5)
+        self.backends.append(backend)
+        return upstream
+
+    def request(self, raw, **options):
+        """the client socket after raw was sent"""
+        client, conn = socket.socketpair()
+        self.socks.append(client)
+        client.settimeout(5)
+        options = dict(options, engine=self.engine, connector=self.connector)
+
+        def serve():
+            session = HttpProxySession(conn, ("127.0.0.1", 40000), options)
+            session.handle()
+            if not session.detached:
+                session.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        client.sendall(raw)
+        return client
+
+    def wait_backend(self):
+        """plain requests get no reply, wait for the upstream instead"""
+        for _ in range(500):
+            if self.backends:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_connect(self):
+        client = self.request(b"CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n"
+                              b"early")
+        self.assertEqual(client.recv(len(RSP_ESTABLISHED), socket.MSG_WAITALL), RSP_ESTABLISHED)
+        self.assertEqual(self.dialed, [("example.com", 443)])
+        backend = self.backends[0]
+        # bytes past the head go upstream first
+        self.assertEqual(backend.recv(5, socket.MSG_WAITALL), b"early")
+        backend.sendall(b"hello")
+        self.assertEqual(client.recv(5, socket.MSG_WAITALL), b"hello")
+
+    def test_connect_ipv6(self):
+        client = self.request(b"CONNECT [::1]:8443 HTTP/1.1\r\n\r\n")
+        client.recv(len(RSP_ESTABLISHED), socket.MSG_WAITALL)
+        self.assertEqual(self.dialed, [("::1", 8443)])
+
+    def test_absolute_uri(self):
+        self.request(b"POST http://example.com:8080/a/b?q=1 HTTP/1.1\r\n"
+                     b"Proxy-Connection: keep-alive\r\n"
+                     b"Proxy-Authorization: Basic eDp5\r\n"
+                     b"Content-Length: 4\r\n\r\nbody")
+        self.assertTrue(self.wait_backend())
+        backend = self.backends[0]
+        expected = (b"POST /a/b?q=1 HTTP/1.1\r\nHost: example.com:8080\r\n"
+                    b"Content-Length: 4\r\nConnection: close\r\n\r\nbody")
+        self.assertEqual(backend.recv(len(expected), socket.MSG_WAITALL), expected)
+        self.assertEqual(self.dialed, [("example.com", 8080)])
+
+    def test_host_header_is_kept(self):
+        self.request(b"GET http://example.com HTTP/1.1\r\nHost: example.com\r\n\r\n")
+        self.assertTrue(self.wait_backend())
+        expected = b"GET / HTTP/1.1\r\nHost: example.com\r\nConnection: close\r\n\r\n"
+        self.assertEqual(self.backends[0].recv(len(expected), socket.MSG_WAITALL), expected)
+        self.assertEqual(self.dialed, [("example.com", 80)])
+
+    def test_bad_requests(self):
+        for raw in (b"CONNECT example.com HTTP/1.1\r\n\r\n",
+                    b"GET /relative HTTP/1.1\r\n\r\n",
+                    b"GET ftp://example.com/ HTTP/1.1\r\n\r\n",
+                    b"not http at all\r\n\r\n"):
+            client = self.request(raw)
+            self.assertTrue(recv_until_closed(client).startswith(b"HTTP/1.1 400 "), raw)
+        self.assertEqual(self.dialed, [])
+
+    def test_bad_gateway(self):
+        client = self.request(b"CONNECT unreachable:443 HTTP/1.1\r\n\r\n")
+        self.assertTrue(recv_until_closed(client).startswith(b"HTTP/1.1 502 "))
+
+    def test_auth(self):
+        auth = Authenticator(CallbackStore(lambda username, password: password == "secret"))
+        token = base64.b64encode(b"alice:secret").decode()
+        client = self.request("CONNECT example.com:443 HTTP/1.1\r\n"
+                              "Proxy-Authorization: Basic {}\r\n\r\n".format(token).encode(),
+                              auth=auth)
+        self.assertEqual(client.recv(len(RSP_ESTABLISHED), socket.MSG_WAITALL), RSP_ESTABLISHED)
+
+        for header in (b"", b"Proxy-Authorization: Basic " + base64.b64encode(b"alice:wrong") + b"\r\n",
+                       b"Proxy-Authorization: Basic !!!\r\n",
+                       b"Proxy-Authorization: Bearer abc\r\n"):
+            client = self.request(b"CONNECT example.com:443 HTTP/1.1\r\n" + header + b"\r\n",
+                                  auth=auth)
+            self.assertTrue(recv_until_closed(client).startswith(b"HTTP/1.1 407 "), header)
+        self.assertEqual(self.dialed, [("example.com", 443)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import unittest
+
+from localforward.matcher import PatternSet, MatchHook
+
+
+class PatternSetTester(unittest.TestCase):
+    """"""
+
+    def test_search(self):
+        patterns = PatternSet([b"he", b"she", b"his", b"hers"])
+        self.assertEqual(sorted(patterns.search(b"ushers")), [(1, 1), (2, 0), (2, 3)])
+
+    def test_no_match(self):
+        self.assertEqual(PatternSet([b"abc"]).search(b"ababab"), [])
+
+    def test_empty_pattern(self):
+        with self.assertRaises(ValueError):
+            PatternSet([b"abc", b""])
+
+    def test_across_chunks(self):
+        stream = PatternSet([b"password="]).stream()
+        self.assertEqual(stream.feed(b"user=a&pass"), [])
+        self.assertEqual(stream.feed(b"word=secret"), [(7, 0)])
+        self.assertEqual(stream.offset, 22)
+
+    def test_reset(self):
+        stream = PatternSet([b"ab"]).stream()
+        stream.feed(b"xa")
+        stream.reset()
+        self.assertEqual(stream.feed(b"b"), [])
+
+
+class MatchHookTester(unittest.TestCase):
+    """"""
+
+    def test_sessions_scan_apart(self):
+        class Session(object):
+            pass
+
+        found = []
+        hook = MatchHook(PatternSet([b"token"]), lambda s, offset, p: found.append((s, offset, p)))
+        a, b = Session(), Session()
+        self.assertEqual(hook(memoryview(b"tok"), None, a), b"tok")
+        hook(memoryview(b"en"), None, b)
+        hook(memoryview(b"en"), None, a)
+        self.assertEqual(found, [(a, 0, b"token")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import unittest
+
+from localforward.quota import ClientQuota
+
+
+class ClientQuotaTester(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.quota = ClientQuota()
+
+    def test_unlimited(self):
+        self.assertEqual(self.quota.acquire("10.0.0.1"), ())
+        self.assertEqual(self.quota.acquire("fe80::1%eth0"), ())
+        self.assertEqual(self.quota.acquire("not an address"), ())
+
+    def test_sessions_per_client(self):
+        self.quota.set_limit(max_sessions=2)
+        first = self.quota.acquire("10.0.0.1")
+        second = self.quota.acquire("10.0.0.1")
+        self.assertIsNotNone(second)
+        self.assertIsNone(self.quota.acquire("10.0.0.1"))
+        self.assertIsNotNone(self.quota.acquire("10.0.0.2"))
+        self.quota.release(first)
+        self.assertIsNotNone(self.quota.acquire("10.0.0.1"))
+        self.assertEqual(self.quota.counters["rejected_sessions"], 1)
+
+    def test_release_forgets_idle_clients(self):
+        self.quota.set_limit(max_sessions=1)
+        ticket = self.quota.acquire("10.0.0.1")
+        self.quota.release(ticket)
+        self.quota.release(ticket)
+        self.assertEqual(self.quota.snapshot()["clients"], 0)
+
+    def test_network_limit(self):
+        self.quota.set_limit(max_sessions=2, cidr="10.0.0.0/8")
+        a = self.quota.acquire("10.1.0.1")
+        self.quota.acquire("10.2.0.1")
+        self.assertIsNone(self.quota.acquire("10.3.0.1"))
+        self.assertIsNotNone(self.quota.acquire("192.168.0.1"))
+        self.assertEqual(self.quota.snapshot()["busiest"], [["10.0.0.0/8", 2]])
+        self.quota.release(a)
+        self.assertIsNotNone(self.quota.acquire("10.3.0.1"))
+        self.quota.remove_limit(cidr="10.0.0.0/8")
+        self.assertEqual(self.quota.acquire("10.4.0.1"), ())
+
+    def test_rate(self):
+        self.quota.set_limit(rate=1, burst=2)
+        self.assertIsNotNone(self.quota.acquire("10.0.0.1"))
+        self.assertIsNotNone(self.quota.acquire("10.0.0.1"))
+        self.assertIsNone(self.quota.acquire("10.0.0.1"))
+        self.assertEqual(self.quota.counters["rejected_rate"], 1)
+
+    def test_scoped_ipv6(self):
+        self.quota.set_limit(max_sessions=1)
+        self.assertIsNotNone(self.quota.acquire("fe80::1%eth0"))
+        self.assertIsNone(self.quota.acquire("fe80::1%eth1"))
+        self.assertEqual(self.quota.snapshot()["busiest"], [["fe80::1", 1]])
+
+    def test_bad_address_never_raises(self):
+        self.quota.set_limit(max_sessions=1)
+        self.assertEqual(self.quota.acquire("unix"), ())
+        self.assertEqual(self.quota.acquire(None), ())
+        self.assertEqual(self.quota.counters["unparsed"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
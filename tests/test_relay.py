@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import select
+import socket
+import threading
+import unittest
+
+from localforward.relay import RelayEngine, PRIORITY_NORMAL
+from localforward.sessions.base import SessionBase
+
+
+def recv_all(sock):
+    data = bytearray()
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+
+
+class RelayTester(unittest.TestCase):
+    """sessions relayed by a running engine over socketpairs"""
+
+    def setUp(self):
+        self.engine = RelayEngine()
+        self.finished = threading.Event()
+        self.socks = []
+
+    def tearDown(self):
+        self.engine.stop()
+        for sock in self.socks:
+            sock.close()
+
+    def relay(self, options=None):
+        client, conn = socket.socketpair()
+        upstream, backend = socket.socketpair()
+        self.socks += [client, backend]
+        for sock in (client, backend):
+            sock.settimeout(5)
+        options = dict(options or {}, engine=self.engine)
+        session = SessionBase(conn, ("127.0.0.1", 40000), options)
+        session.on_finish = self.finished.set
+        session.relay(upstream)
+        return session, client, backend
+
+    def test_both_ways(self):
+        session, client, backend = self.relay()
+        client.sendall(b"ping")
+        self.assertEqual(backend.recv(10), b"ping")
+        backend.sendall(b"pong")
+        self.assertEqual(client.recv(10), b"pong")
+        self.assertEqual((session.stat.bytes_up, session.stat.bytes_down), (4, 4))
+
+    def test_half_close(self):
+        session, client, backend = self.relay()
+        client.sendall(b"request")
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(recv_all(backend), b"request")
+        self.assertFalse(self.finished.is_set())
+        # the other direction still works after the half-close
+        backend.sendall(b"response")
+        backend.shutdown(socket.SHUT_WR)
+        self.assertEqual(recv_all(client), b"response")
+        self.assertTrue(self.finished.wait(5))
+        self.assertTrue(session.closed)
+
+    def test_parked_data_survives_eof(self):
+        session, client, backend = self.relay()
+        data = bytes(range(256)) * 4096
+
+        def send():
+            client.sendall(data)
+            client.shutdown(socket.SHUT_WR)
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        # the backend reads only now, most of the data sat parked in the engine
+        self.assertEqual(recv_all(backend), data)
+        sender.join()
+        backend.close()
+        self.assertTrue(self.finished.wait(5))
+
+    def test_error_closes(self):
+        def broken(buff, conn):
+            # not bytes, the send fails
+            return "data"
+
+        session, client, backend = self.relay({"data_send": broken})
+        client.sendall(b"data")
+        self.assertTrue(self.finished.wait(5))
+        self.assertEqual(backend.recv(10), b"")
+
+
+class PumpTester(unittest.TestCase):
+    """one direction pumped by hand, without the engine thread"""
+
+    def setUp(self):
+        self.engine = RelayEngine(chunk_size=4096, min_chunk=1024)
+        self.engine._kq = select.kqueue()
+        self.client, conn = socket.socketpair()
+        upstream, self.backend = socket.socketpair()
+        self.session = SessionBase(conn, ("127.0.0.1", 40000), {"engine": self.engine})
+        self.session.upstream = upstream
+        self.session.priority = PRIORITY_NORMAL
+        self.engine._register(self.session)
+        self.up = self.session.pipes[0]
+
+    def tearDown(self):
+        self.session.close()
+        self.client.close()
+        self.backend.close()
+        self.engine._kq.close()
+
+    def test_budget(self):
+        self.client.sendall(b"x" * 10000)
+        self.assertTrue(self.engine._pump(self.up, 3000, 8))
+        self.assertEqual(len(self.backend.recv(65536)), 3000)
+        self.assertFalse(self.engine._pump(self.up, 65536, 8))
+        self.assertEqual(len(self.backend.recv(65536)), 7000)
+
+    def test_calls(self):
+        self.client.sendall(b"x" * 10000)
+        self.up.chunk = 1024
+        self.engine._pump(self.up, 65536, 2)
+        # 1024, then 2048 after the first full read doubled the size
+        self.assertEqual(len(self.backend.recv(65536)), 3072)
+
+    def test_adaptive_chunk(self):
+        self.up.chunk = 2048
+        self.engine._adapt(self.up, 2048, 2048)
+        self.assertEqual(self.up.chunk, 4096)
+        self.engine._adapt(self.up, 4096, 4096)
+        self.assertEqual(self.up.chunk, 4096)
+        self.engine._adapt(self.up, 4096, 10)
+        self.assertEqual(self.up.chunk, 2048)
+
+    def test_eof_passes_the_half_close_on(self):
+        self.client.sendall(b"last")
+        self.client.shutdown(socket.SHUT_WR)
+        self.assertFalse(self.engine._pump(self.up, 65536, 8))
+        self.assertTrue(self.up.eof)
+        self.assertFalse(self.session.closed)
+        self.backend.settimeout(5)
+        self.assertEqual(recv_all(self.backend), b"last")
+
+
+if __name__ == '__main__':
+    unittest.main()
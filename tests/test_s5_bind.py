@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import socket
+import struct
+import itertools
+import threading
+import unittest
+
+from localforward.relay import RelayEngine
+from localforward.sessions.s5 import (Sock5Session, Sock5Request, Sock5Response, CMD_BIND,
+                                      ATYP_IPV4, ATYP_IPv6, REP_SUCCEEDED, REP_TTL_EXPIRED)
+
+
+def has_ipv6():
+    try:
+        with socket.socket(socket.AF_INET6) as sock:
+            sock.bind(("::1", 0))
+        return True
+    except OSError:
+        return False
+
+
+def read_reply(sock):
+    """(rep, atyp, host, port) of a socks5 reply"""
+    ver, rep, _, atyp = sock.recv(4, socket.MSG_WAITALL)
+    family, size = (socket.AF_INET, 4) if atyp == ATYP_IPV4 else (socket.AF_INET6, 16)
+    host = socket.inet_ntop(family, sock.recv(size, socket.MSG_WAITALL))
+    port, = struct.unpack("!H", sock.recv(2, socket.MSG_WAITALL))
+    return rep, atyp, host, port
+
+
+class BoundTester(unittest.TestCase):
+    """"""
+
+    def test_ipv4(self):
+        self.assertEqual(Sock5Response.bound(("10.0.0.2", 1080)),
+                         b"\x05\x00\x00\x01\x0a\x00\x00\x02\x04\x38")
+
+    def test_ipv6(self):
+        rsp = Sock5Response.bound(("fe80::1%eth0", 80, 0, 2))
+        self.assertEqual(rsp[:4], b"\x05\x00\x00\x04")
+        self.assertEqual(rsp[4:20], socket.inet_pton(socket.AF_INET6, "fe80::1"))
+        self.assertEqual(rsp[20:], b"\x00\x50")
+
+    def test_mapped(self):
+        self.assertEqual(Sock5Response.bound(("::ffff:127.0.0.1", 80, 0, 0)),
+                         b"\x05\x00\x00\x01\x7f\x00\x00\x01\x00\x50")
+
+    def test_no_address(self):
+        self.assertEqual(Sock5Response.bound("/tmp/lf.sock"),
+                         b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00")
+
+
+class BindTester(unittest.TestCase):
+    """BIND handled by a session, the client side is a socketpair (a unix listener)"""
+
+    def setUp(self):
+        self.engine = RelayEngine()
+        self.socks = []
+
+    def tearDown(self):
+        self.engine.stop()
+        for sock in self.socks:
+            sock.close()
+
+    def bind(self, dest="0.0.0.0", **options):
+        """the client socket after the BIND request was sent"""
+        client, conn = socket.socketpair()
+        self.socks.append(client)
+        client.settimeout(5)
+        options = dict(options, engine=self.engine, bind_counter=itertools.count())
+        options.setdefault("bind_timeout", 5)
+
+        def serve():
+            session = Sock5Session(conn, ("127.0.0.1", 40000), options)
+            session.handle()
+            if not session.detached:
+                session.close()
+
+        client.sendall(b"\x05\x01\x00")
+        threading.Thread(target=serve, daemon=True).start()
+        self.assertEqual(client.recv(2), b"\x05\x00")
+        client.sendall(Sock5Request.to(dest, 0, CMD_BIND).to_bytes())
+        return client
+
+    def connect(self, host, port):
+        peer = socket.create_connection((host, port), 5)
+        self.socks.append(peer)
+        return peer
+
+    def test_unix_listener(self):
+        client = self.bind()
+        rep, atyp, host, port = read_reply(client)
+        self.assertEqual((rep, atyp, host), (REP_SUCCEEDED, ATYP_IPV4, "0.0.0.0"))
+        peer = self.connect("127.0.0.1", port)
+        rep, atyp, host, peer_port = read_reply(client)
+        self.assertEqual((rep, atyp, host), (REP_SUCCEEDED, ATYP_IPV4, "127.0.0.1"))
+        self.assertEqual(peer_port, peer.getsockname()[1])
+
+        client.sendall(b"ping")
+        self.assertEqual(peer.recv(4), b"ping")
+        peer.sendall(b"pong")
+        self.assertEqual(client.recv(4), b"pong")
+
+    def test_early_data(self):
+        client = self.bind()
+        _, _, _, port = read_reply(client)
+        client.sendall(b"early")
+        peer = self.connect("127.0.0.1", port)
+        read_reply(client)
+        self.assertEqual(peer.recv(5, socket.MSG_WAITALL), b"early")
+
+    def test_bind_ports(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        free = probe.getsockname()[1]
+        probe.close()
+        client = self.bind(bind_host="127.0.0.1", bind_ports=(free, free))
+        self.assertEqual(read_reply(client), (REP_SUCCEEDED, ATYP_IPV4, "127.0.0.1", free))
+
+    def test_unexpected_peer(self):
+        client = self.bind(dest="127.0.0.2", bind_timeout=0.5)
+        _, _, _, port = read_reply(client)
+        peer = self.connect("127.0.0.1", port)
+        # turned away, then the BIND times out
+        self.assertEqual(peer.recv(1), b"")
+        self.assertEqual(read_reply(client)[0], REP_TTL_EXPIRED)
+
+    @unittest.skipUnless(has_ipv6(), "no ipv6")
+    def test_ipv6_bind_host(self):
+        client = self.bind(dest="::1", bind_host="::1")
+        rep, atyp, host, port = read_reply(client)
+        self.assertEqual((rep, atyp, host), (REP_SUCCEEDED, ATYP_IPv6, "::1"))
+        peer = self.connect("::1", port)
+        rep, atyp, host, _ = read_reply(client)
+        self.assertEqual((rep, atyp, host), (REP_SUCCEEDED, ATYP_IPv6, "::1"))
+        peer.sendall(b"pong")
+        self.assertEqual(client.recv(4), b"pong")
+
+
+if __name__ == '__main__':
+    unittest.main()
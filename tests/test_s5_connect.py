@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from localforward.relay import RelayEngine
+from localforward.sessions.s5 import Sock5Session, Sock5Request, ATYP_IPV4, ATYP_IPv6, REP_SUCCEEDED
+from tests.test_s5_bind import has_ipv6, read_reply
+
+
+class ConnectTester(unittest.TestCase):
+    """the CONNECT reply reports the upstream in its own family"""
+
+    def setUp(self):
+        self.engine = RelayEngine()
+        self.dir = tempfile.mkdtemp()
+        self.socks = []
+
+    def tearDown(self):
+        self.engine.stop()
+        for sock in self.socks:
+            sock.close()
+        shutil.rmtree(self.dir)
+
+    def listen(self, family, addr):
+        sock = socket.socket(family)
+        self.socks.append(sock)
+        sock.bind(addr)
+        sock.listen(1)
+        return sock
+
+    def connect(self, host, port, **options):
+        """the client socket after the CONNECT reply"""
+        client, conn = socket.socketpair()
+        self.socks.append(client)
+        client.settimeout(5)
+        options = dict(options, engine=self.engine)
+
+        def serve():
+            session = Sock5Session(conn, ("127.0.0.1", 40000), options)
+            session.handle()
+
+        client.sendall(b"\x05\x01\x00")
+        threading.Thread(target=serve, daemon=True).start()
+        self.assertEqual(client.recv(2), b"\x05\x00")
+        client.sendall(Sock5Request.to(host, port).to_bytes())
+        return client
+
+    def test_ipv4(self):
+        server = self.listen(socket.AF_INET, ("127.0.0.1", 0))
+        client = self.connect(*server.getsockname())
+        self.assertEqual(read_reply(client),
+                         (REP_SUCCEEDED, ATYP_IPV4) + server.getsockname())
+
+    @unittest.skipUnless(has_ipv6(), "no ipv6")
+    def test_ipv6(self):
+        server = self.listen(socket.AF_INET6, ("::1", 0))
+        port = server.getsockname()[1]
+        client = self.connect("::1", port)
+        self.assertEqual(read_reply(client), (REP_SUCCEEDED, ATYP_IPv6, "::1", port))
+        upstream, _ = server.accept()
+        self.socks.append(upstream)
+        upstream.sendall(b"pong")
+        self.assertEqual(client.recv(4), b"pong")
+
+    def test_unix_target(self):
+        path = os.path.join(self.dir, "s")
+        self.listen(socket.AF_UNIX, path)
+
+        class Routes(object):
+            def lookup(self, host, port):
+                return {"target": "unix:" + path}
+
+        client = self.connect("example.com", 80, routes=Routes())
+        self.assertEqual(read_reply(client), (REP_SUCCEEDED, ATYP_IPV4, "0.0.0.0", 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
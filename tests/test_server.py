@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import unittest
+
+from localforward.core import ForwordServer, FORWORD_TYPE_HTTP
+
+
+class ProxiesTester(unittest.TestCase):
+    """"""
+
+    def proxies(self, host, port, type="socks5"):
+        server = ForwordServer(host, port, type)
+        try:
+            return server.proxies
+        finally:
+            server.stop()
+
+    def test_tcp(self):
+        self.assertEqual(self.proxies("127.0.0.1", 1080),
+                         {"http": "socks5://127.0.0.1:1080", "https": "socks5://127.0.0.1:1080"})
+        self.assertEqual(self.proxies("127.0.0.1", 8080, FORWORD_TYPE_HTTP)["https"],
+                         "http://127.0.0.1:8080")
+
+    def test_ipv6(self):
+        self.assertEqual(self.proxies("::1", 1080)["http"], "socks5://[::1]:1080")
+
+    def test_unix(self):
+        self.assertEqual(self.proxies("unix:/tmp/lf.sock", None), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import time
+import unittest
+
+from localforward.shaping import Shaper, TokenBucket
+
+
+class TokenBucketTester(unittest.TestCase):
+    """"""
+
+    def test_refill_caps_at_burst(self):
+        bucket = TokenBucket("global", None, rate=100, burst=50)
+        bucket.tokens = 0
+        bucket.refill(0.2)
+        self.assertEqual(bucket.tokens, 20)
+        bucket.refill(10)
+        self.assertEqual(bucket.tokens, 50)
+
+    def test_rerate(self):
+        bucket = TokenBucket("global", None, rate=100, burst=100)
+        bucket.rerate(10, 30)
+        self.assertEqual((bucket.rate, bucket.burst, bucket.tokens), (10, 30, 30))
+
+
+class ShaperTester(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.shaper = Shaper(interval=0.01)
+
+    def tearDown(self):
+        self.shaper.stop()
+
+    def test_unlimited(self):
+        flow = self.shaper.open_flow("10.0.0.1", "example.com")
+        self.assertEqual(flow.allowance(4096), 4096)
+        self.assertIsNone(self.shaper._timer)
+
+    def test_tightest_level_wins(self):
+        self.shaper.set_limit("global", 10000)
+        self.shaper.set_limit("client", 1000, key="10.0.0.1")
+        self.shaper.set_limit("dest", 5000)
+        flow = self.shaper.open_flow("10.0.0.1", "example.com")
+        self.assertEqual(flow.allowance(4096), 1000)
+        flow.consume(1000)
+        self.assertEqual(flow.allowance(4096), 0)
+        other = self.shaper.open_flow("10.0.0.2", "example.com")
+        self.assertEqual(other.allowance(8192), 4000)
+
+    def test_flows_share_buckets(self):
+        self.shaper.set_limit("dest", 1000)
+        a = self.shaper.open_flow("10.0.0.1", "example.com")
+        b = self.shaper.open_flow("10.0.0.2", "example.com")
+        a.allowance(1)
+        b.allowance(1)
+        a.consume(600)
+        self.assertEqual(b.allowance(1000), 400)
+        a.close()
+        b.close()
+        self.assertEqual(self.shaper._buckets["dest"], {})
+
+    def test_refill(self):
+        self.shaper.set_limit("global", 100000, burst=1000)
+        flow = self.shaper.open_flow("10.0.0.1", "example.com")
+        flow.allowance(1)
+        flow.consume(1000)
+        time.sleep(0.1)
+        self.assertEqual(flow.allowance(1000), 1000)
+
+    def test_limits_change_live_flows(self):
+        self.shaper.set_limit("client", 1000)
+        flow = self.shaper.open_flow("10.0.0.1", "example.com")
+        self.assertEqual(flow.allowance(4096), 1000)
+        self.shaper.set_limit("client", 100)
+        self.assertEqual(flow.allowance(4096), 100)
+        self.shaper.clear_limit("client")
+        self.assertEqual(flow.allowance(4096), 4096)
+        self.assertEqual(self.shaper._buckets["client"], {})
+
+    def test_bad_limits(self):
+        with self.assertRaises(ValueError):
+            self.shaper.set_limit("galaxy", 100)
+        with self.assertRaises(ValueError):
+            self.shaper.set_limit("global", 0)
+
+    def test_stop_and_restart(self):
+        self.shaper.set_limit("global", 1000)
+        first = self.shaper._timer
+        self.shaper.stop()
+        self.assertFalse(first.is_alive())
+        flow = self.shaper.open_flow("10.0.0.1", "example.com")
+        flow.allowance(1)
+        self.assertTrue(self.shaper._timer.is_alive())
+        self.assertEqual(self.shaper.limits(), {"global": {"*": [1000, 1000]},
+                                                "client": {}, "dest": {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import unittest
+
+from localforward.table import parse_table
+
+
+class ParseTableTester(unittest.TestCase):
+    """"""
+
+    def test_entries(self):
+        entries = parse_table("""
+            # listen            mode      targets                     options
+            127.0.0.1:2201      raw       10.0.0.5:22                 priority=interactive
+            :8443               raw       10.0.0.7:443,10.0.0.8:443   idle_timeout=600 ratio=0.5
+            127.0.0.1:1080      socks5    # trailing comment
+        """.splitlines())
+        self.assertEqual(len(entries), 3)
+        ssh, tls, socks = entries
+        self.assertEqual((ssh.host, ssh.port, ssh.type), ("127.0.0.1", 2201, "raw"))
+        self.assertEqual(ssh.targets, (("10.0.0.5", 22),))
+        self.assertEqual(ssh.options, {"priority": "interactive"})
+        self.assertEqual(tls.host, "127.0.0.1")
+        self.assertEqual(tls.targets, (("10.0.0.7", 443), ("10.0.0.8", 443)))
+        self.assertEqual(tls.options, {"idle_timeout": 600, "ratio": 0.5})
+        self.assertEqual((socks.type, socks.targets, socks.name), ("socks5", (), "127.0.0.1:1080"))
+
+    def test_unix(self):
+        entry, = parse_table(["unix:/run/lf.sock raw unix:/run/app.sock"])
+        self.assertEqual((entry.host, entry.port), ("/run/lf.sock", None))
+        self.assertEqual(entry.name, "unix:/run/lf.sock")
+        self.assertEqual(entry.listen_host, "unix:/run/lf.sock")
+        self.assertEqual(entry.targets, ("/run/app.sock",))
+        self.assertEqual(repr(entry), "<forward: unix:/run/lf.sock raw unix:/run/app.sock>")
+
+    def test_ipv6(self):
+        entry, = parse_table(["[::1]:2201 raw [fd00::5]:22"])
+        self.assertEqual((entry.host, entry.port, entry.targets), ("::1", 2201, (("fd00::5", 22),)))
+        self.assertEqual(entry.name, "[::1]:2201")
+
+    def test_key(self):
+        a, b, c = parse_table(["127.0.0.1:1 raw 10.0.0.1:1 a=1",
+                               "127.0.0.1:1 raw 10.0.0.1:1 a=1",
+                               "127.0.0.1:1 raw 10.0.0.1:1 a=2"])
+        self.assertEqual(a.key(), b.key())
+        self.assertNotEqual(a.key(), c.key())
+
+    def test_errors_name_the_line(self):
+        for line in ("127.0.0.1:1080", "127.0.0.1:http raw", "127.0.0.1 raw"):
+            with self.assertRaises(ValueError) as ctx:
+                parse_table(["# header", line])
+            self.assertIn("line 2", str(ctx.exception))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import unittest
+import threading
+
+from localforward.timers import Timer, TimerWheel
+
+
+class TimerWheelTester(unittest.TestCase):
+    """the wheel is moved by hand through _advance, without its thread"""
+
+    def setUp(self):
+        self.wheel = TimerWheel(tick=0.1)
+
+    def add(self, delay):
+        timer = Timer(self.wheel._start + delay, lambda: None)
+        self.wheel._insert(timer)
+        return timer
+
+    def advance(self, seconds):
+        return self.wheel._advance(self.wheel._start + seconds)
+
+    def test_fires_on_its_tick(self):
+        timer = self.add(1.0)
+        self.assertEqual(self.advance(0.95), [])
+        self.assertEqual(self.advance(1.0), [timer])
+
+    def test_cancelled(self):
+        timer = self.add(0.5)
+        timer.cancel()
+        self.assertIsNone(timer.callback)
+        self.assertEqual(self.advance(1.0), [])
+
+    def test_reset_rehashes(self):
+        timer = self.add(0.5)
+        timer.deadline = self.wheel._start + 2.0
+        self.assertEqual(self.advance(1.0), [])
+        self.assertEqual(self.advance(2.0), [timer])
+
+    def test_cascades(self):
+        # 600s is on the last level, 100s on the second
+        far, mid = self.add(600), self.add(100)
+        self.assertEqual(self.advance(99.9), [])
+        self.assertEqual(self.advance(100), [mid])
+        self.assertEqual(self.advance(599.9), [])
+        self.assertEqual(self.advance(600), [far])
+        self.assertFalse(any(self.wheel._counts))
+
+    def test_beyond_the_wheel(self):
+        # past 64 * 16384 ticks, parked and re-hashed
+        timer = self.add(200000)
+        self.assertEqual(self.advance(1000), [])
+        self.assertEqual(sum(self.wheel._counts), 1)
+        self.assertFalse(timer.cancelled)
+
+
+class TimerThreadTester(unittest.TestCase):
+    """"""
+
+    def test_schedule_and_stop(self):
+        wheel = TimerWheel(tick=0.01)
+        fired = threading.Event()
+        wheel.schedule(0.05, fired.set)
+        wheel.schedule(0.05, lambda: 1 / 0)
+        wheel.schedule(0.02, fired.clear).cancel()
+        self.assertTrue(fired.wait(2))
+        wheel.stop()
+        self.assertIsNone(wheel._thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# coding:utf-8
+import time
+import zlib
+import socket
+import threading
+import unittest
+
+from localforward.tunnel import (Mux, TunnelError, FRAME_DATA, FRAME_OPEN, FLAG_ZLIB, MAX_FRAME,
+                                 pack_frame, read_frame, _inflate)
+
+
+def recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+def wait_for(check, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FrameTester(unittest.TestCase):
+    """"""
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.b.settimeout(5)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_round_trip(self):
+        self.a.sendall(pack_frame(FRAME_DATA, 7, b"hello") + pack_frame(FRAME_OPEN, 9))
+        self.assertEqual(read_frame(self.b), (FRAME_DATA, 7, b"hello"))
+        self.assertEqual(read_frame(self.b), (FRAME_OPEN, 9, b""))
+
+    def test_header(self):
+        self.assertEqual(pack_frame(FRAME_DATA, 1, b"x", FLAG_ZLIB),
+                         b"\x03\x01\x00\x00\x00\x01\x00\x00\x00\x01x")
+
+    def test_too_large(self):
+        self.a.sendall(pack_frame(FRAME_DATA, 1)[:6] + (MAX_FRAME + 1).to_bytes(4, "big"))
+        with self.assertRaises(TunnelError):
+            read_frame(self.b)
+
+    def test_closed(self):
+        self.a.sendall(pack_frame(FRAME_DATA, 1, b"cut")[:-1])
+        self.a.close()
+        with self.assertRaises(TunnelError):
+            read_frame(self.b)
+
+    def test_inflate(self):
+        data = b"abc" * 1000
+        self.assertEqual(_inflate(zlib.compress(data)), data)
+
+    def test_inflate_refuses_bombs(self):
+        with self.assertRaises(TunnelError):
+            _inflate(zlib.compress(b"\x00" * (MAX_FRAME + 1)))
+        with self.assertRaises(TunnelError):
+            _inflate(b"not zlib")
+
+
+class MuxTester(unittest.TestCase):
+    """two muxes over a socketpair, the accepting side connects streams to socketpairs"""
+
+    def setUp(self):
+        self.socks = []
+        self.muxes = []
+        # the far end of every stream the server side opened
+        self.backends = []
+
+    def tearDown(self):
+        for mux in self.muxes:
+            mux.close()
+            mux.join(5)
+        for sock in self.socks + self.backends:
+            sock.close()
+
+    def pair(self, on_open=None, **kwargs):
+        a, b = socket.socketpair()
+        client = Mux(a, initiator=True, **kwargs)
+        server = Mux(b, initiator=False, on_open=on_open or self.on_open, **kwargs)
+        self.muxes += [client, server]
+        client.start()
+        server.start()
+        return client, server
+
+    def on_open(self, host, port):
+        if host == "refused":
+            raise ConnectionRefusedError("no")
+        local, backend = socket.socketpair()
+        backend.settimeout(5)
+        self.backends.append(backend)
+        return local
+
+    def open(self, mux, host="example.com", port=80):
+        sock = mux.open(host, port, timeout=5)
+        sock.settimeout(5)
+        self.socks.append(sock)
+        return sock
+
+    def test_both_ways(self):
+        client, _ = self.pair()
+        sock = self.open(client)
+        backend = self.backends[0]
+        sock.sendall(b"ping")
+        self.assertEqual(recv_exact(backend, 4), b"ping")
+        backend.sendall(b"pong")
+        self.assertEqual(recv_exact(sock, 4), b"pong")
+        self.assertEqual(len(client), 1)
+
+    def test_streams(self):
+        client, _ = self.pair()
+        socks = [self.open(client, "host{}".format(i)) for i in range(5)]
+        for i, sock in enumerate(socks):
+            sock.sendall("stream {}".format(i).encode())
+        for i, backend in enumerate(self.backends):
+            self.assertEqual(recv_exact(backend, 8), "stream {}".format(i).encode())
+
+    def test_compressed(self):
+        client, _ = self.pair(compress=True)
+        sock = self.open(client)
+        data = b"compressible " * 20000
+        threading.Thread(target=sock.sendall, args=(data,), daemon=True).start()
+        self.assertEqual(recv_exact(self.backends[0], len(data)), data)
+
+    def test_refused(self):
+        client, _ = self.pair()
+        with self.assertRaises(TunnelError):
+            client.open("refused", 80, timeout=5)
+        self.assertEqual(len(client), 0)
+
+    def test_no_on_open(self):
+        a, b = socket.socketpair()
+        client, server = Mux(a), Mux(b, initiator=False)
+        self.muxes += [client, server]
+        client.start()
+        server.start()
+        with self.assertRaises(TunnelError):
+            client.open("example.com", 80, timeout=5)
+
+    def test_close_reaches_the_other_side(self):
+        client, server = self.pair()
+        sock = self.open(client)
+        sock.close()
+        self.assertEqual(self.backends[0].recv(1), b"")
+        self.assertTrue(wait_for(lambda: not len(client) and not len(server)))
+
+    def test_window(self):
+        window = 16 * 1024
+        client, server = self.pair(window=window)
+        sock = self.open(client)
+        backend = self.backends[0]
+        data = bytes(range(256)) * 4096
+        threading.Thread(target=sock.sendall, args=(data,), daemon=True).start()
+
+        # the backend reads nothing: the sender runs out of credit ...
+        stream = client._streams[1]
+        self.assertTrue(wait_for(lambda: stream.send_window == 0))
+        time.sleep(0.2)
+        # ... and the receiver never holds more than the window it granted
+        queued = sum(len(chunk) for chunk in server._streams[1].outq)
+        self.assertLessEqual(queued, window)
+        self.assertEqual(stream.send_window, 0)
+
+        # credit comes back as the backend reads
+        self.assertEqual(recv_exact(backend, len(data)), data)
+
+
+if __name__ == '__main__':
+    unittest.main()